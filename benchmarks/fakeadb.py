@@ -0,0 +1,246 @@
+#!/usr/bin/env python
+"""
+A stand-in for the adb executable, simulating a farm of devices.
+
+It answers the commands Dumpey sends, including batched shell sessions,
+from a JSON configuration named by the FAKEADB_CONFIG environment variable:
+
+    devices: number of devices, named fake-00, fake-01, ...
+    api: Android API level of every device.
+    latency: seconds each adb call takes, before any transfer.
+    packages: number of installed packages, com.fake.app0000, ...
+    ps_rows: number of rows in the ps process table.
+    dump_size: heap dump size in bytes.
+    bandwidth: bytes per second of pulls, streams and installs.
+    event_latency: seconds each monkey event takes.
+
+Heap dumps are valid Android hprof files, so that they can be converted.
+Nothing is stored, every device always has the same packages and files.
+"""
+
+import struct
+import shlex
+import json
+import time
+import sys
+import re
+import os
+
+DEFAULTS = {
+    'devices': 4,
+    'api': 30,
+    'latency': 0.005,
+    'packages': 200,
+    'ps_rows': 400,
+    'dump_size': 4 << 20,
+    'bandwidth': 40e6,
+    'event_latency': 0.0005,
+}
+
+# First pid of the package processes
+_PID_BASE = 10000
+
+# Instance dumps per heap dump segment, and their field bytes
+_SEGMENT_INSTANCES = 4096
+_INSTANCE_DATA = 32
+
+_FRAME = re.compile(r'echo (\S+)B(\d+); (.*?); _s=\$\?; echo; '
+                    r'echo \1E\2 \$_s')
+
+
+def load_config():
+    config = dict(DEFAULTS)
+    path = os.environ.get('FAKEADB_CONFIG')
+    if path:
+        with open(path) as f:
+            config.update(json.load(f))
+    return config
+
+
+def device_names(config):
+    return ['fake-%02d' % i for i in range(config['devices'])]
+
+
+def package_names(config):
+    return ['com.fake.app%04d' % i for i in range(config['packages'])]
+
+
+def hprof_chunks(size):
+    # Yields an Android heap dump of about size bytes, in chunks.
+    yield b'JAVA PROFILE 1.0.3\0' + struct.pack('>IQ', 4, 0)
+    body = bytearray()
+    for i in range(_SEGMENT_INSTANCES):
+        if i % 64 == 0:
+            # An Android specific root, which conversion rewrites
+            body += struct.pack('>BI', 0x89, i + 1)
+        body += struct.pack('>BIIII', 0x21, i + 1, 0, 1, _INSTANCE_DATA)
+        body += bytearray(_INSTANCE_DATA)
+    segment = struct.pack('>BII', 0x1c, 0, len(body)) + bytes(body)
+    for _ in range(max(1, size // len(segment))):
+        yield segment
+    yield struct.pack('>BII', 0x2c, 0, 0)
+
+
+def transfer_time(config, size):
+    return size / float(config['bandwidth'])
+
+
+class Device(object):
+
+    def __init__(self, config, serial):
+        self.config = config
+        self.serial = serial
+        self.packages = package_names(config)
+
+    def shell(self, line):
+        # Returns the (output, status) of a shell command line.
+        line = line.replace('2>/dev/null', '').strip()
+        if line.startswith('(') and line.endswith(')'):
+            line = line[1:-1]
+        if '||' in line:
+            for alternative in line.split('||'):
+                out, status = self.shell(alternative)
+                if status == 0:
+                    break
+            return out, status
+        words = shlex.split(line)
+        if not words:
+            return '', 0
+        handler = getattr(self, 'cmd_' + words[0].replace('-', '_'), None)
+        if handler is None:
+            return '/system/bin/sh: %s: not found\n' % words[0], 127
+        return handler(words[1:])
+
+    def batch(self, script):
+        output = []
+        for marker, index, command in _FRAME.findall(script):
+            out, status = self.shell(command)
+            output.append('%sB%s\n%s\n%sE%s %d\n'
+                          % (marker, index, out, marker, index, status))
+        return ''.join(output), 0
+
+    def cmd_getprop(self, args):
+        return ('[ro.build.version.sdk]: [%d]\n'
+                '[ro.product.model]: [Fake]\n'
+                '[ro.serialno]: [%s]\n' % (self.config['api'], self.serial),
+                0)
+
+    def cmd_pm(self, args):
+        if args[:2] == ['list', 'packages']:
+            return ''.join('package:%s\n' % p for p in self.packages), 0
+        if args[:1] == ['path']:
+            return 'package:/data/app/%s-1/base.apk\n' % args[1], 0
+        if args[:1] in (['clear'], ['uninstall']):
+            return 'Success\n', 0
+        return 'Unknown command\n', 1
+
+    def cmd_ps(self, args):
+        rows = ['USER PID PPID VSZ RSS WCHAN ADDR S NAME']
+        names = self.packages + ['/system/bin/daemon%d' % i
+                                 for i in range(self.config['ps_rows'])]
+        for i, name in enumerate(names[:self.config['ps_rows']]):
+            rows.append('u0_a%d %d 1 1000 100 0 0 S %s'
+                        % (i, _PID_BASE + i, name))
+        return '\n'.join(rows) + '\n', 0
+
+    def cmd_pidof(self, args):
+        pids = [str(_PID_BASE + self.packages.index(a))
+                for a in args if a in self.packages]
+        return ' '.join(pids) + '\n' if pids else '', 0 if pids else 1
+
+    def cmd_dumpsys(self, args):
+        if args[:1] == ['meminfo']:
+            return (' App Summary\n'
+                    '       Java Heap:    12000\n'
+                    '     Native Heap:     8000\n'
+                    '        Graphics:     4000\n'
+                    '       TOTAL PSS:    40000\n'), 0
+        if args[:1] == ['package']:
+            return ('    versionCode=1 minSdk=21 targetSdk=30\n'
+                    '    lastUpdateTime=2020-01-01 00:00:00\n'), 0
+        return '', 0
+
+    def cmd_am(self, args):
+        return '', 0
+
+    def cmd_rm(self, args):
+        return '', 0
+
+    def cmd_stat(self, args):
+        return '%d 1577836800\n' % self.config['dump_size'], 0
+
+    def cmd_ls(self, args):
+        return ('-rw-rw---- root sdcard_rw %d 2020-01-01 00:00 %s\n'
+                % (self.config['dump_size'], args[-1]), 0)
+
+    def cmd_sha256sum(self, args):
+        return '%s  %s\n' % ('0' * 64, args[-1]), 0
+
+    def cmd_echo(self, args):
+        return ' '.join(args) + '\n', 0
+
+    def cmd_monkey(self, args):
+        events = int(args[-1])
+        time.sleep(events * self.config['event_latency'])
+        return 'Events injected: %d\n' % events, 0
+
+    def cmd_screencap(self, args):
+        return '', 0
+
+
+def main(argv):
+    config = load_config()
+    time.sleep(config['latency'])
+    devices = device_names(config)
+    serial = None
+    if argv[:1] == ['-s']:
+        serial, argv = argv[1], argv[2:]
+    if argv == ['devices']:
+        sys.stdout.write('List of devices attached\n' +
+                         ''.join('%s\tdevice\n' % d for d in devices))
+        return 0
+    if serial is None and len(devices) == 1:
+        serial = devices[0]
+    if serial not in devices:
+        sys.stderr.write("error: device '%s' not found\n" % serial)
+        return 1
+    device = Device(config, serial)
+    command, args = argv[0], argv[1:]
+    out = getattr(sys.stdout, 'buffer', sys.stdout)
+    if command == 'shell':
+        line = ' '.join(args)
+        if _FRAME.search(line):
+            text, status = device.batch(line)
+        else:
+            text, status = device.shell(line)
+        sys.stdout.write(text)
+        return status
+    if command == 'exec-out' and args[:1] == ['cat']:
+        for chunk in hprof_chunks(config['dump_size']):
+            time.sleep(transfer_time(config, len(chunk)))
+            out.write(chunk)
+        return 0
+    if command == 'exec-out' and args[:1] == ['screencap']:
+        out.write(b'\x89PNG\r\n\x1a\n' + bytes(bytearray(1024)))
+        return 0
+    if command == 'pull':
+        with open(args[-1], 'wb') as f:
+            for chunk in hprof_chunks(config['dump_size']):
+                f.write(chunk)
+        time.sleep(transfer_time(config, os.path.getsize(args[-1])))
+        sys.stdout.write('%s: 1 file pulled\n' % args[0])
+        return 0
+    if command in ('install', 'install-multiple'):
+        size = sum(os.path.getsize(a) for a in args if a.endswith('.apk'))
+        time.sleep(transfer_time(config, size))
+        sys.stdout.write('Success\n')
+        return 0
+    if command in ('uninstall', 'reboot'):
+        sys.stdout.write('Success\n')
+        return 0
+    sys.stderr.write('fakeadb: unknown command %s\n' % command)
+    return 1
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
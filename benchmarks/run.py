@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+"""
+Benchmarks Dumpey end to end against a simulated farm of devices.
+
+Each benchmark runs the public API against fakeadb.py, which stands in for
+adb on the PATH, once per device count. It reports the median wall time,
+and the adb commands run and their rate, and can save the results as JSON:
+
+    $ python benchmarks/run.py run --devices 1 4 16 -o results.json
+
+A later run compared against saved results fails, with exit status 1, if
+any benchmark got slower by more than the tolerance:
+
+    $ python benchmarks/run.py run -o new.json --baseline results.json
+    $ python benchmarks/run.py compare results.json new.json
+
+Results are only comparable between runs with the same configuration on
+the same machine. The startup time of fakeadb.py counts towards each adb
+command, as that of adb does.
+"""
+
+from __future__ import print_function
+
+import argparse
+import tempfile
+import timeit
+import shutil
+import json
+import sys
+import os
+
+_HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(_HERE))
+
+from dumpey import dumpey, instrument  # noqa: E402
+
+_RESULTS_VERSION = 1
+
+# Simulated farm, see fakeadb.DEFAULTS, and workload settings
+_CONFIG = {
+    'api': 30,
+    'latency': 0.005,
+    'packages': 200,
+    'ps_rows': 400,
+    'dump_size': 4 << 20,
+    'bandwidth': 40e6,
+    'event_latency': 0.0005,
+    'monkey_events': 200,
+    'install_apks': 4,
+    'install_size': 1 << 20,
+}
+
+_DEVICE_COUNTS = (1, 2, 4, 8)
+
+# Default max ratio of a new to a baseline wall time, minus one
+_TOLERANCE = 0.25
+
+# Package run by the single package benchmarks, and the regex matching the
+# packages of the package_iter one
+_PACKAGE = 'com.fake.app0001'
+_REGEX = r'app00[0-4]'
+
+
+def bench_package_list(devices, work_dir, config):
+    dumpey.package_list(devices, refresh=True)
+
+
+def bench_package_iter(devices, work_dir, config):
+    dumpey.invalidate_packages()
+    dumpey.clear_data(regex=_REGEX, devices=devices, force=True)
+
+
+def bench_install(devices, work_dir, config):
+    dumpey.install(os.path.join(work_dir, 'apks'), devices, reinstall=True)
+
+
+def bench_dump_heap(devices, work_dir, config):
+    dumps = os.path.join(work_dir, 'dumps')
+    os.mkdir(dumps)
+    try:
+        dumpey.dump_heap(_PACKAGE, devices=devices, local_dir=dumps)
+    finally:
+        shutil.rmtree(dumps)
+
+
+def bench_monkey(devices, work_dir, config):
+    dumpey.monkey(_PACKAGE, devices=devices, seed=1,
+                  events=config['monkey_events'], log=False)
+
+
+BENCHMARKS = {
+    'package_list': bench_package_list,
+    'package_iter': bench_package_iter,
+    'install': bench_install,
+    'dump_heap': bench_dump_heap,
+    'monkey': bench_monkey,
+}
+
+
+def run(names, device_counts, repeat, config):
+    """
+    Run benchmarks against fakeadb.py.
+
+    Args:
+        names: list of BENCHMARKS names.
+        device_counts: list of numbers of devices, as ints.
+        repeat: number of runs per benchmark and device count, as int.
+        config: dict of fakeadb settings and workload settings.
+    Returns:
+        the results as a dict, see write_results.
+    """
+    work_dir = tempfile.mkdtemp(prefix='dumpey-bench-')
+    path = os.environ.get('PATH', '')
+    results = {}
+    try:
+        _setup(work_dir, config)
+        os.environ['PATH'] = os.path.join(work_dir, 'bin') + os.pathsep + path
+        dumpey.use_builtin_converter()
+        for name in names:
+            results[name] = {}
+            for count in device_counts:
+                _configure(work_dir, config, count)
+                devices = ['fake-%02d' % i for i in range(count)]
+                results[name][str(count)] = _measure(
+                    BENCHMARKS[name], devices, work_dir, config, repeat)
+    finally:
+        os.environ['PATH'] = path
+        os.environ.pop('FAKEADB_CONFIG', None)
+        dumpey.use_builtin_converter(False)
+        shutil.rmtree(work_dir)
+    return {
+        'version': _RESULTS_VERSION,
+        'python': '%d.%d.%d' % sys.version_info[:3],
+        'config': config,
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def compare(baseline, current, tolerance=_TOLERANCE, out=sys.stdout):
+    """
+    Compare the wall times of two sets of results.
+
+    Args:
+        baseline: results as dict, as returned by run.
+        current: results as dict, as returned by run.
+        tolerance: max slowdown, as a fraction of the baseline wall time.
+        out: text file-like object the comparison is written to.
+    Returns:
+        a list of (benchmark, device count) tuples that got slower by more
+        than the tolerance.
+    """
+    if baseline.get('config') != current.get('config'):
+        out.write('warning: results were taken with different settings\n')
+    regressions = []
+    out.write('%-14s %7s %10s %10s %8s\n'
+              % ('benchmark', 'devices', 'base s', 'new s', 'change'))
+    for name in sorted(current['results']):
+        for count, result in _by_count(current['results'][name]):
+            base = baseline['results'].get(name, {}).get(count)
+            if base is None:
+                continue
+            change = result['wall'] / base['wall'] - 1
+            flag = ''
+            if change > tolerance:
+                regressions.append((name, int(count)))
+                flag = '  REGRESSION'
+            out.write('%-14s %7s %10.3f %10.3f %+7.1f%%%s\n'
+                      % (name, count, base['wall'], result['wall'],
+                         change * 100, flag))
+    return regressions
+
+
+def write_report(results, out=sys.stdout):
+    """Write results as a table, a row per benchmark and device count."""
+    out.write('%-14s %7s %10s %10s %12s\n'
+              % ('benchmark', 'devices', 'wall s', 'commands', 'commands/s'))
+    for name in sorted(results['results']):
+        for count, result in _by_count(results['results'][name]):
+            out.write('%-14s %7s %10.3f %10d %12.1f\n'
+                      % (name, count, result['wall'], result['commands'],
+                         result['commands_per_second']))
+
+
+def write_results(results, path):
+    """
+    Write results as JSON. Each benchmark maps device counts to the median
+    wall time in seconds, the number of adb commands and their rate.
+    """
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=1, sort_keys=True)
+        f.write('\n')
+
+
+def read_results(path):
+    with open(path) as f:
+        results = json.load(f)
+    if results.get('version') != _RESULTS_VERSION:
+        raise Exception('%s: unsupported results version %s'
+                        % (path, results.get('version')))
+    return results
+
+
+#
+# Helpers
+#
+
+def _setup(work_dir, config):
+    # Puts an adb wrapper of fakeadb.py, and the APKs to install, into
+    # work_dir.
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.mkdir(bin_dir)
+    adb = os.path.join(bin_dir, 'adb')
+    with open(adb, 'w') as f:
+        f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n'
+                % (sys.executable, os.path.join(_HERE, 'fakeadb.py')))
+    os.chmod(adb, 0o755)
+    apks = os.path.join(work_dir, 'apks')
+    os.mkdir(apks)
+    for i in range(config['install_apks']):
+        with open(os.path.join(apks, 'app%d.apk' % i), 'wb') as f:
+            f.write(os.urandom(config['install_size']))
+
+
+def _configure(work_dir, config, device_count):
+    path = os.path.join(work_dir, 'fakeadb.json')
+    with open(path, 'w') as f:
+        json.dump(dict(config, devices=device_count), f)
+    os.environ['FAKEADB_CONFIG'] = path
+    dumpey.invalidate_packages()
+    dumpey.invalidate_device_info()
+
+
+def _measure(bench, devices, work_dir, config, repeat):
+    # Returns the median wall time of repeat runs, and the number of adb
+    # commands of the median run.
+    runs = []
+    stdout = sys.stdout
+    for _ in range(repeat):
+        recorder = instrument.enable()
+        sys.stdout = open(os.devnull, 'w')
+        try:
+            start = timeit.default_timer()
+            bench(devices, work_dir, config)
+            wall = timeit.default_timer() - start
+        finally:
+            sys.stdout.close()
+            sys.stdout = stdout
+            instrument.disable()
+        commands = sum(1 for c in recorder.calls()
+                       if c.kind.startswith('adb'))
+        runs.append((wall, commands))
+    wall, commands = sorted(runs)[len(runs) // 2]
+    return {
+        'wall': wall,
+        'commands': commands,
+        'commands_per_second': commands / wall if wall else 0.0,
+    }
+
+
+def _by_count(results):
+    return sorted(results.items(), key=lambda item: int(item[0]))
+
+
+def _parse_setting(string):
+    name, _, value = string.partition('=')
+    if name not in _CONFIG:
+        raise argparse.ArgumentTypeError('unknown setting %s' % name)
+    return name, type(_CONFIG[name])(float(value))
+
+
+def _args_parser():
+    parser = argparse.ArgumentParser(
+        description='Benchmark Dumpey against a simulated device farm.')
+    subparsers = parser.add_subparsers(dest='sub')
+
+    r = subparsers.add_parser('run', help='run benchmarks')
+    r.add_argument('-b', '--benchmarks', nargs='+', choices=sorted(BENCHMARKS),
+                   default=sorted(BENCHMARKS), metavar='NAME',
+                   help='benchmarks to run (default: all of %s)'
+                        % ', '.join(sorted(BENCHMARKS)))
+    r.add_argument('-d', '--devices', nargs='+', type=int, metavar='N',
+                   default=list(_DEVICE_COUNTS),
+                   help='device counts to run with (default: %s)'
+                        % ' '.join(str(n) for n in _DEVICE_COUNTS))
+    r.add_argument('-n', '--repeat', type=int, default=3,
+                   help='runs per benchmark and device count (default: 3)')
+    r.add_argument('--set', type=_parse_setting, action='append', default=[],
+                   metavar='NAME=VALUE',
+                   help='change a setting, one of %s'
+                        % ', '.join(sorted(_CONFIG)))
+    r.add_argument('-o', '--output', metavar='FILE',
+                   help='write the results to a JSON file')
+    r.add_argument('--baseline', metavar='FILE',
+                   help='compare against saved results, and fail on '
+                        'regressions')
+    r.add_argument('--tolerance', type=float, default=_TOLERANCE,
+                   help='max slowdown as a fraction (default: %.2f)'
+                        % _TOLERANCE)
+
+    c = subparsers.add_parser('compare', help='compare saved results')
+    c.add_argument('baseline', help='baseline results file')
+    c.add_argument('current', help='new results file')
+    c.add_argument('--tolerance', type=float, default=_TOLERANCE,
+                   help='max slowdown as a fraction (default: %.2f)'
+                        % _TOLERANCE)
+    return parser
+
+
+def main(argv=None):
+    args = _args_parser().parse_args(argv)
+    if args.sub == 'run':
+        config = dict(_CONFIG)
+        config.update(args.set)
+        current = run(args.benchmarks, args.devices, args.repeat, config)
+        write_report(current)
+        if args.output:
+            write_results(current, args.output)
+        baseline = read_results(args.baseline) if args.baseline else None
+    elif args.sub == 'compare':
+        baseline = read_results(args.baseline)
+        current = read_results(args.current)
+    else:
+        _args_parser().print_help()
+        return 2
+    if baseline is not None:
+        print()
+        if compare(baseline, current, args.tolerance):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
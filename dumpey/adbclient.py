@@ -0,0 +1,299 @@
+"""
+A minimal client for the adb host protocol.
+
+Talks to the adb server over its local socket directly, instead of forking
+an adb client process per command. Each request is a 4 digit hex length
+followed by the payload, and the server answers with OKAY or with FAIL and
+a length-prefixed message.
+
+Shell commands run over the shell v2 protocol when the server and device
+support it, which frames stdout and stderr and reports the exit status of
+the command, like the adb executable does.
+"""
+
+import socket
+import struct
+import sys
+import os
+
+# Default adb server address
+_DEFAULT_HOST = '127.0.0.1'
+_DEFAULT_PORT = 5037
+
+# Seconds to wait for the server to accept a connection
+_CONNECT_TIMEOUT = 2.0
+
+_OKAY = b'OKAY'
+_FAIL = b'FAIL'
+
+# Feature of servers and devices that support the shell v2 protocol
+_SHELL_V2 = 'shell_v2'
+
+# Shell v2 packets: an id byte and a little-endian data length, then data
+_SHELL_PACKET = struct.Struct('<BI')
+_SHELL_STDOUT = 1
+_SHELL_STDERR = 2
+_SHELL_EXIT = 3
+
+_PY3 = sys.version_info[0] >= 3
+
+
+class AdbError(Exception):
+    """Raised when the adb server answers a request with FAIL."""
+
+
+class ServerUnavailable(Exception):
+    """Raised when no adb server is listening on the given address."""
+
+
+class ShellError(AdbError):
+    """
+    Raised when a shell command exits with a non-zero status.
+
+    Attributes:
+        status: exit status as int.
+        output: stdout and stderr of the command as string.
+    """
+
+    def __init__(self, command, status, output):
+        AdbError.__init__(self, "'%s' exited with status %d: %s"
+                          % (_join(command), status, output.strip()))
+        self.status = status
+        self.output = output
+
+
+class AdbClient(object):
+    """
+    Connects to the adb server on host:port. Every request opens a fresh
+    connection, since the server closes it once a service is done.
+    """
+
+    def __init__(self, host=None, port=None, timeout=None):
+        if port is None:
+            port = int(os.environ.get('ANDROID_ADB_SERVER_PORT',
+                                      _DEFAULT_PORT))
+        self.host = host or _DEFAULT_HOST
+        self.port = port
+        self.timeout = timeout
+        self._features = {}
+
+    def devices(self):
+        """
+        Return the raw device list, formatted as 'adb devices' prints it.
+        """
+        sock = self._connect()
+        try:
+            _request(sock, 'host:devices')
+            return 'List of devices attached\n' + _read_message(sock)
+        finally:
+            sock.close()
+
+    def track_devices(self):
+        """
+        Open the device tracking service. The server sends the full device
+        list, formatted as 'adb devices' prints it but without the header,
+        right away and whenever a device changes state.
+
+        Returns:
+            a DeviceTracker reading the lists.
+        """
+        sock = self._connect()
+        try:
+            _request(sock, 'host:track-devices')
+        except Exception:
+            sock.close()
+            raise
+        # Updates come whenever they happen, so reads wait indefinitely.
+        sock.settimeout(None)
+        return DeviceTracker(sock)
+
+    def features(self, device=None):
+        """
+        Return the set of features both the server and a device support,
+        e.g. 'shell_v2'. Features are read once per device, and are empty
+        if the server can't tell them, e.g. for a device that isn't attached
+        or a server older than the features request.
+
+        Args:
+            device: device serial as string, or None for the only device.
+        """
+        features = self._features.get(device)
+        if features is not None:
+            return features
+        sock = self._connect()
+        try:
+            _request(sock, 'host-serial:%s:features' % device if device
+                     else 'host:features')
+            features = frozenset(_read_message(sock).split(','))
+        except AdbError:
+            return frozenset()
+        finally:
+            sock.close()
+        self._features[device] = features
+        return features
+
+    def shell(self, command, device=None):
+        """
+        Run a shell command on a device and return its output.
+
+        Args:
+            command: command as list or string.
+            device: device serial as string, or None for the only device.
+        Returns:
+            the command output as string.
+        Raises:
+            ShellError: if the command exits with a non-zero status. Devices
+                        without shell v2 don't report it, as with the adb
+                        executable.
+        """
+        if _SHELL_V2 not in self.features(device):
+            sock = self.open('shell:' + _join(command), device)
+            try:
+                return _to_native(_read_all(sock))
+            finally:
+                sock.close()
+        sock = self.open('shell,v2,raw:' + _join(command), device)
+        try:
+            stdout, stderr, status = _read_shell_v2(sock)
+        finally:
+            sock.close()
+        if status:
+            raise ShellError(command, status,
+                             _to_native(stdout) + _to_native(stderr))
+        return _to_native(stdout)
+
+    def exec_in(self, command, chunks, device=None):
+        """
+        Run a command on a device, sending it the given bytes as input, and
+        return its output. The command must read exactly the bytes sent.
+
+        Args:
+            command: command as list or string.
+            chunks: iterable of bytes.
+            device: device serial as string, or None for the only device.
+        Returns:
+            the command output as string.
+        """
+        sock = self.open('exec:' + _join(command), device)
+        try:
+            for chunk in chunks:
+                sock.sendall(chunk)
+            return _to_native(_read_all(sock))
+        finally:
+            sock.close()
+
+    def open(self, service, device=None):
+        """
+        Open a device service, e.g. 'shell:ls' or 'exec:cat /path', and
+        return the connected socket. The caller reads the service output
+        from it and closes it when done.
+        """
+        sock = self._connect()
+        try:
+            if device:
+                _request(sock, 'host:transport:' + device)
+            else:
+                _request(sock, 'host:transport-any')
+            _request(sock, service)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def _connect(self):
+        try:
+            sock = socket.create_connection((self.host, self.port),
+                                            _CONNECT_TIMEOUT)
+        except socket.error as e:
+            raise ServerUnavailable('no adb server at %s:%d: %s'
+                                    % (self.host, self.port, e))
+        sock.settimeout(self.timeout)
+        return sock
+
+
+class DeviceTracker(object):
+    """
+    Reads the device lists of the device tracking service, see
+    AdbClient.track_devices.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    def next(self):
+        """
+        Wait for the next device list and return it.
+
+        Raises:
+            AdbError: if the connection is closed.
+        """
+        return _read_message(self.sock)
+
+    def close(self):
+        """Close the connection, which stops a pending next() call."""
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+def _request(sock, payload):
+    data = payload.encode('utf-8')
+    sock.sendall(('%04x' % len(data)).encode('ascii') + data)
+    status = _read_exactly(sock, 4)
+    if status == _FAIL:
+        raise AdbError("'%s' failed: %s" % (payload, _read_message(sock)))
+    if status != _OKAY:
+        raise AdbError("'%s' failed: unexpected status %r" % (payload, status))
+
+
+def _read_message(sock):
+    length = int(_read_exactly(sock, 4), 16)
+    return _to_native(_read_exactly(sock, length))
+
+
+def _read_exactly(sock, size):
+    chunks = []
+    while size > 0:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise AdbError('connection closed by the adb server')
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+def _read_all(sock):
+    chunks = []
+    while True:
+        chunk = sock.recv(65536)
+        if not chunk:
+            return b''.join(chunks)
+        chunks.append(chunk)
+
+
+def _read_shell_v2(sock):
+    # Reads the packets of a shell v2 service up to the exit packet, and
+    # returns a (stdout, stderr, exit status) tuple.
+    out = {_SHELL_STDOUT: [], _SHELL_STDERR: []}
+    while True:
+        kind, length = _SHELL_PACKET.unpack(
+            _read_exactly(sock, _SHELL_PACKET.size))
+        data = _read_exactly(sock, length) if length else b''
+        if kind == _SHELL_EXIT:
+            status = struct.unpack('<B', data[:1])[0] if data else 0
+            return (b''.join(out[_SHELL_STDOUT]),
+                    b''.join(out[_SHELL_STDERR]), status)
+        if kind in out:
+            out[kind].append(data)
+
+
+def _join(command):
+    # Same as the adb client, arguments are joined with spaces and left to
+    # the device shell to interpret.
+    return command if isinstance(command, str) else ' '.join(command)
+
+
+def _to_native(data):
+    return data.decode('utf-8', 'replace') if _PY3 else data
@@ -0,0 +1,728 @@
+"""
+Asynchronous Dumpey API for asyncio applications. Needs Python 3.5+.
+
+The coroutines here mirror the dumpey functions of the same names, but run
+adb as asyncio subprocesses instead of blocking the caller, so that a
+single event loop can drive hundreds of devices at once. Cancelling a
+coroutine kills the adb processes it started, which makes asyncio.wait_for
+a timeout for any of them. adb() also takes a timeout of its own.
+
+Device properties and package lists are cached together with the dumpey
+module, see dumpey.invalidate_device_info and dumpey.invalidate_packages.
+Command output is returned as text.
+
+    async def main():
+        devices = await aio.attached_devices()
+        await asyncio.wait_for(aio.dump_heap('com.example', devices=devices),
+                               timeout=300)
+
+    asyncio.get_event_loop().run_until_complete(main())
+"""
+
+import asyncio
+import random
+import time
+import os
+import re
+
+from . import compress
+from . import dumpey
+
+
+async def adb(args, device=None, decor=None, timeout=None):
+    """
+    Execute an adb command.
+
+    Args:
+        args: command as list.
+        device: device serial as string.
+        decor: function to process command output. Invoked with one param.
+        timeout: max number of seconds the command may take, as float.
+    Returns:
+        the command output, altered by the decor function, if given.
+    Raises:
+        Exception: if the command return code is not 0.
+        asyncio.TimeoutError: if the command timed out, it is killed.
+    """
+    head = ['adb', '-s', device] if device else ['adb']
+    output = await _cmd(head + args, timeout)
+    return decor(output) if decor else output
+
+
+async def api_version(device, decor=None):
+    """
+    Return the Android SDK version a given device is running on.
+
+    Args:
+        device: device serial as string.
+        decor: function to process command output. Invoked with one param.
+    Returns:
+        the version number as a string, altered by the decor function,
+        if given.
+    """
+    info = await device_info(device)
+    version = info.get('ro.build.version.sdk', '').strip()
+    return decor(version) if decor else version
+
+
+async def attached_devices():
+    """
+    Return a list of currently attached devices, read from the registry
+    of dumpey.watch_devices if it is enabled.
+
+    Raises:
+        Exception: if there are no devices in "device" state.
+    """
+    if dumpey._registry is not None:
+        devices = dumpey._registry.devices()
+    else:
+        raw_list = (await adb(['devices'], decor=dumpey._decor_split))[1:]
+        delimiter = "\tdevice"
+        devices = [d.split(delimiter)[0] for d in raw_list if delimiter in d]
+    if not devices:
+        raise Exception("no devices in 'device' state")
+    return devices
+
+
+async def clear_data(package=None, regex=None, devices=None, force=False,
+                     max_workers=None):
+    """
+    Stop and clear all data associated with a given package or the ones
+    found by regex, see dumpey.clear_data.
+
+    Args:
+        package: package name as string.
+        regex: string.
+        devices: list of device serials.
+        force: boolean.
+        max_workers: max number of devices handled at once, as int.
+    Raises:
+        Exception: if neither package nor regex is given.
+        DeviceError: if the command fails on any of the devices.
+    """
+    await _for_packages(_clear_data, package, regex, devices, force,
+                        max_workers)
+
+
+async def device_info(device, refresh=False):
+    """
+    Return the DeviceInfo of a given device, see dumpey.device_info.
+
+    Args:
+        device: device serial as string.
+        refresh: boolean.
+    """
+    with dumpey._device_info_lock:
+        info = dumpey._device_info.get(device)
+    if info is None or refresh:
+        properties = await adb(['shell', 'getprop'], device,
+                               dumpey._decor_getprop)
+        info = dumpey.DeviceInfo(device, properties)
+        with dumpey._device_info_lock:
+            dumpey._device_info[device] = info
+    return info
+
+
+async def dump_heap(package=None, regex=None, devices=None, local_dir=None,
+                    force=False, max_workers=None, codec=None):
+    """
+    Create a converted heap dump for a given package or regex and download
+    it to a local_dir, see dumpey.dump_heap. Heap dumps are converted in a
+    worker thread, the only blocking part.
+
+    Args:
+        package: package name as string.
+        regex: string.
+        devices: list of device serials.
+        local_dir: local directory path as string.
+        force: boolean.
+        max_workers: max number of devices handled at once, as int.
+        codec: one of 'gzip', 'zstd' or 'lz4'.
+    Raises:
+        Exception: if neither package nor regex is given.
+        DeviceError: if the command fails on any of the devices.
+    """
+    if local_dir is None:
+        local_dir = os.getcwd()
+    await _for_packages(_dump_heap, package, regex, devices, force,
+                        max_workers, local_dir, codec)
+
+
+async def install(local_path=None, devices=None, recursive=False,
+                  max_workers=None, reinstall=False):
+    """
+    Install APKs on given devices, see dumpey.install. A base APK and its
+    splits are installed together. APKs a device already has are skipped,
+    unless reinstall is True.
+
+    Args:
+        local_path: path to a local file or directory as string.
+        devices: device serial as string.
+        recursive: boolean.
+        max_workers: max number of devices handled at once, as int.
+        reinstall: boolean.
+    Returns:
+        a dict of local APK paths installed, skipped and failed on each
+        device, e.g.:
+        {'device_1': {'installed': ['a.apk'], 'skipped': [], 'failed': []}}
+    Raises:
+        Exception: if the local path does not exist.
+        DeviceError: if the command fails on any of the devices.
+    """
+    if local_path is None:
+        local_path = os.getcwd()
+    elif not os.path.exists(local_path):
+        raise Exception("%s does not exist" % local_path)
+    if devices is None:
+        devices = await attached_devices()
+    if os.path.isdir(local_path):
+        local_files = dumpey._apk_files(local_path, recursive)
+    else:
+        local_files = [local_path]
+    # Reading manifests and checking the installed APKs block, they are
+    # done in worker threads.
+    loop = asyncio.get_event_loop()
+    apks = await loop.run_in_executor(None, dumpey._identify_apks,
+                                      local_files)
+    groups = dumpey._apk_groups(local_files, apks)
+
+    async def install_all(device):
+        outcome = {'installed': [], 'skipped': [], 'failed': []}
+        unchanged = set()
+        if apks and not reinstall:
+            unchanged = await loop.run_in_executor(
+                None, dumpey._unchanged_apks, device, apks)
+        for group in groups:
+            if all(local_file in unchanged for local_file in group):
+                for local_file in group:
+                    dumpey._inform('%s is up to date on %s', local_file,
+                                   device)
+                outcome['skipped'].extend(group)
+                continue
+            try:
+                await _install_apks(group, device)
+                outcome['installed'].extend(group)
+            except Exception as e:
+                dumpey._warn('failed to install %s on %s: %s',
+                             dumpey._to_str(group), device, e)
+                outcome['failed'].extend(group)
+        return outcome
+
+    return await _fan_out(install_all, devices, max_workers)
+
+
+async def monkey(package=None, regex=None, devices=None, seed=None,
+                 events=None, before=None, after=None, log=True, force=False,
+                 max_workers=None):
+    """
+    Run the monkey stress test, see dumpey.monkey.
+
+    Args:
+        package: package name as string.
+        regex: string.
+        devices: list of device serials.
+        seed: int value for pseudo-random number generator.
+        events: number of events to be injected as int.
+        before: function or coroutine function to be executed before each
+                monkey iteration starts. Receives two arguments: package
+                name and device serial.
+        after: function or coroutine function to be executed after each
+               monkey iteration ends. Receives two arguments: package name
+               and device serial.
+        log: boolean.
+        force: boolean.
+        max_workers: max number of devices handled at once, as int.
+    Raises:
+        Exception: if neither package nor regex is given.
+        DeviceError: if the command fails on any of the devices.
+    """
+    if seed is None:
+        seed = random.randint(dumpey._MONKEY_SEED_MIN,
+                              dumpey._MONKEY_SEED_MAX)
+    if events is None:
+        events = dumpey._MONKEY_EVENTS
+    await _for_packages(_monkey, package, regex, devices, force, max_workers,
+                        seed, events, before, after, log)
+
+
+async def package_list(devices=None, regex=None, max_workers=None,
+                       refresh=False):
+    """
+    Return a dict of installed packages on given devices, filtered by the
+    regex, see dumpey.package_list.
+
+    Args:
+        devices: list of device serials.
+        regex: string.
+        max_workers: max number of devices handled at once, as int.
+        refresh: boolean.
+    Raises:
+        DeviceError: if the packages cannot be listed on any of the devices.
+    """
+    if devices is None:
+        devices = await attached_devices()
+    compiled_regex = re.compile(regex) if regex else None
+    return await _fan_out(lambda d: _package_list(d, compiled_regex, refresh),
+                          devices, max_workers)
+
+
+async def pid(package, device, force_open=True):
+    """
+    Return the package process ID on a given device, see dumpey.pid.
+
+    Args:
+        package: package name as string.
+        device: device serial as string.
+        force_open: boolean.
+    Raises:
+        Exception: if force_open cannot open the given package, or if multiple
+        PIDs are found.
+    """
+    processes = (await pids([package], device))[package]
+    if not processes:
+        if force_open:
+            await _monkey(package, device, 0, 1, None, None, False)
+            return await pid(package, device, force_open=False)
+        raise Exception('no process on %s found for %s, is your app '
+                        'installed?' % (device, package))
+    elif len(processes) > 1:
+        raise Exception('multiple processes for %s: %s.'
+                        % (package, dumpey._to_str(processes)))
+    return processes[0]
+
+
+async def pids(packages, device):
+    """
+    Return the process IDs of many packages on a given device at once, see
+    dumpey.pids.
+
+    Args:
+        packages: list of package names.
+        device: device serial as string.
+    Returns:
+        a dict of package names to lists of PIDs as strings.
+    """
+    if await api_version(device, int) >= dumpey._PIDOF_MIN_API:
+        results = await shell_batch(device, [['pidof', package]
+                                             for package in packages])
+        return {package: output.split() for package, (output, _)
+                in zip(packages, results)}
+    command = ['shell', 'ps']
+    if await api_version(device, int) >= dumpey._PS_ALL_MIN_API:
+        command.append('-A')
+    table = dumpey.ProcessTable(device, await adb(command, device,
+                                                  dumpey._decor_ps))
+    return {package: table.pids(package) for package in packages}
+
+
+async def pull(remote, local, device):
+    """
+    Copies files from a device.
+
+    Args:
+        remote: path on a device to be copied as string.
+        local: local path where remote file will be copied to as string.
+        device: device serial as string.
+    """
+    await adb(['pull', remote, local], device)
+
+
+async def pull_apk(package=None, regex=None, devices=None, local_dir=None,
+                   force=False, max_workers=None):
+    """
+    Downloads the package apk, and its splits if it has any, see
+    dumpey.pull_apk.
+
+    Args:
+        package: package name as string.
+        regex: string.
+        devices: list of device serials.
+        local_dir: local directory as string.
+        force: boolean.
+        max_workers: max number of devices handled at once, as int.
+    Raises:
+        DeviceError: if the command fails on any of the devices.
+    """
+    if local_dir is None:
+        local_dir = os.getcwd()
+    await _for_packages(_pull_apk, package, regex, devices, force,
+                        max_workers, local_dir)
+
+
+async def reboot(devices=None, max_workers=None):
+    """
+    Reboot the devices.
+
+    Args:
+        devices: list of device serials.
+        max_workers: max number of devices handled at once, as int.
+    Raises:
+        DeviceError: if any of the devices fails to reboot.
+    """
+    if devices is None:
+        devices = await attached_devices()
+    await _fan_out(_reboot, devices, max_workers)
+
+
+async def remove_file(remote_path, device):
+    """
+    Remove the remote path from a device, if it exists.
+
+    Args:
+        remote_path: path on a device as string.
+        device: device serial as string.
+    """
+    await adb(['shell', 'rm', '-f', remote_path], device)
+
+
+async def shell_batch(device, commands):
+    """
+    Run shell commands in a single adb shell session, see
+    dumpey.ShellBatch.
+
+    Args:
+        device: device serial as string.
+        commands: list of commands, each a list or a string.
+    Returns:
+        a list of (output, exit status) tuples, one per command.
+    Raises:
+        Exception: if the output of a command cannot be found.
+    """
+    if not commands:
+        return []
+    marker = '_dumpey_%d_' % random.randint(dumpey._BATCH_MARKER_MIN,
+                                            dumpey._BATCH_MARKER_MAX)
+    script = [dumpey._BATCH_FRAME % {'marker': marker,
+                                     'index': index,
+                                     'command': dumpey._shell_str(command)}
+              for index, command in enumerate(commands)]
+    output = await adb(['shell', '; '.join(script)], device)
+    return dumpey._parse_batch_output(output, marker, len(commands))
+
+
+async def uninstall(package=None, regex=None, devices=None, force=False,
+                    max_workers=None):
+    """
+    Uninstall the package on all given devices, see dumpey.uninstall.
+
+    Args:
+        package: package name as string.
+        regex: string.
+        devices: list of device serials.
+        force: boolean.
+        max_workers: max number of devices handled at once, as int.
+    Raises:
+        DeviceError: if the command fails on any of the devices.
+    """
+    await _for_packages(_uninstall_package, package, regex, devices, force,
+                        max_workers)
+
+
+async def wait_for_file(remote_path, device, timeout=None, settle=None):
+    """
+    Wait until a device is done writing a file, see dumpey.wait_for_file.
+
+    Args:
+        remote_path: path to a file on a device as string.
+        device: device serial as string.
+        timeout: max number of seconds to wait, as float.
+        settle: number of seconds the file has to stay unchanged, as float.
+    Returns:
+        the file size as int, 0 if the file is empty or does not exist.
+    Raises:
+        Exception: if the file is not complete after timeout seconds.
+    """
+    if timeout is None:
+        timeout = dumpey._WAIT_TIMEOUT
+    if settle is None:
+        settle = dumpey._WAIT_SETTLE
+    start = changed = time.time()
+    interval = dumpey._WAIT_POLL_MIN
+    last = None
+    unchanged = 0
+    while True:
+        await asyncio.sleep(interval)
+        now = time.time()
+        probe = await _remote_stat(remote_path, device)
+        size = probe[0] if probe else 0
+        if probe != last:
+            last = probe
+            changed = now
+            unchanged = 0
+        else:
+            unchanged += 1
+            if (unchanged >= dumpey._WAIT_SETTLE_PROBES and
+                    now - changed >= (settle if size else
+                                      dumpey._WAIT_EMPTY_SETTLE)):
+                return size
+            interval = min(interval * 2, dumpey._WAIT_POLL_MAX)
+        if now - start >= timeout:
+            raise Exception('%s on %s not complete after %ds'
+                            % (remote_path, device, timeout))
+
+
+#
+# Helpers
+#
+
+async def _cmd(args, timeout=None, stdout=asyncio.subprocess.PIPE):
+    process = await asyncio.create_subprocess_exec(
+        *args, stdout=stdout, stderr=asyncio.subprocess.PIPE)
+    try:
+        output, err = await asyncio.wait_for(process.communicate(), timeout)
+    except BaseException:
+        # Timed out or cancelled, adb must not outlive the coroutine.
+        if process.returncode is None:
+            process.kill()
+        raise
+    if process.returncode:
+        raise Exception("failed to execute '%s', status=%d, err=%s"
+                        % (dumpey._to_str(args, " "), process.returncode,
+                           _decode(err)))
+    return _decode(output)
+
+
+async def _stream(args, consume):
+    # Runs args and passes its output, as a binary file object, to consume,
+    # called in a worker thread, see dumpey._stream.
+    read_fd, write_fd = os.pipe()
+    try:
+        process = await asyncio.create_subprocess_exec(*args, stdout=write_fd)
+    except BaseException:
+        os.close(read_fd)
+        raise
+    finally:
+        os.close(write_fd)
+    try:
+        await asyncio.get_event_loop().run_in_executor(
+            None, _consume, consume, os.fdopen(read_fd, 'rb'))
+        returncode = await process.wait()
+    except BaseException:
+        # Failed, timed out or cancelled, adb must not outlive the coroutine.
+        if process.returncode is None:
+            process.kill()
+        raise
+    if returncode:
+        raise Exception("failed to execute '%s', status=%d"
+                        % (dumpey._to_str(args, " "), returncode))
+
+
+def _consume(consume, src):
+    with src:
+        consume(src)
+
+
+def _decode(output):
+    return output.decode('utf-8', 'replace') if output else ''
+
+
+async def _fan_out(func, devices, max_workers=None):
+    # Awaits func(device) on each device, at most max_workers at a time, or
+    # all at once if max_workers is None. A failing device does not stop
+    # the others, see dumpey._fan_out.
+    semaphore = asyncio.Semaphore(max_workers) if max_workers else None
+
+    async def run(device):
+        try:
+            if semaphore is None:
+                return device, await func(device), None
+            async with semaphore:
+                return device, await func(device), None
+        except Exception as e:
+            return device, None, e
+
+    outcomes = await asyncio.gather(*[run(device) for device in devices])
+    results = {}
+    errors = {}
+    for device, result, error in outcomes:
+        if error is None:
+            results[device] = result
+        else:
+            dumpey._warn('failed on %s: %s', device, error)
+            errors[device] = error
+    if errors:
+        raise dumpey.DeviceError(results, errors)
+    return results
+
+
+async def _for_packages(func, package, regex, devices, force, max_workers,
+                        *args):
+    # Awaits func(package, device, *args) on each device, for the package or
+    # for the ones matching regex, see dumpey._package_iter.
+    dumpey._ensure_package_or_regex_given(package, regex)
+    if devices is None:
+        devices = await attached_devices()
+    if package is not None:
+        return await _fan_out(lambda d: func(package, d, *args), devices,
+                              max_workers)
+    compiled_regex = re.compile(regex)
+
+    async def run(device):
+        packages = await _package_list(device, compiled_regex)
+        if not packages:
+            dumpey._warn("nothing found for regex '%s' on %s", regex, device)
+        elif len(packages) > 1 and not force:
+            dumpey._warn("multiple apps found for regex '%s' on %s: %s",
+                         regex, device, dumpey._to_str(packages))
+        else:
+            for p in packages:
+                await func(p, device, *args)
+            return True
+        return False
+
+    return await _fan_out(run, devices, max_workers)
+
+
+async def _package_list(device, compiled_regex, refresh=False):
+    now = time.time()
+    with dumpey._package_cache_lock:
+        cached = dumpey._package_cache.get(device)
+    if cached and not refresh and now - cached[0] < dumpey._PACKAGE_CACHE_TTL:
+        packages = cached[1]
+    else:
+        packages = await adb(['shell', 'pm', 'list', 'packages'], device,
+                             dumpey._decor_package)
+        with dumpey._package_cache_lock:
+            dumpey._package_cache[device] = (now, packages)
+    return [p for p in packages if
+            compiled_regex.search(p)] if compiled_regex else list(packages)
+
+
+async def _clear_data(package, device):
+    await adb(["shell", "pm", "clear", package], device)
+    dumpey._inform("cleared data for '%s' on device %s", package, device)
+
+
+async def _uninstall_package(package, device):
+    await adb(['uninstall', package], device)
+    dumpey.invalidate_packages([device])
+    dumpey._inform('%s uninstalled from %s', package, device)
+
+
+async def _install_apks(local_files, device):
+    if len(local_files) > 1 and (await api_version(device, int) >=
+                                 dumpey._INSTALL_MULTIPLE_MIN_API):
+        out = await adb(['install-multiple', '-r'] + local_files, device)
+        dumpey._check_install(out, local_files, device)
+        return
+    for local_file in local_files:
+        out = await adb(['install', '-r', local_file], device)
+        dumpey._check_install(out, [local_file], device)
+
+
+async def _reboot(device):
+    await adb(["reboot"], device)
+    dumpey.invalidate_packages([device])
+    dumpey.invalidate_device_info([device])
+    dumpey._inform("%s rebooted", device)
+
+
+async def _monkey(package, device, seed, events, before, after, log):
+    if before is not None:
+        await _maybe_await(before(package, device))
+    if log:
+        dumpey._inform('starting monkey (seed=%d, events=%d) on %s '
+                       'for package %s', seed, events, device, package)
+    await adb(['shell', 'monkey', '-p', package, '-s', str(seed),
+               str(events)], device)
+    if after is not None:
+        await _maybe_await(after(package, device))
+
+
+async def _maybe_await(result):
+    if asyncio.iscoroutine(result) or isinstance(result, asyncio.Future):
+        return await result
+    return result
+
+
+async def _pull_apk(package, device, local_dir):
+    paths = await adb(['shell', 'pm', 'path', package], device,
+                      dumpey._decor_package)
+    if not paths:
+        dumpey._warn('path for package %s on %s not available', package,
+                     device)
+    for path in paths:
+        name = dumpey._apk_name(package, device, path, len(paths) > 1)
+        local = os.path.join(local_dir, name)
+        await pull(path, local, device)
+        dumpey._inform('apk from %s downloaded to %s', device, local)
+
+
+async def _remote_stat(remote_path, device):
+    # See dumpey._remote_stat.
+    try:
+        if await api_version(device, int) < dumpey._STAT_MIN_API:
+            out = await adb(['shell', 'ls', '-l', remote_path,
+                             dumpey._IGNORE_STATUS], device)
+            return int(dumpey._split_whitespace(out)[3]), None
+        out = await adb(['shell', 'stat', '-c', "'%s %Y'", remote_path,
+                         dumpey._IGNORE_STATUS], device)
+        size, mtime = out.split()
+        return int(size), int(mtime)
+    except (ValueError, IndexError):
+        return None
+
+
+async def _dump_heap(package, device, local_dir, codec=None):
+    # Unlike dumpey._dump_heap, each package is dumped to a remote file of
+    # its own, as several dumps may run on a device at once.
+    api = await api_version(device, int)
+    if api < 11:
+        dumpey._warn('heap dumps available on API > 10, device %s is %d',
+                     device, api)
+        return None
+    pid_str = await pid(package, device)
+    remote = '%s_%s' % (dumpey._REMOTE_HEAP_DUMP_PATH,
+                        dumpey._alphanum_str(package))
+    results = await shell_batch(device, [['rm', '-f', remote],
+                                         ['am', 'dumpheap', pid_str, remote]])
+    dumpey._check_dumpheap(results[1], package, device)
+    if api < dumpey._DUMPHEAP_WAIT_MIN_API:
+        size = await wait_for_file(remote, device)
+    else:
+        probe = await _remote_stat(remote, device)
+        size = probe[0] if probe else 0
+    if not size:
+        dumpey._warn("heap dump is empty, has '%s' crashed?", package)
+        await remove_file(remote, device)
+        return None
+
+    name = dumpey._generate_name(device, [package])
+    local_file = os.path.join(local_dir, name + '.hprof')
+    local_file_nonconv = local_file + '-nonconv'
+    local_file = compress.filename(local_file, codec)
+    # Compressed dumps are converted in-process, so that only compressed
+    # bytes reach the disk.
+    builtin = (dumpey._builtin_converter or codec or
+               not dumpey._find_executable('hprof-conv'))
+    try:
+        if api >= dumpey._EXEC_OUT_MIN_API and builtin:
+            # Stream the dump straight into the converter.
+            await _stream(['adb', '-s', device, 'exec-out', 'cat', remote],
+                          lambda src: dumpey._convert_hprof(src, local_file,
+                                                            codec))
+        else:
+            # Download the non-converted dump, then convert it.
+            if api >= dumpey._EXEC_OUT_MIN_API:
+                with open(local_file_nonconv, 'wb') as dst:
+                    await _cmd(['adb', '-s', device, 'exec-out', 'cat',
+                                remote], stdout=dst)
+            else:
+                await pull(remote, local_file_nonconv, device)
+            if builtin:
+                await asyncio.get_event_loop().run_in_executor(
+                    None, _convert_file, local_file_nonconv, local_file,
+                    codec)
+            else:
+                await _cmd(['hprof-conv', local_file_nonconv, local_file])
+    finally:
+        if os.path.exists(local_file_nonconv):
+            os.remove(local_file_nonconv)
+    await remove_file(remote, device)
+    dumpey._inform('converted hprof file available at %s', local_file)
+    return local_file
+
+
+def _convert_file(src_file, local_file, codec):
+    with open(src_file, 'rb') as src:
+        dumpey._convert_hprof(src, local_file, codec)
@@ -0,0 +1,576 @@
+"""
+Heap dump analysis without a GUI.
+
+class_histogram() counts the instances and shallow bytes of every class in
+a heap dump, in one streaming pass that keeps no object graph in memory.
+diff_histograms() compares two histograms, e.g. of dumps taken before and
+after a monkey run, and write_report() ranks the classes that grew.
+
+dominator_tree() computes the retained size of every object, the bytes
+that would be freed if it were collected, and write_retainers() lists the
+objects retaining the most.
+"""
+
+from bisect import bisect_left
+from array import array
+import tempfile
+import shutil
+import struct
+import heapq
+import os
+
+from . import compress
+from . import heapindex
+from . import hprof
+
+try:
+    array('q')
+    _LONG = 'q'
+    _ID = 'Q'
+except ValueError:
+    _LONG = 'l'
+    _ID = 'L'
+
+# Class names of primitive arrays, by basic type
+_PRIMITIVE_ARRAYS = {
+    4: 'boolean[]',
+    5: 'char[]',
+    6: 'float[]',
+    7: 'double[]',
+    8: 'byte[]',
+    9: 'short[]',
+    10: 'int[]',
+    11: 'long[]',
+}
+
+
+class Histogram(object):
+    """
+    Instance count and shallow size in bytes of each class of a heap.
+
+    Shallow sizes are the bytes a dump records for an object: field values
+    for instances, elements for arrays. Object headers are not included, as
+    they depend on the VM.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.counts = array(_LONG)
+        self.sizes = array(_LONG)
+        self._index = {}
+
+    def add(self, name, size, count=1):
+        """
+        Add count objects of a class, size bytes in total.
+
+        Args:
+            name: class name as string.
+            size: int.
+            count: int.
+        """
+        i = self._index.get(name)
+        if i is None:
+            i = self._index[name] = len(self.names)
+            self.names.append(name)
+            self.counts.append(0)
+            self.sizes.append(0)
+        self.counts[i] += count
+        self.sizes[i] += size
+
+    def get(self, name):
+        """
+        Return the (instance count, shallow size) tuple of a class, zeros if
+        the heap has no instances of it.
+        """
+        i = self._index.get(name)
+        if i is None:
+            return 0, 0
+        return self.counts[i], self.sizes[i]
+
+    def total(self):
+        """Return the (instance count, shallow size) tuple of the heap."""
+        return sum(self.counts), sum(self.sizes)
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        """Yield (class name, instance count, shallow size) tuples."""
+        for i, name in enumerate(self.names):
+            yield name, self.counts[i], self.sizes[i]
+
+
+def class_histogram(path):
+    """
+    Return the class Histogram of a heap dump file.
+
+    Args:
+        path: local path of an Android or J2SE hprof file, compressed or
+              not, as string.
+    Returns:
+        a Histogram.
+    Raises:
+        HprofError: if the file is not a heap dump, or it is malformed.
+    """
+    visitor = _HistogramVisitor()
+    with compress.open_read(path) as src:
+        hprof.walk(src, visitor)
+    return visitor.histogram()
+
+
+def diff_histograms(before, after):
+    """
+    Return the classes whose instance count or shallow size grew between
+    two histograms, largest size growth first.
+
+    Args:
+        before: Histogram.
+        after: Histogram.
+    Returns:
+        a list of (class name, count delta, size delta) tuples.
+    """
+    grown = []
+    for name, count, size in after:
+        before_count, before_size = before.get(name)
+        count_delta = count - before_count
+        size_delta = size - before_size
+        if count_delta > 0 or size_delta > 0:
+            grown.append((name, count_delta, size_delta))
+    grown.sort(key=lambda g: (-g[2], -g[1], g[0]))
+    return grown
+
+
+def write_report(out, before, after, limit=None):
+    """
+    Write a text report of the classes that grew between two histograms.
+
+    Args:
+        out: text file-like object.
+        before: Histogram.
+        after: Histogram.
+        limit: max number of classes listed, as int, or None for all.
+    """
+    grown = diff_histograms(before, after)
+    before_count, before_size = before.total()
+    after_count, after_size = after.total()
+    out.write('instances: %d -> %d (%+d)\n'
+              % (before_count, after_count, after_count - before_count))
+    out.write('shallow bytes: %d -> %d (%+d)\n'
+              % (before_size, after_size, after_size - before_size))
+    out.write('%d classes grew\n\n' % len(grown))
+    out.write('%14s %12s  %s\n' % ('bytes', 'instances', 'class'))
+    for name, count_delta, size_delta in grown[:limit]:
+        out.write('%+14d %+12d  %s\n' % (size_delta, count_delta, name))
+
+
+def dominator_tree(path):
+    """
+    Compute the dominator tree and the retained sizes of a heap dump.
+
+    The reference graph is kept in flat integer arrays, a few dozen bytes
+    per object, and objects are read through the heapindex index of the
+    dump, which is built if needed. Compressed dumps are decompressed to a
+    temporary file first.
+
+    Args:
+        path: local path of an Android or J2SE hprof file, compressed or
+              not, as string.
+    Returns:
+        a DominatorTree.
+    Raises:
+        HprofError: if the file is not a heap dump, or it is malformed.
+    """
+    if compress.detect(path) is None:
+        with heapindex.HeapIndex(path) as index:
+            return _build_dominator_tree(index)
+    tmp_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        tmp_path = os.path.join(tmp_dir, 'dump.hprof')
+        with compress.open_read(path) as src:
+            with open(tmp_path, 'wb') as dst:
+                shutil.copyfileobj(src, dst)
+        with heapindex.HeapIndex(tmp_path) as index:
+            return _build_dominator_tree(index)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def write_retainers(out, tree, count=20, prefix=None):
+    """
+    Write a text report of the objects retaining the most memory.
+
+    Args:
+        out: text file-like object.
+        tree: DominatorTree.
+        count: max number of objects listed, as int.
+        prefix: class name prefix as string, see DominatorTree.top.
+    """
+    out.write('%14s %14s  %s\n' % ('retained', 'shallow', 'object'))
+    for object_id, name, shallow, retained in tree.top(count, prefix):
+        out.write('%14d %14d  %s @ 0x%x\n'
+                  % (retained, shallow, name, object_id))
+
+
+class DominatorTree(object):
+    """
+    Dominator tree of a heap, with the retained size of each object. An
+    object dominates another if every path from the GC roots to the latter
+    goes through it. Built by dominator_tree().
+
+    Objects are numbered by ascending id, the arrays hold a value per
+    object. Unreachable objects retain nothing.
+    """
+
+    def __init__(self, ids, classes, kinds, shallow, retained, idom, names):
+        self.ids = ids
+        self.classes = classes
+        self.kinds = kinds
+        self.shallow = shallow
+        self.retained = retained
+        # Immediate dominator of each object, len(ids) for the GC roots and
+        # -1 if the object is unreachable.
+        self.idom = idom
+        self.names = names
+
+    def __len__(self):
+        return len(self.ids)
+
+    def retained_size(self, object_id):
+        """
+        Return the retained size of an object in bytes, or None if the heap
+        has no such object.
+        """
+        i = self._node(object_id)
+        return None if i is None else self.retained[i]
+
+    def dominator(self, object_id):
+        """
+        Return the id of the immediate dominator of an object, or None if it
+        is dominated by the GC roots only, unreachable or unknown.
+        """
+        i = self._node(object_id)
+        if i is None or self.idom[i] < 0 or self.idom[i] == len(self.ids):
+            return None
+        return self.ids[self.idom[i]]
+
+    def top(self, count=20, prefix=None):
+        """
+        Return the objects retaining the most memory.
+
+        Args:
+            count: max number of objects returned, as int.
+            prefix: class name prefix as string, e.g. a package name
+                    followed by a dot. If given, objects of the classes
+                    matching it are returned, otherwise the objects
+                    dominated by the GC roots only.
+        Returns:
+            a list of (object id, class name, shallow size, retained size)
+            tuples, largest retained size first.
+        """
+        nodes = range(len(self.ids))
+        if prefix is None:
+            root = len(self.ids)
+            nodes = (i for i in nodes if self.idom[i] == root)
+        else:
+            matching = set(class_id for class_id, name in self.names.items()
+                           if name.startswith(prefix))
+            nodes = (i for i in nodes if self.retained[i] and
+                     self._class_key(i) in matching)
+        best = heapq.nlargest(count, nodes, key=self.retained.__getitem__)
+        return [(self.ids[i], self._name(i), self.shallow[i],
+                 self.retained[i]) for i in best]
+
+    def _node(self, object_id):
+        i = bisect_left(self.ids, object_id)
+        if i < len(self.ids) and self.ids[i] == object_id:
+            return i
+        return None
+
+    def _class_key(self, i):
+        # Returns the id of the class an object is matched by, the class
+        # itself for class objects.
+        kind = self.kinds[i]
+        if kind == heapindex.CLASS:
+            return self.ids[i]
+        if kind == heapindex.PRIMITIVE_ARRAY:
+            return None
+        return self.classes[i]
+
+    def _name(self, i):
+        kind = self.kinds[i]
+        if kind == heapindex.PRIMITIVE_ARRAY:
+            return _PRIMITIVE_ARRAYS[self.classes[i]]
+        class_id = self._class_key(i)
+        name = self.names.get(class_id, '0x%x' % class_id)
+        return 'class ' + name if kind == heapindex.CLASS else name
+
+
+class _HistogramVisitor(hprof.HeapVisitor):
+    # Counts objects by class id while walking, class names are resolved at
+    # the end. Primitive arrays are keyed by their negated basic type.
+
+    def __init__(self):
+        self.strings = {}
+        self.class_names = {}
+        self.counts = array(_LONG)
+        self.sizes = array(_LONG)
+        self.index = {}
+        self.id_size = 4
+
+    def header(self, version, id_size):
+        self.id_size = id_size
+
+    def string(self, string_id, value):
+        self.strings[string_id] = value
+
+    def load_class(self, class_id, name_id):
+        self.class_names[class_id] = name_id
+
+    def add(self, key, size):
+        i = self.index.get(key)
+        if i is None:
+            i = self.index[key] = len(self.counts)
+            self.counts.append(0)
+            self.sizes.append(0)
+        self.counts[i] += 1
+        self.sizes[i] += size
+
+    def instance(self, offset, object_id, class_id, size, data):
+        self.add(class_id, size)
+
+    def object_array(self, offset, object_id, class_id, count, data):
+        self.add(class_id, count * self.id_size)
+
+    def primitive_array(self, offset, object_id, kind, count):
+        self.add(-kind, count * hprof.TYPE_SIZES[kind])
+
+    def name(self, key):
+        if key < 0:
+            return _PRIMITIVE_ARRAYS[-key]
+        name = self.strings.get(self.class_names.get(key))
+        if name is None:
+            return '0x%x' % key
+        return name.decode('utf-8', 'replace').replace('/', '.')
+
+    def histogram(self):
+        histogram = Histogram()
+        for key, i in self.index.items():
+            histogram.add(self.name(key), self.sizes[i], self.counts[i])
+        return histogram
+
+
+class _GraphVisitor(hprof.HeapVisitor):
+    # Collects the GC roots, the field types of each class and the objects
+    # each class references: its super class and static values.
+
+    def __init__(self):
+        self.roots = array(_ID)
+        self.layouts = {}
+        self.class_refs = {}
+
+    def root(self, tag, object_id):
+        self.roots.append(object_id)
+
+    def class_dump(self, offset, class_id, super_id, instance_size, statics,
+                   fields):
+        self.layouts[class_id] = (super_id, [kind for _, kind in fields])
+        self.class_refs[class_id] = [super_id] + [
+            value for _, kind, value in statics if kind == hprof.TYPE_OBJECT]
+
+
+def _build_dominator_tree(index):
+    visitor = _GraphVisitor()
+    with open(index.path, 'rb') as src:
+        hprof.walk(src, visitor)
+
+    ids = array(_ID)
+    classes = array(_ID)
+    kinds = array('b')
+    shallow = array(_LONG)
+    for record in index.records():
+        ids.append(record.object_id)
+        classes.append(record.class_id)
+        kinds.append(record.kind)
+        # The size of class records is the one of their instances.
+        shallow.append(0 if record.kind == heapindex.CLASS else record.size)
+    count = len(ids)
+    root = count
+
+    # Outgoing references, as a compressed sparse row matrix: the targets
+    # of object i are targets[starts[i]:starts[i + 1]]. Node count stands
+    # for the GC roots.
+    starts = array(_LONG, [0])
+    targets = array('i')
+    id_size = index.id_size
+    id_format = '>I' if id_size == 4 else '>Q'
+    ref_offsets = _ref_offsets(visitor.layouts, id_size)
+
+    def add(object_ids):
+        for object_id in object_ids:
+            if object_id:
+                j = bisect_left(ids, object_id)
+                if j < count and ids[j] == object_id:
+                    targets.append(j)
+
+    for record in index.records():
+        kind = record.kind
+        if kind == heapindex.INSTANCE:
+            offsets = ref_offsets(record.class_id)
+            if offsets:
+                data = index.data(record)
+                add([struct.unpack_from(id_format, data, offset)[0]
+                     for offset in offsets])
+        elif kind == heapindex.OBJECT_ARRAY:
+            data = index.data(record)
+            add(struct.unpack('>%d%s' % (len(data) // id_size, id_format[1]),
+                              data))
+        elif kind == heapindex.CLASS:
+            add(visitor.class_refs.get(record.object_id, ()))
+        starts.append(len(targets))
+    # Classes stay alive as long as their class loaders, which are treated
+    # as GC roots.
+    add(visitor.roots)
+    add(ids[i] for i in range(count) if kinds[i] == heapindex.CLASS)
+    starts.append(len(targets))
+
+    idom, vertex = _dominators(starts, targets, root)
+
+    retained = array(_LONG, [0]) * len(vertex)
+    for k in range(1, len(vertex)):
+        retained[k] = shallow[vertex[k]]
+    for k in range(len(vertex) - 1, 0, -1):
+        retained[idom[k]] += retained[k]
+
+    node_retained = array(_LONG, [0]) * count
+    node_idom = array('i', [-1]) * count
+    for k in range(1, len(vertex)):
+        v = vertex[k]
+        node_retained[v] = retained[k]
+        node_idom[v] = vertex[idom[k]]
+    return DominatorTree(ids, classes, kinds, shallow, node_retained,
+                         node_idom, dict(index.class_names()))
+
+
+def _ref_offsets(layouts, id_size):
+    # Returns a function of a class id to the offsets of the references in
+    # the data of its instances. Instance data holds the fields of the class
+    # first, then the ones of its super classes.
+    sizes = dict(hprof.TYPE_SIZES)
+    sizes[hprof.TYPE_OBJECT] = id_size
+    cache = {}
+
+    def ref_offsets(class_id):
+        offsets = cache.get(class_id)
+        if offsets is None:
+            offsets = []
+            pos = 0
+            current = class_id
+            seen = set()
+            while current in layouts and current not in seen:
+                seen.add(current)
+                super_id, kinds = layouts[current]
+                for kind in kinds:
+                    if kind == hprof.TYPE_OBJECT:
+                        offsets.append(pos)
+                    pos += sizes.get(kind, 0)
+                current = super_id
+            offsets = cache[class_id] = tuple(offsets)
+        return offsets
+
+    return ref_offsets
+
+
+def _dominators(starts, targets, root):
+    # Lengauer-Tarjan, on a graph in compressed sparse row form. Returns the
+    # (idom, vertex) tuple of arrays: vertex maps depth-first numbers to
+    # nodes, idom the number of a node to the number of its immediate
+    # dominator. Nodes unreachable from root are not numbered.
+    n = len(starts) - 1
+
+    # Iterative depth-first search, numbering nodes in preorder.
+    number = array('i', [-1]) * n
+    vertex = array('i', [root])
+    parent = array('i', [-1])
+    number[root] = 0
+    stack = array('i', [root])
+    edges = array(_LONG, [starts[root]])
+    while stack:
+        v = stack[-1]
+        e = edges[-1]
+        if e < starts[v + 1]:
+            edges[-1] = e + 1
+            w = targets[e]
+            if number[w] < 0:
+                number[w] = len(vertex)
+                parent.append(number[v])
+                vertex.append(w)
+                stack.append(w)
+                edges.append(starts[w])
+        else:
+            stack.pop()
+            edges.pop()
+    reached = len(vertex)
+
+    # Predecessors of each number, in compressed sparse row form.
+    pred_starts = array(_LONG, [0]) * (reached + 1)
+    for k in range(reached):
+        v = vertex[k]
+        for e in range(starts[v], starts[v + 1]):
+            pred_starts[number[targets[e]] + 1] += 1
+    for k in range(reached):
+        pred_starts[k + 1] += pred_starts[k]
+    preds = array('i', [0]) * pred_starts[reached]
+    fill = array(_LONG, pred_starts[:reached])
+    for k in range(reached):
+        v = vertex[k]
+        for e in range(starts[v], starts[v + 1]):
+            w = number[targets[e]]
+            preds[fill[w]] = k
+            fill[w] += 1
+    del fill
+
+    semi = array('i', range(reached))
+    label = array('i', range(reached))
+    ancestor = array('i', [-1]) * reached
+    idom = array('i', [0]) * reached
+    bucket = array('i', [-1]) * reached
+    bucket_next = array('i', [-1]) * reached
+    path = []
+
+    def evaluate(v):
+        # Returns the ancestor of v with the smallest semidominator,
+        # compressing the path to it.
+        if ancestor[v] < 0:
+            return v
+        a = v
+        while ancestor[ancestor[a]] >= 0:
+            path.append(a)
+            a = ancestor[a]
+        while path:
+            x = path.pop()
+            a = ancestor[x]
+            if semi[label[a]] < semi[label[x]]:
+                label[x] = label[a]
+            ancestor[x] = ancestor[a]
+        return label[v]
+
+    for w in range(reached - 1, 0, -1):
+        for e in range(pred_starts[w], pred_starts[w + 1]):
+            u = evaluate(preds[e])
+            if semi[u] < semi[w]:
+                semi[w] = semi[u]
+        s = semi[w]
+        bucket_next[w] = bucket[s]
+        bucket[s] = w
+        p = parent[w]
+        ancestor[w] = p
+        v = bucket[p]
+        while v >= 0:
+            u = evaluate(v)
+            idom[v] = u if semi[u] < semi[v] else p
+            v = bucket_next[v]
+        bucket[p] = -1
+    for w in range(1, reached):
+        if idom[w] != semi[w]:
+            idom[w] = idom[idom[w]]
+    return idom, vertex
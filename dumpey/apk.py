@@ -0,0 +1,194 @@
+"""
+Identification of local APK files.
+
+identify() reads the package name, version code and split name from the
+binary AndroidManifest.xml of an APK and hashes its content, without aapt or
+any other SDK tool.
+"""
+
+import collections
+import hashlib
+import zipfile
+import struct
+
+# Local APK identity. Digests are hex strings, split is the split name of
+# split APKs, None for base APKs.
+ApkInfo = collections.namedtuple('ApkInfo',
+                                 'package version_code sha256 md5 split')
+
+# Binary XML chunk types
+_RES_XML_TYPE = 0x0003
+_RES_STRING_POOL_TYPE = 0x0001
+_RES_XML_RESOURCE_MAP_TYPE = 0x0180
+_RES_XML_START_ELEMENT_TYPE = 0x0102
+
+# String pool flag of UTF-8 strings, UTF-16 otherwise
+_UTF8_FLAG = 1 << 8
+
+# Typed value data types
+_TYPE_STRING = 0x03
+_TYPE_INT_DEC = 0x10
+_TYPE_INT_HEX = 0x11
+
+# Resource ids of the manifest attributes read, for APKs whose attribute
+# names are stripped
+_ATTR_VERSION_CODE = 0x0101021b
+_ATTR_VERSION_CODE_MAJOR = 0x01010576
+
+_NO_INDEX = 0xffffffff
+
+_CHUNK = struct.Struct('<HHI')
+_STRING_POOL = struct.Struct('<IIIII')
+_START_ELEMENT = struct.Struct('<IIHHH')
+_ATTRIBUTE = struct.Struct('<IIIHBBI')
+
+# Bytes hashed at once
+_HASH_BLOCK = 1 << 20
+
+
+class ApkError(Exception):
+    """Raised when a file is not an APK, or its manifest is malformed."""
+
+
+def identify(path):
+    """
+    Return the ApkInfo of a local APK file.
+
+    Args:
+        path: local file path as string.
+    Raises:
+        ApkError: if the file is not an APK, or its manifest is malformed.
+    """
+    package, version_code, split = read_manifest(path)
+    sha256, md5 = digests(path)
+    return ApkInfo(package, version_code, sha256, md5, split)
+
+
+def digests(path):
+    """
+    Return the (SHA-256, MD5) hex digests tuple of a local file.
+
+    Args:
+        path: local file path as string.
+    """
+    sha256 = hashlib.sha256()
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(_HASH_BLOCK)
+            if not block:
+                break
+            sha256.update(block)
+            md5.update(block)
+    return sha256.hexdigest(), md5.hexdigest()
+
+
+def read_manifest(path):
+    """
+    Return the (package name, version code, split name) tuple of a local
+    APK file. The split name is None for base APKs.
+
+    Args:
+        path: local file path as string.
+    Raises:
+        ApkError: if the file is not an APK, or its manifest is malformed.
+    """
+    try:
+        with zipfile.ZipFile(path) as apk:
+            data = apk.read('AndroidManifest.xml')
+    except (zipfile.BadZipfile, KeyError, IOError) as e:
+        raise ApkError('%s is not an APK: %s' % (path, e))
+    try:
+        return _parse_manifest(data)
+    except (struct.error, IndexError, ValueError) as e:
+        raise ApkError('malformed manifest in %s: %s' % (path, e))
+
+
+def _parse_manifest(data):
+    # Reads the package, version code and split attributes of the first
+    # element, the manifest element.
+    kind, header_size, _ = _CHUNK.unpack_from(data, 0)
+    if kind != _RES_XML_TYPE:
+        raise ApkError('not a binary XML manifest')
+    strings = []
+    resource_ids = []
+    pos = header_size
+    while pos < len(data):
+        kind, header_size, size = _CHUNK.unpack_from(data, pos)
+        if size < _CHUNK.size:
+            raise ApkError('bad chunk size %d at %d' % (size, pos))
+        if kind == _RES_STRING_POOL_TYPE:
+            strings = _read_string_pool(data, pos)
+        elif kind == _RES_XML_RESOURCE_MAP_TYPE:
+            count = (size - header_size) // 4
+            resource_ids = struct.unpack_from('<%dI' % count, data,
+                                              pos + header_size)
+        elif kind == _RES_XML_START_ELEMENT_TYPE:
+            return _read_manifest_element(data, pos + header_size, strings,
+                                          resource_ids)
+        pos += size
+    raise ApkError('no manifest element')
+
+
+def _read_manifest_element(data, pos, strings, resource_ids):
+    _, _, start, attr_size, count = _START_ELEMENT.unpack_from(data, pos)
+    package = version_code = split = None
+    major = 0
+    for i in range(count):
+        (_, attr_name, raw_value, _, _, data_type,
+         value) = _ATTRIBUTE.unpack_from(data, pos + start + i * attr_size)
+        key = strings[attr_name] if attr_name != _NO_INDEX else None
+        res_id = (resource_ids[attr_name]
+                  if attr_name < len(resource_ids) else None)
+        if data_type == _TYPE_STRING or raw_value != _NO_INDEX:
+            value = strings[raw_value if raw_value != _NO_INDEX else value]
+        elif data_type not in (_TYPE_INT_DEC, _TYPE_INT_HEX):
+            continue
+        if key == 'package' and res_id is None:
+            package = value
+        elif key == 'split' and res_id is None:
+            split = value or None
+        elif res_id == _ATTR_VERSION_CODE or key == 'versionCode':
+            version_code = int(value)
+        elif res_id == _ATTR_VERSION_CODE_MAJOR or key == 'versionCodeMajor':
+            major = int(value)
+    if package is None or version_code is None:
+        raise ApkError('manifest has no package name or version code')
+    return package, (major << 32) | version_code, split
+
+
+def _read_string_pool(data, pos):
+    _, header_size, _ = _CHUNK.unpack_from(data, pos)
+    count, _, flags, strings_start, _ = _STRING_POOL.unpack_from(
+        data, pos + _CHUNK.size)
+    offsets = struct.unpack_from('<%dI' % count, data, pos + header_size)
+    base = pos + strings_start
+    utf8 = flags & _UTF8_FLAG
+    return [_read_utf8(data, base + o) if utf8 else _read_utf16(data, base + o)
+            for o in offsets]
+
+
+def _read_utf8(data, pos):
+    # Skips the length in UTF-16 units, then reads the length in bytes.
+    _, pos = _read_length8(data, pos)
+    length, pos = _read_length8(data, pos)
+    return data[pos:pos + length].decode('utf-8', 'replace')
+
+
+def _read_length8(data, pos):
+    length = struct.unpack_from('<B', data, pos)[0]
+    if length & 0x80:
+        length = ((length & 0x7f) << 8) | struct.unpack_from('<B', data,
+                                                             pos + 1)[0]
+        return length, pos + 2
+    return length, pos + 1
+
+
+def _read_utf16(data, pos):
+    length = struct.unpack_from('<H', data, pos)[0]
+    pos += 2
+    if length & 0x8000:
+        length = (((length & 0x7fff) << 16) |
+                  struct.unpack_from('<H', data, pos)[0])
+        pos += 2
+    return data[pos:pos + 2 * length].decode('utf-16-le', 'replace')
@@ -0,0 +1,210 @@
+"""
+Content-addressed store of APKs pulled from devices.
+
+Every APK is kept once, named after its SHA-256 digest, however many
+devices it was pulled from. The store index lists the package name, version
+code, size and digests of each stored APK, so the APK installed on a device
+can be looked up by the digest computed on the device, or by its size and
+version code if the device can't hash files, and downloaded only if the
+store doesn't have it yet.
+
+Each pull is recorded in the store manifest, a line per device and APK.
+"""
+
+import collections
+import threading
+import tempfile
+import time
+import os
+
+from . import apk
+
+# A stored APK. Digests are lowercase hex strings.
+StoreEntry = collections.namedtuple('StoreEntry',
+                                    'package version_code size sha256 md5')
+
+# A pulled APK, as recorded in the manifest.
+ManifestEntry = collections.namedtuple(
+    'ManifestEntry', 'time device package version_code remote_path sha256')
+
+_INDEX = 'index.txt'
+_MANIFEST = 'manifest.txt'
+_OBJECTS = 'objects'
+_TMP = 'tmp'
+
+# Hex digest lengths
+_SHA256_LENGTH = 64
+_MD5_LENGTH = 32
+
+
+class ApkStore(object):
+    """
+    A content-addressed APK store in a local directory, created if needed.
+    Safe to use from multiple threads.
+
+    Args:
+        root: local directory path as string.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        self._lock = threading.Lock()
+        self._entries = None
+        for name in (_OBJECTS, _TMP):
+            path = os.path.join(root, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+
+    def entries(self):
+        """Return the list of StoreEntry tuples of the stored APKs."""
+        with self._lock:
+            return list(self._load())
+
+    def find(self, package, version_code, digest=None, size=None):
+        """
+        Return the path of a stored APK, or None if the store has none.
+
+        The APK is matched by digest if one is given, otherwise by size.
+
+        Args:
+            package: package name as string.
+            version_code: int.
+            digest: SHA-256 or MD5 hex digest as string.
+            size: size in bytes as int.
+        """
+        if digest is None and size is None:
+            return None
+        if digest is not None:
+            digest = digest.lower()
+        with self._lock:
+            for entry in self._load():
+                if (entry.package, entry.version_code) != (package,
+                                                           version_code):
+                    continue
+                if digest is not None:
+                    if digest in (entry.sha256, entry.md5):
+                        return self.path(entry.sha256)
+                elif entry.size == size:
+                    return self.path(entry.sha256)
+        return None
+
+    def path(self, sha256):
+        """Return the path of the stored APK with the given SHA-256 digest."""
+        return os.path.join(self.root, _OBJECTS, sha256[:2], sha256 + '.apk')
+
+    def temp_path(self):
+        """
+        Return the path of a new empty file to download an APK to, before it
+        is added to the store.
+        """
+        fd, path = tempfile.mkstemp(suffix='.apk',
+                                    dir=os.path.join(self.root, _TMP))
+        os.close(fd)
+        return path
+
+    def add(self, package, version_code, local_file):
+        """
+        Move a local APK into the store, unless the store has its content
+        already, in which case the file is removed.
+
+        Args:
+            package: package name as string.
+            version_code: int.
+            local_file: local path as string, e.g. from temp_path().
+        Returns:
+            the path of the stored APK.
+        """
+        sha256, md5 = apk.digests(local_file)
+        size = os.path.getsize(local_file)
+        stored = self.path(sha256)
+        entry = StoreEntry(package, version_code, size, sha256, md5)
+        with self._lock:
+            entries = self._load()
+            if os.path.exists(stored):
+                os.remove(local_file)
+            else:
+                directory = os.path.dirname(stored)
+                if not os.path.isdir(directory):
+                    os.makedirs(directory)
+                os.rename(local_file, stored)
+            if entry not in entries:
+                entries.append(entry)
+                with open(os.path.join(self.root, _INDEX), 'a') as f:
+                    f.write(_line(entry))
+        return stored
+
+    def record(self, device, package, version_code, remote_path, stored):
+        """
+        Append a line to the manifest, recording that a device has a stored
+        APK installed.
+
+        Args:
+            device: device serial as string.
+            package: package name as string.
+            version_code: int.
+            remote_path: path of the APK on the device, as string.
+            stored: path of the stored APK as string.
+        """
+        sha256 = os.path.basename(stored)[:-len('.apk')]
+        entry = ManifestEntry(time.strftime('%Y-%m-%dT%H:%M:%S'), device,
+                              package, version_code, remote_path, sha256)
+        with self._lock:
+            with open(os.path.join(self.root, _MANIFEST), 'a') as f:
+                f.write(_line(entry))
+
+    def manifest(self):
+        """Return the list of ManifestEntry tuples, oldest first."""
+        path = os.path.join(self.root, _MANIFEST)
+        with self._lock:
+            if not os.path.exists(path):
+                return []
+            with open(path) as f:
+                return [ManifestEntry(*_fields(line, 3)) for line in f
+                        if line.strip()]
+
+    def _load(self):
+        # Reads the index once, the caller holds the lock.
+        if self._entries is None:
+            entries = []
+            path = os.path.join(self.root, _INDEX)
+            if os.path.exists(path):
+                with open(path) as f:
+                    for line in f:
+                        if line.strip():
+                            fields = _fields(line, 1)
+                            fields[2] = int(fields[2])
+                            entries.append(StoreEntry(*fields))
+            self._entries = entries
+        return self._entries
+
+
+def link(stored, local_file):
+    """
+    Hard-link a stored APK to a local path, replacing any file there.
+
+    Args:
+        stored: path of the stored APK as string.
+        local_file: local path as string.
+    Returns:
+        True if the link was made, False if the file system doesn't support
+        hard links, or the paths are on different file systems.
+    """
+    try:
+        if os.path.exists(local_file):
+            if os.path.samefile(stored, local_file):
+                return True
+            os.remove(local_file)
+        os.link(stored, local_file)
+        return True
+    except (AttributeError, OSError):
+        return False
+
+
+def _line(entry):
+    return '\t'.join(str(value) for value in entry) + '\n'
+
+
+def _fields(line, version_code_index):
+    fields = line.rstrip('\n').split('\t')
+    fields[version_code_index] = int(fields[version_code_index])
+    return fields
@@ -0,0 +1,132 @@
+"""
+Streaming compression of the files Dumpey writes.
+
+open_write() returns a file object that compresses bytes as they are
+written, open_read() one that decompresses them as they are read, telling
+the codec by the file's magic bytes. gzip is always available, zstd and lz4
+need the zstandard and lz4 packages.
+"""
+
+import gzip
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+GZIP = 'gzip'
+ZSTD = 'zstd'
+LZ4 = 'lz4'
+
+CODECS = (GZIP, ZSTD, LZ4)
+
+# File name extension for each codec
+EXTENSIONS = {GZIP: '.gz', ZSTD: '.zst', LZ4: '.lz4'}
+
+# Leading bytes of the files each codec writes
+_MAGIC = {
+    GZIP: b'\x1f\x8b',
+    ZSTD: b'\x28\xb5\x2f\xfd',
+    LZ4: b'\x04\x22\x4d\x18',
+}
+
+
+def available(codec):
+    """
+    Return True if a codec can be used.
+
+    Args:
+        codec: one of CODECS.
+    """
+    if codec == ZSTD:
+        return zstandard is not None
+    if codec == LZ4:
+        return lz4 is not None
+    return codec == GZIP
+
+
+def filename(path, codec):
+    """
+    Return path with the extension of a codec appended, or path itself if
+    codec is None.
+    """
+    return path + EXTENSIONS[codec] if codec else path
+
+
+def detect(path):
+    """
+    Return the codec a file is compressed with, telling it by the file's
+    magic bytes, or None if the file is not compressed.
+
+    Args:
+        path: local file path as string.
+    """
+    with open(path, 'rb') as f:
+        head = f.read(4)
+    for codec in CODECS:
+        if head.startswith(_MAGIC[codec]):
+            return codec
+    return None
+
+
+def open_write(path, codec=None):
+    """
+    Open a file for writing, compressing its content on the fly.
+
+    Args:
+        path: local file path as string.
+        codec: one of CODECS, or None to write the file as it is.
+    Returns:
+        a binary file object.
+    Raises:
+        Exception: if the codec is unknown or not available.
+    """
+    _ensure_available(codec)
+    if codec is None:
+        return open(path, 'wb')
+    if codec == GZIP:
+        return gzip.open(path, 'wb', 6)
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor().stream_writer(open(path, 'wb'))
+    return lz4.frame.open(path, 'wb')
+
+
+def open_read(path):
+    """
+    Open a file written by open_write for reading, decompressing it on the
+    fly if needed.
+
+    Args:
+        path: local file path as string.
+    Returns:
+        a binary file object.
+    Raises:
+        Exception: if the file is compressed with a codec that is not
+                   available.
+    """
+    codec = detect(path)
+    _ensure_available(codec)
+    if codec is None:
+        return open(path, 'rb')
+    if codec == GZIP:
+        return gzip.open(path, 'rb')
+    if codec == ZSTD:
+        return zstandard.ZstdDecompressor().stream_reader(open(path, 'rb'))
+    return lz4.frame.open(path, 'rb')
+
+
+def _ensure_available(codec):
+    if codec is None:
+        return
+    if codec not in CODECS:
+        raise Exception("unknown codec '%s', use one of %s"
+                        % (codec, ', '.join(CODECS)))
+    if not available(codec):
+        package = 'zstandard' if codec == ZSTD else codec
+        raise Exception("%s compression needs the %s package"
+                        % (codec, package))
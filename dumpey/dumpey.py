@@ -14,31 +14,59 @@ on all attached devices, or just the ones you specify.
 
 __version__ = '0.8.3'
 
+from multiprocessing.pool import ThreadPool
 import subprocess
+import threading
+import tempfile
 import argparse
+import shutil
 import random
 import time
 import sys
 import re
 import os
 
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+from . import adbclient
+from . import analysis
+from . import apk
+from . import apkstore
+from . import compress
+from . import hprof
+from . import instrument
+from . import meminfo
+from . import plan
+from . import registry
+
 
 def adb(args, device=None, decor=None):
     """
     Execute an adb command.
 
+    If the native transport is enabled, shell and device list commands are
+    sent to the adb server socket directly. Anything else, or any command
+    while the server is unreachable, runs through the adb executable.
+
     Args:
         args: command as list.
         device: device serial as string.
         decor: function to process command output. Invoked with one param.
     Returns:
-        the command output, altered by the decor function, if given.
+        the command output as string, or as bytes for exec-out commands,
+        altered by the decor function, if given.
     Raises:
         Exception: if the command return code is not 0.
     """
-    head = ['adb', '-s', device] if device else ['adb']
-    command = head + args
-    output = _cmd(command)
+    output = _native_adb(args, device) if _adb_client else None
+    if output is None:
+        head = ['adb', '-s', device] if device else ['adb']
+        command = head + args
+        # exec-out passes binary output, such as screenshots, unchanged.
+        output = _cmd(command, binary=args[:1] == ['exec-out'])
     return decor(output) if decor else output
 
 
@@ -53,7 +81,7 @@ def api_version(device, decor=None):
         the version number as a string, altered by the decor function,
         if given.
     """
-    version = adb(['shell', 'getprop', 'ro.build.version.sdk'], device).strip()
+    version = device_info(device).get('ro.build.version.sdk', '').strip()
     return decor(version) if decor else version
 
 
@@ -61,18 +89,24 @@ def attached_devices():
     """
     Return a list of currently attached devices.
 
+    If watch_devices is enabled, the devices are read from its registry.
+
     Raises:
         Exception: if there are no devices in "device" state.
     """
-    raw_list = adb(['devices'], decor=_decor_split)[1:]
-    delimiter = "\tdevice"
-    devices = [d.split(delimiter)[0] for d in raw_list if delimiter in d]
+    if _registry is not None:
+        devices = _registry.devices()
+    else:
+        raw_list = adb(['devices'], decor=_decor_split)[1:]
+        delimiter = "\tdevice"
+        devices = [d.split(delimiter)[0] for d in raw_list if delimiter in d]
     if not devices:
         raise Exception("no devices in 'device' state")
     return devices
 
 
-def clear_data(package=None, regex=None, devices=None, force=False):
+def clear_data(package=None, regex=None, devices=None, force=False,
+               max_workers=None):
     """
     Stop and clear all data associated with a given package or the one found
     by regex. If regex matches multiple packages and force is True, data for
@@ -83,21 +117,43 @@ def clear_data(package=None, regex=None, devices=None, force=False):
         regex: string.
         devices: list of device serials.
         force: boolean.
+        max_workers: max number of devices handled at once, as int.
     Raises:
         Exception: if neither package nor regex is given.
+        DeviceError: if the command fails on any of the devices.
     """
     _ensure_package_or_regex_given(package, regex)
     if devices is None:
         devices = attached_devices()
     if package is not None:
-        for device in devices:
-            _clear_data(package, device)
+        _fan_out(lambda d: _clear_data(package, d), devices, max_workers)
     else:
-        _package_iter(regex, devices, _clear_data, force)
+        _package_iter(regex, devices, _clear_data, force,
+                      max_workers=max_workers)
+
+
+def device_info(device, refresh=False):
+    """
+    Return the DeviceInfo of a given device.
+
+    Device properties are loaded once and cached until the device is
+    rebooted by Dumpey. If refresh is True, they are loaded again.
+
+    Args:
+        device: device serial as string.
+        refresh: boolean.
+    """
+    with _device_info_lock:
+        info = _device_info.get(device)
+    if info is None or refresh:
+        info = DeviceInfo.load(device)
+        with _device_info_lock:
+            _device_info[device] = info
+    return info
 
 
 def dump_heap(package=None, regex=None, devices=None, local_dir=None,
-              force=False):
+              force=False, max_workers=None, codec=None):
     """
     Create a converted heap dump for a given package or regex and download
     it to a local_dir. If local_dir is not given, the current working directory
@@ -106,14 +162,19 @@ def dump_heap(package=None, regex=None, devices=None, local_dir=None,
     If regex matches multiple packages and force is True, heap dumps will be
     made for each subsequent package.
 
+    If codec is given, the heap dump is compressed while it is downloaded.
+
     Args:
         package: package name as string.
         regex: string.
         devices: list of device serials.
         local_dir: local directory path as string.
         force: boolean.
+        max_workers: max number of devices handled at once, as int.
+        codec: one of 'gzip', 'zstd' or 'lz4'.
     Raises:
         Exception: if neither package nor regex is given.
+        DeviceError: if the command fails on any of the devices.
     """
     _ensure_package_or_regex_given(package, regex)
     if devices is None:
@@ -121,10 +182,11 @@ def dump_heap(package=None, regex=None, devices=None, local_dir=None,
     if local_dir is None:
         local_dir = os.getcwd()
     if package is not None:
-        for device in devices:
-            _dump_heap(package, device, local_dir)
+        _fan_out(lambda d: _dump_heap(package, d, local_dir, None, codec),
+                 devices, max_workers)
     else:
-        _package_iter(regex, devices, _dump_heap, force, local_dir)
+        _package_iter(regex, devices, _dump_heap, force, local_dir, None,
+                      codec, max_workers=max_workers)
 
 
 def file_size(remote_path, device):
@@ -143,20 +205,44 @@ def file_size(remote_path, device):
     return _split_whitespace(out)[3]
 
 
-def install(local_path=None, devices=None, recursive=False):
+def install(local_path=None, devices=None, recursive=False, max_workers=None,
+            reinstall=False, hub_workers=None, bandwidth=None):
     """
     Install apk on given devices.
 
     If local path is a directory, it browses and installs any file ending
     with '.apk'. If recursive is True, each subdirectory it encounters is also
-    checked.
+    checked. A base APK and the split APKs of the same package and version
+    in its directory are installed together, other APKs one by one.
+
+    An APK is skipped on devices that already have the same package,
+    version code and content installed, unless reinstall is True.
+
+    Devices on the same USB hub share its bandwidth. hub_workers limits
+    the installs running at once on the devices of each hub, and bandwidth
+    the bytes per second sent to them. Devices whose hub is unknown count
+    as one hub. bandwidth can only be kept to on devices with API 24 or
+    higher, while the adb server is reachable, since the APKs are streamed
+    to them in paced chunks. Other devices are sent APKs as fast as adb
+    install goes, with a warning.
 
     Args:
         local_path: path to a local file or directory as string.
         devices: device serial as string.
         recursive: boolean.
+        max_workers: max number of devices handled at once, as int.
+        reinstall: boolean.
+        hub_workers: max number of installs at once per USB hub, as int.
+        bandwidth: max bytes per second sent per USB hub, as number, on
+                   devices with API 24 or higher.
+    Returns:
+        a dict of local APK paths installed, skipped and failed on each
+        device, e.g.:
+        {'device_1': {'installed': ['a.apk'], 'skipped': ['b.apk'],
+                      'failed': []}}
     Raises:
         Exception: if the local path does not exist.
+        DeviceError: if the command fails on any of the devices.
     """
     if local_path is None:
         local_path = os.getcwd()
@@ -165,9 +251,72 @@ def install(local_path=None, devices=None, recursive=False):
     if devices is None:
         devices = attached_devices()
     if os.path.isdir(local_path):
-        _install_from_dir(local_path, devices, recursive)
+        local_files = _apk_files(local_path, recursive)
     else:
-        _install_from_file(local_path, devices)
+        local_files = [local_path]
+    return _install_from_files(local_files, devices, max_workers, reinstall,
+                               hub_workers, bandwidth)
+
+
+def invalidate_device_info(devices=None):
+    """
+    Forget the cached device properties, so that they are loaded again on
+    next use.
+
+    Args:
+        devices: list of device serials, or None for all devices.
+    """
+    with _device_info_lock:
+        if devices is None:
+            _device_info.clear()
+        else:
+            for device in devices:
+                _device_info.pop(device, None)
+
+
+def invalidate_packages(devices=None):
+    """
+    Forget the cached package lists, so that they are listed again on next
+    use. Dumpey does this by itself on install, uninstall and reboot, this
+    is needed only for changes made outside of it.
+
+    Args:
+        devices: list of device serials, or None for all devices.
+    """
+    with _package_cache_lock:
+        if devices is None:
+            _package_cache.clear()
+        else:
+            for device in devices:
+                _package_cache.pop(device, None)
+
+
+def memory_usage(devices=None, regex=None, max_workers=None, refresh=False):
+    """
+    Return the memory use of the running packages on given devices, from
+    dumpsys meminfo. The packages of each device are queried in a single
+    batched shell session, devices in parallel.
+
+    Args:
+        devices: list of device serials.
+        regex: string, packages matching it are queried, all if None.
+        max_workers: max number of devices handled at once, as int.
+        refresh: boolean, list the packages again instead of using the
+                 cache, see package_list.
+    Returns:
+        a dict of device serials to dicts of package names to samples, as
+        returned by meminfo.parse, e.g.:
+        {'device_1': {'package_1': {'pss': 20000, 'java_heap': 3100,
+                                    'native_heap': 4900, 'graphics': 7000}}}
+        Packages that are not running are left out.
+    Raises:
+        DeviceError: if the memory use cannot be read on any of the devices.
+    """
+    if devices is None:
+        devices = attached_devices()
+    compiled_regex = re.compile(regex) if regex else None
+    return _fan_out(lambda d: _memory_usage(d, compiled_regex, refresh),
+                    devices, max_workers)
 
 
 # Default number of monkey events
@@ -180,10 +329,16 @@ _MONKEY_SEED_MAX = 100000
 
 
 def monkey(package=None, regex=None, devices=None, seed=None, events=None,
-           before=None, after=None, log=True, force=False):
+           before=None, after=None, log=True, force=False, max_workers=None,
+           meminfo_interval=None, local_dir=None, meminfo_format='csv'):
     """
     Run the monkey stress test.
 
+    If meminfo_interval is given, the memory use of the package is sampled
+    from dumpsys meminfo at that interval while the monkey runs, and the
+    samples are written to a <device>_<package>_meminfo file in local_dir,
+    or the current working directory if local_dir is not given.
+
     Args:
         package: package name as string.
         regex: string.
@@ -197,8 +352,14 @@ def monkey(package=None, regex=None, devices=None, seed=None, events=None,
                ends. Receives two arguments: package name
                and device serial.
         log: boolean.
+        force: boolean.
+        max_workers: max number of devices handled at once, as int.
+        meminfo_interval: seconds between memory samples, as float.
+        local_dir: local directory of the memory samples, as string.
+        meminfo_format: memory samples file format, 'csv' or 'ndjson'.
     Raises:
         Exception: if neither package nor regex is given.
+        DeviceError: if the command fails on any of the devices.
     """
     _ensure_package_or_regex_given(package, regex)
     if devices is None:
@@ -207,31 +368,44 @@ def monkey(package=None, regex=None, devices=None, seed=None, events=None,
         seed = random.randint(_MONKEY_SEED_MIN, _MONKEY_SEED_MAX)
     if events is None:
         events = _MONKEY_EVENTS
+    sampling = None
+    if meminfo_interval:
+        sampler = meminfo.Sampler(
+            lambda p, d: adb(['shell', 'dumpsys', 'meminfo', p], d),
+            meminfo_interval)
+        sampling = (sampler, local_dir or os.getcwd(), meminfo_format)
     if package is not None:
-        for device in devices:
-            _monkey(package, device, seed, events, before, after, log)
+        _fan_out(lambda d: _monkey(package, d, seed, events, before, after,
+                                   log, sampling), devices, max_workers)
     else:
         _package_iter(regex, devices, _monkey, force, seed, events, before,
-                      after, log)
+                      after, log, sampling, max_workers=max_workers)
 
 
-def package_list(devices=None, regex=None):
+def package_list(devices=None, regex=None, max_workers=None, refresh=False):
     """
     Return a dict of installed packages on given devices, filtered by
     the regex.
 
+    Package lists are cached per device for a short while, see
+    invalidate_packages. If refresh is True, they are listed again.
+
     Args:
         devices: list of device serials.
         regex: string.
+        max_workers: max number of devices handled at once, as int.
+        refresh: boolean.
     Returns:
         a dict of installed packages on each device, e.g.:
         {'device_1': ['package_1'], 'device_2': ['package_1', 'package_2']}
+    Raises:
+        DeviceError: if the packages cannot be listed on any of the devices.
     """
     if devices is None:
         devices = attached_devices()
     compiled_regex = re.compile(regex) if regex else None
-    return {device: _package_list(device, compiled_regex)
-            for device in devices}
+    return _fan_out(lambda d: _package_list(d, compiled_regex, refresh),
+                    devices, max_workers)
 
 
 def pid(package, device, force_open=True):
@@ -249,8 +423,7 @@ def pid(package, device, force_open=True):
         Exception: if force_open cannot open the given package, or if multiple
         PIDs are found.
     """
-    out = adb(['shell', 'ps'], device, _decor_split)
-    processes = [p.strip() for p in out if package in p]
+    processes = pids([package], device)[package]
     if not processes:
         if force_open:
             # The app might be installed, but is not running. Exec the monkey
@@ -260,9 +433,38 @@ def pid(package, device, force_open=True):
         raise Exception('no process on %s found for %s, is your app '
                         'installed?' % (device, package))
     elif len(processes) > 1:
-        raise Exception('multiple processes for %s: %s.' % package,
-                        _to_str(processes))
-    return _split_whitespace(processes[0])[1]
+        raise Exception('multiple processes for %s: %s.'
+                        % (package, _to_str(processes)))
+    return processes[0]
+
+
+# First API level whose toolbox ships pidof
+_PIDOF_MIN_API = 24
+
+
+def pids(packages, device):
+    """
+    Return the process IDs of many packages on a given device at once.
+
+    Devices with pidof resolve every package in one batched shell session,
+    older ones from a single ProcessTable snapshot. Packages are matched by
+    exact process name.
+
+    Args:
+        packages: list of package names.
+        device: device serial as string.
+    Returns:
+        a dict of package names to lists of PIDs as strings, e.g.:
+        {'package_1': ['1234'], 'package_2': []}
+    """
+    if api_version(device, int) >= _PIDOF_MIN_API:
+        with ShellBatch(device) as batch:
+            for package in packages:
+                batch.add(['pidof', package])
+        return {package: output.split() for package, (output, _)
+                in zip(packages, batch.results)}
+    table = ProcessTable.load(device)
+    return {package: table.pids(package) for package in packages}
 
 
 def pull(remote, local, device, show_progress=True):
@@ -282,12 +484,18 @@ def pull(remote, local, device, show_progress=True):
 
 
 def pull_apk(package=None, regex=None, devices=None, local_dir=None,
-             force=False):
+             force=False, max_workers=None, codec=None, store=None):
     """
     Downloads the package apk.
 
     If regex matches multiple packages and force is True, each package apk
-    will be downloaded.
+    will be downloaded. If codec is given, the apk is compressed while it is
+    downloaded. Split apks are downloaded together with their base apk.
+
+    If store is given, apks are kept in the content-addressed apk store in
+    that directory, see apkstore, and only downloaded if the store has no
+    apk of the same package, version code and digest. Each download is
+    recorded in the store manifest, and hard-linked to local_dir if given.
 
     Args:
         package: package name as string.
@@ -295,31 +503,44 @@ def pull_apk(package=None, regex=None, devices=None, local_dir=None,
         devices: list of device serials.
         local_dir: local directory as string.
         force: boolean.
+        max_workers: max number of devices handled at once, as int.
+        codec: one of 'gzip', 'zstd' or 'lz4'.
+        store: local apk store directory as string.
+    Raises:
+        Exception: if both codec and store are given.
+        DeviceError: if the command fails on any of the devices.
     """
     _ensure_package_or_regex_given(package, regex)
+    if codec and store:
+        raise Exception("apks are kept uncompressed in a store, codec and "
+                        "store can't be used together")
     if devices is None:
         devices = attached_devices()
-    if local_dir is None:
+    if store is not None:
+        store = apkstore.ApkStore(store)
+    elif local_dir is None:
         local_dir = os.getcwd()
     if package is not None:
-        for device in devices:
-            _pull_apk(package, device, local_dir)
+        _fan_out(lambda d: _pull_apk(package, d, local_dir, codec, store),
+                 devices, max_workers)
     else:
-        _package_iter(regex, devices, _pull_apk, force, local_dir)
+        _package_iter(regex, devices, _pull_apk, force, local_dir, codec,
+                      store, max_workers=max_workers)
 
 
-def reboot(devices):
+def reboot(devices=None, max_workers=None):
     """
     Reboot the devices.
 
     Args:
         devices: list of device serials.
+        max_workers: max number of devices handled at once, as int.
+    Raises:
+        DeviceError: if any of the devices fails to reboot.
     """
     if devices is None:
         devices = attached_devices()
-    for device in devices:
-        adb(["reboot"], device)
-        _inform("%s rebooted", device)
+    _fan_out(_reboot, devices, max_workers)
 
 
 def remove_file(remote_path, device):
@@ -333,38 +554,63 @@ def remove_file(remote_path, device):
     adb(['shell', 'rm', '-f', remote_path], device)
 
 
-def snapshots(device=None, local_dir=None, multiple=False):
+def snapshots(device=None, local_dir=None, multiple=False, codec=None,
+              interval=None, count=None, devices=None, max_workers=None):
     """
     Take a snapshot of the current screen.
 
     If multiple is True, a new snapshot is taken each time ENTER is
     pressed. Snapshot is stored to a local_dir, or current working directory
-    if local_dir is not given.
+    if local_dir is not given. If codec is given, it is stored compressed.
+
+    If interval or count is given, snapshots are taken in a burst instead:
+    count snapshots, one every interval seconds, on each device at once.
+    Without count, the burst goes on until interrupted with Ctrl+C. Files
+    are written by a thread of their own, so that captures are not held up
+    by the disk.
 
     Args:
         device: device serial as string.
         local_dir: local directory as string.
         multiple: boolean.
+        codec: one of 'gzip', 'zstd' or 'lz4'.
+        interval: seconds between burst snapshots, as float, 0 for as fast
+                  as a device allows.
+        count: number of burst snapshots per device, as int.
+        devices: list of device serials for bursts, used instead of device.
+                 Defaults to all attached devices.
+        max_workers: max number of devices captured at once in a burst, as
+                     int. Defaults to all of them.
+    Returns:
+        for bursts, a dict of device serials to the number of snapshots
+        taken.
     Raises:
         Exception: if no device is given and there is more than one
-                   attached device.
+                   attached device, outside of bursts.
+        DeviceError: if a burst fails on any of the devices.
     """
+    if local_dir is None:
+        local_dir = os.getcwd()
+    if interval is not None or count is not None:
+        if devices is None:
+            devices = [device] if device else attached_devices()
+        return _burst(devices, local_dir, codec, interval or 0, count,
+                      max_workers)
     if device is None:
         devices = attached_devices()
         if len(devices) > 1:
             raise Exception('specify device serial')
         device = devices[0]
-    if local_dir is None:
-        local_dir = os.getcwd()
     if multiple:
         _inform("press enter to take a snapshot or [any key + enter] to exit")
         while sys.stdin.read(1) == "\n":
-            _screenshot(device, local_dir)
+            _screenshot(device, local_dir, codec)
     else:
-        _screenshot(device, local_dir)
+        _screenshot(device, local_dir, codec)
 
 
-def uninstall(package=None, regex=None, devices=None, force=False):
+def uninstall(package=None, regex=None, devices=None, force=False,
+              max_workers=None):
     """
     Uninstall the package on all given devices.
 
@@ -375,162 +621,1350 @@ def uninstall(package=None, regex=None, devices=None, force=False):
         regex: string.
         devices: list of device serials.
         force: boolean.
+        max_workers: max number of devices handled at once, as int.
+    Raises:
+        DeviceError: if the command fails on any of the devices.
     """
     _ensure_package_or_regex_given(package, regex)
     if devices is None:
         devices = attached_devices()
     if package is not None:
-        for device in devices:
-            _uninstall_package(package, device)
+        _fan_out(lambda d: _uninstall_package(package, d), devices,
+                 max_workers)
     else:
-        _package_iter(regex, devices, _uninstall_package, force)
+        _package_iter(regex, devices, _uninstall_package, force,
+                      max_workers=max_workers)
+
+
+def use_builtin_converter(enabled=True):
+    """
+    Convert heap dumps with the built-in dumpey.hprof converter instead of
+    the SDK hprof-conv tool. The built-in converter is also used whenever
+    hprof-conv is not on the path.
+
+    Args:
+        enabled: boolean.
+    """
+    global _builtin_converter
+    _builtin_converter = enabled
+
+
+# Set by use_native_transport
+_adb_client = None
+
+
+def use_native_transport(enabled=True, host=None, port=None):
+    """
+    Send adb commands straight to the adb server socket, instead of
+    starting an adb process for each of them. The native transport is also
+    enabled if the DUMPEY_ADB_TRANSPORT environment variable is 'native'.
+
+    Args:
+        enabled: boolean.
+        host: adb server host as string, defaults to localhost.
+        port: adb server port as int, defaults to 5037.
+    """
+    global _adb_client
+    _adb_client = adbclient.AdbClient(host, port) if enabled else None
+
+
+if os.environ.get('DUMPEY_ADB_TRANSPORT') == 'native':
+    use_native_transport()
+
+
+# Polling of a file a device is writing: the first and the longest interval
+# between probes, how long the file has to stay unchanged to be considered
+# complete, and how long to wait overall, in seconds. The settle time spans
+# more than the one second resolution of modification times.
+_WAIT_POLL_MIN = 0.02
+_WAIT_POLL_MAX = 1.0
+_WAIT_SETTLE = 1.5
+_WAIT_TIMEOUT = 600
+
+# Probes in a row that have to find a file unchanged for it to be complete
+_WAIT_SETTLE_PROBES = 2
+
+# Seconds an empty or missing file has to stay so, to be considered empty
+_WAIT_EMPTY_SETTLE = 5
+
+
+def wait_for_file(remote_path, device, timeout=None, settle=None):
+    """
+    Wait until a device is done writing a file.
+
+    The file is probed for its size and modification time, starting at
+    short intervals that grow while nothing changes. It is considered
+    complete once it has not changed for settle seconds, over at least two
+    probes after the one that saw it change. A file that stays
+    empty, or is never created, gets a longer grace period before it is
+    reported as empty.
+
+    Args:
+        remote_path: path to a file on a device as string.
+        device: device serial as string.
+        timeout: max number of seconds to wait, as float.
+        settle: number of seconds the file has to stay unchanged, as float.
+    Returns:
+        the file size as int, 0 if the file is empty or does not exist.
+    Raises:
+        Exception: if the file is not complete after timeout seconds.
+    """
+    if timeout is None:
+        timeout = _WAIT_TIMEOUT
+    if settle is None:
+        settle = _WAIT_SETTLE
+    timer = instrument.begin(kind='wait_for_file', device=device)
+    start = changed = time.time()
+    interval = _WAIT_POLL_MIN
+    last = None
+    unchanged = 0
+    while True:
+        time.sleep(interval)
+        now = time.time()
+        probe = _remote_stat(remote_path, device)
+        size = probe[0] if probe else 0
+        if probe != last:
+            last = probe
+            changed = now
+            unchanged = 0
+        else:
+            unchanged += 1
+            if (unchanged >= _WAIT_SETTLE_PROBES and
+                    now - changed >= (settle if size else _WAIT_EMPTY_SETTLE)):
+                if timer is not None:
+                    timer.end()
+                return size
+            interval = min(interval * 2, _WAIT_POLL_MAX)
+        if now - start >= timeout:
+            if timer is not None:
+                timer.end(None)
+            raise Exception('%s on %s not complete after %ds'
+                            % (remote_path, device, timeout))
+
+
+def watch_devices(enabled=True, interval=None):
+    """
+    Keep a registry of the attached devices, updated in the background as
+    the adb server reports devices coming and going. If the server can't be
+    reached, the devices are polled every interval seconds instead.
+
+    attached_devices, and with it every function run on all attached
+    devices, then reads the devices from the registry instead of running
+    adb. Devices that change state have their cached packages and
+    properties forgotten.
+
+    Args:
+        enabled: boolean.
+        interval: seconds between polls, as float.
+    Returns:
+        the registry.DeviceRegistry, to add listeners to, or None if not
+        enabled.
+    """
+    global _registry
+    if _registry is not None:
+        _registry.stop()
+        _registry = None
+    if enabled:
+        client = _adb_client or adbclient.AdbClient()
+        devices = registry.DeviceRegistry(lambda: adb(['devices']),
+                                          client.track_devices, interval)
+        devices.add_listener(_forget_device)
+        devices.start()
+        _registry = devices
+    return _registry
+
+
+class DeviceError(Exception):
+    """
+    Raised when a command fails on one or more devices. The command still
+    runs to completion on every other device.
+
+    Attributes:
+        results: dict of device serials to results, for devices that
+                 succeeded.
+        errors: dict of device serials to exceptions, for devices that
+                failed.
+    """
+
+    def __init__(self, results, errors):
+        failed = _to_str(['%s (%s)' % (d, errors[d]) for d in sorted(errors)])
+        super(DeviceError, self).__init__('failed on %d device(s): %s'
+                                          % (len(errors), failed))
+        self.results = results
+        self.errors = errors
+
+
+class DeviceInfo(object):
+    """
+    System properties of a device, as reported by a bare getprop call.
+
+    Args:
+        device: device serial as string.
+        properties: dict of property names to values.
+    """
+
+    def __init__(self, device, properties):
+        self.device = device
+        self.properties = properties
+
+    @classmethod
+    def load(cls, device):
+        """
+        Load all properties of a device with a single getprop call.
+
+        Args:
+            device: device serial as string.
+        """
+        return cls(device, adb(['shell', 'getprop'], device, _decor_getprop))
+
+    def get(self, name, default=None):
+        """
+        Return the value of a property, or default if it is not set.
+
+        Args:
+            name: property name as string, e.g. 'ro.build.version.sdk'.
+            default: value returned for a missing property.
+        """
+        return self.properties.get(name, default)
+
+    @property
+    def api(self):
+        """The Android SDK version as int."""
+        return int(self.get('ro.build.version.sdk'))
+
+
+class ProcessTable(object):
+    """
+    A snapshot of the processes running on a device, parsed from a single
+    ps call and indexed by exact process name.
+
+    Args:
+        device: device serial as string.
+        processes: dict of process names to lists of PIDs as strings.
+    """
+
+    def __init__(self, device, processes):
+        self.device = device
+        self.processes = processes
+
+    @classmethod
+    def load(cls, device):
+        """
+        Take a snapshot of the processes running on a device.
+
+        Args:
+            device: device serial as string.
+        """
+        # Since Oreo, ps lists only the processes of the current shell,
+        # unless asked for all of them.
+        command = ['shell', 'ps']
+        if api_version(device, int) >= _PS_ALL_MIN_API:
+            command.append('-A')
+        return cls(device, adb(command, device, _decor_ps))
+
+    def pids(self, name):
+        """
+        Return a list of PIDs of processes with the given name.
+
+        Args:
+            name: process name as string, e.g. a package name.
+        """
+        return list(self.processes.get(name, []))
+
+
+class ShellBatch(object):
+    """
+    Queues shell commands for a device and runs them all in a single adb
+    shell session. The output of each command is framed by markers, so it
+    can be told apart from the output of the others.
+
+    Use it as a context manager, the queued commands run when the block
+    exits without an exception:
+
+        with ShellBatch(device) as batch:
+            batch.add(['pm', 'clear', package])
+        output, status = batch.results[0]
+
+    Args:
+        device: device serial as string.
+    """
+
+    def __init__(self, device):
+        self.device = device
+        self.commands = []
+        self.results = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.run()
+
+    def add(self, command):
+        """
+        Queue a shell command.
+
+        Args:
+            command: command as list or string.
+        Returns:
+            the index of the command result in results.
+        """
+        self.commands.append(command)
+        return len(self.commands) - 1
+
+    def run(self):
+        """
+        Run the queued commands.
+
+        Returns:
+            a list of (output, exit status) tuples, one per queued command.
+        Raises:
+            Exception: if the output of a command cannot be found.
+        """
+        if not self.commands:
+            self.results = []
+            return self.results
+        marker = '_dumpey_%d_' % random.randint(_BATCH_MARKER_MIN,
+                                                _BATCH_MARKER_MAX)
+        script = [_BATCH_FRAME % {'marker': marker,
+                                  'index': index,
+                                  'command': _shell_str(command)}
+                  for index, command in enumerate(self.commands)]
+        output = adb(['shell', '; '.join(script)], self.device)
+        self.results = _parse_batch_output(output, marker, len(self.commands))
+        return self.results
 
 
 #
 # Helpers
 #
 
+# Set by watch_devices
+_registry = None
+
 
-def _cmd(args):
+def _forget_device(device, old_state, new_state):
+    # A device that went away may come back rebooted or reinstalled.
+    invalidate_packages([device])
+    invalidate_device_info([device])
+
+
+def _native_adb(args, device):
+    # Returns None for commands the native client does not handle, and when
+    # the adb server is not reachable, so that the caller falls back to the
+    # adb executable.
+    head = ['adb', '-s', device] if device else ['adb']
+    if args != ['devices'] and not (len(args) > 1 and args[0] == 'shell'):
+        return None
+    timer = instrument.begin(head + args)
+    try:
+        if args == ['devices']:
+            output = _adb_client.devices()
+        else:
+            output = _adb_client.shell(args[1:], device)
+    except adbclient.ServerUnavailable:
+        return None
+    except adbclient.ShellError as e:
+        if timer is not None:
+            timer.end(e.status)
+        raise Exception("failed to execute '%s', status=%d, err=%s"
+                        % (_to_str(head + args, " "), e.status,
+                           e.output.strip()))
+    except adbclient.AdbError as e:
+        if timer is not None:
+            timer.end(None)
+        raise Exception("failed to execute '%s', err=%s"
+                        % (_to_str(head + args, " "), e))
+    if timer is not None:
+        timer.end(0, len(output))
+    return output
+
+
+def _cmd(args, binary=False):
+    # Returns the output as text, decoded as UTF-8 on Python 3, or as bytes
+    # if binary is True.
+    timer = instrument.begin(args)
     process = subprocess.Popen(args, stdout=subprocess.PIPE)
     output, err = process.communicate()
     returncode = process.poll()
+    if timer is not None:
+        timer.end(returncode, _transferred(args, output))
     if returncode:
         raise Exception("failed to execute '%s', status=%d, err=%s"
                         % (_to_str(args, " "), returncode, err))
+    if not binary and output is not None and not isinstance(output, str):
+        output = output.decode('utf-8', 'replace')
     return output
 
 
-def _install_from_dir(local_dir, devices, recursive):
-    for item in os.listdir(local_dir):
+def _pipe(producer_args, consumer_args):
+    # Runs producer_args with its output piped into consumer_args, without
+    # buffering it in between.
+    timer = instrument.begin(producer_args)
+    producer = subprocess.Popen(producer_args, stdout=subprocess.PIPE)
+    consumer = subprocess.Popen(consumer_args, stdin=producer.stdout,
+                                stdout=subprocess.PIPE)
+    # Leave the consumer the only reader, so that the producer gets a
+    # broken pipe if the consumer dies.
+    producer.stdout.close()
+    output, err = consumer.communicate()
+    returncodes = ((producer_args, producer.wait()),
+                   (consumer_args, consumer.poll()))
+    if timer is not None:
+        timer.end(returncodes[0][1] or returncodes[1][1])
+    for args, returncode in returncodes:
+        if returncode:
+            raise Exception("failed to execute '%s', status=%d, err=%s"
+                            % (_to_str(args, " "), returncode, err))
+    return output
+
+
+def _stream(args, consume):
+    # Runs args and passes its output, as a binary file object, to consume.
+    timer = instrument.begin(args)
+    process = subprocess.Popen(args, stdout=subprocess.PIPE)
+    src = process.stdout
+    if timer is not None:
+        src = instrument.CountingReader(src)
+    try:
+        consume(src)
+    finally:
+        process.stdout.close()
+        returncode = process.wait()
+        if timer is not None:
+            timer.end(returncode, src.count)
+    if returncode:
+        raise Exception("failed to execute '%s', status=%d"
+                        % (_to_str(args, " "), returncode))
+
+
+def _transferred(args, output):
+    # Bytes moved by a command: the size of the file pulled or the APKs
+    # installed, or else the size of its output.
+    if 'pull' in args and os.path.isfile(args[-1]):
+        return os.path.getsize(args[-1])
+    if 'install' in args or 'install-multiple' in args:
+        return sum(os.path.getsize(a) for a in args
+                   if a.endswith('.apk') and os.path.isfile(a))
+    return len(output) if output is not None else None
+
+
+def _find_executable(name):
+    names = [name, name + '.exe'] if os.name == 'nt' else [name]
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        for candidate in names:
+            path = os.path.join(directory, candidate)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+    return None
+
+
+# Default upper bound on the number of devices a command runs on at once
+_MAX_WORKERS = 8
+
+
+def _fan_out(func, devices, max_workers=None):
+    # Runs func(device) on each device, at most max_workers at a time. A
+    # failing device does not stop the others; failures are reported once
+    # every device is done.
+    def run(device):
+        try:
+            return device, func(device), None
+        except Exception as e:
+            return device, None, e
+
+    workers = min(len(devices), max_workers or _MAX_WORKERS)
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            outcomes = pool.map(run, devices)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        outcomes = [run(device) for device in devices]
+
+    results = {}
+    errors = {}
+    for device, result, error in outcomes:
+        if error is None:
+            results[device] = result
+        else:
+            _warn('failed on %s: %s', device, error)
+            errors[device] = error
+    if errors:
+        raise DeviceError(results, errors)
+    return results
+
+
+# Device serial to a DeviceInfo
+_device_info = {}
+_device_info_lock = threading.Lock()
+
+
+# First API level whose ps needs -A to list every process
+_PS_ALL_MIN_API = 26
+
+
+def _install_from_files(local_files, devices, max_workers, reinstall=False,
+                        hub_workers=None, bandwidth=None):
+    # Each device installs its APKs in turn, devices run in parallel, as
+    # far as the limits of their USB hub allow.
+    apks = _identify_apks(local_files)
+    groups = _apk_groups(local_files, apks)
+    hubs = _usb_hubs(devices) if hub_workers or bandwidth else {}
+    throttles = dict((hub, _HubThrottle(hub_workers, bandwidth))
+                     for hub in set(hubs.get(d) for d in devices))
+
+    def install_all(device):
+        outcome = {'installed': [], 'skipped': [], 'failed': []}
+        throttle = throttles[hubs.get(device)]
+        unchanged = set()
+        if apks and not reinstall:
+            unchanged = _unchanged_apks(device, apks)
+        for group in groups:
+            if all(local_file in unchanged for local_file in group):
+                for local_file in group:
+                    _inform('%s is up to date on %s', local_file, device)
+                outcome['skipped'].extend(group)
+                continue
+            try:
+                with throttle:
+                    _install_apks(group, device, throttle)
+                outcome['installed'].extend(group)
+            except Exception as e:
+                _warn('failed to install %s on %s: %s', _to_str(group),
+                      device, e)
+                outcome['failed'].extend(group)
+        return outcome
+
+    return _fan_out(install_all, devices, max_workers)
+
+
+def _apk_groups(local_files, apks):
+    # Returns local_files as a list of lists: a base APK with the split APKs
+    # of the same package and version in the same directory, or a single
+    # APK. apks is a dict of local files to their ApkInfo.
+    def key(local_file):
+        info = apks[local_file]
+        return os.path.dirname(local_file), info.package, info.version_code
+
+    groups = []
+    by_base = {}
+    for local_file in local_files:
+        info = apks.get(local_file)
+        if info and info.split is not None:
+            continue
+        group = [local_file]
+        groups.append(group)
+        if info:
+            by_base.setdefault(key(local_file), group)
+    for local_file in local_files:
+        info = apks.get(local_file)
+        if info and info.split is not None:
+            group = by_base.get(key(local_file))
+            if group is None:
+                groups.append([local_file])
+            else:
+                group.append(local_file)
+    return groups
+
+
+# First API level whose package manager installs APKs in sessions, which
+# split APKs need
+_INSTALL_MULTIPLE_MIN_API = 21
+
+# First API level with the cmd tool, which reads streamed APKs from stdin
+_STREAMED_INSTALL_MIN_API = 24
+
+
+def _install_apks(local_files, device, throttle=None):
+    # Installs an APK, or a base APK and its splits. Throttled installs are
+    # streamed to the package manager, so that the bytes sent can be paced.
+    if throttle and throttle.bucket:
+        if api_version(device, int) >= _STREAMED_INSTALL_MIN_API:
+            try:
+                _install_streamed(local_files, device, throttle.bucket)
+                return
+            except adbclient.ServerUnavailable:
+                pass
+        if device not in throttle.unpaced:
+            throttle.unpaced.add(device)
+            _warn("can't limit the bandwidth of installs on %s, it needs "
+                  "API %d and a reachable adb server", device,
+                  _STREAMED_INSTALL_MIN_API)
+    if len(local_files) == 1:
+        _install_apk(local_files[0], device)
+    elif api_version(device, int) >= _INSTALL_MULTIPLE_MIN_API:
+        out = adb(['install-multiple', '-r'] + local_files, device)
+        _check_install(out, local_files, device)
+    else:
+        for local_file in local_files:
+            _install_apk(local_file, device)
+
+
+def _install_apk(local_file, device):
+    out = adb(['install', '-r', local_file], device)
+    _check_install(out, [local_file], device)
+
+
+def _check_install(out, local_files, device):
+    invalidate_packages([device])
+    # Older adb versions exit with 0 on failed installs.
+    if out and 'Failure' in out:
+        raise Exception(out.strip())
+    _inform('%s installed on %s', _to_str(local_files), device)
+
+
+# Bytes sent at once in streamed installs
+_INSTALL_CHUNK = 1 << 16
+
+
+def _install_streamed(local_files, device, bucket):
+    # Installs APKs in a package manager session, streaming each one through
+    # the adb server at the pace the bucket allows.
+    client = _adb_client or adbclient.AdbClient()
+    out = client.shell(['cmd', 'package', 'install-create', '-r'], device)
+    session = re.search(r'\[(\d+)\]', out)
+    if not session:
+        raise Exception(out.strip())
+    session = session.group(1)
+    try:
+        for index, local_file in enumerate(local_files):
+            size = os.path.getsize(local_file)
+            command = ['cmd', 'package', 'install-write', '-S', str(size),
+                       session, '%d_%s' % (index, os.path.basename(local_file)),
+                       '-']
+            out = client.exec_in(command, _paced_chunks(local_file, bucket),
+                                 device)
+            if 'Success' not in out:
+                raise Exception(out.strip())
+        out = client.shell(['cmd', 'package', 'install-commit', session],
+                           device)
+    except Exception:
+        try:
+            client.shell(['cmd', 'package', 'install-abandon', session],
+                         device)
+        except adbclient.AdbError:
+            pass
+        raise
+    if 'Success' not in out:
+        raise Exception(out.strip())
+    _check_install(out, local_files, device)
+
+
+def _paced_chunks(local_file, bucket):
+    with open(local_file, 'rb') as f:
+        while True:
+            chunk = f.read(_INSTALL_CHUNK)
+            if not chunk:
+                return
+            bucket.consume(len(chunk))
+            yield chunk
+
+
+def _usb_hubs(devices):
+    # Returns a dict of device serials to the USB hub they're attached to,
+    # as reported by 'adb devices -l', or None if it's unknown. A device at
+    # usb:1-1.2 is on port 2 of hub 1-1, one at usb:1-1 on root hub 1.
+    hubs = {}
+    for line in adb(['devices', '-l']).splitlines()[1:]:
+        fields = line.split()
+        for field in fields[2:]:
+            if field.startswith('usb:'):
+                port = field[len('usb:'):]
+                if '.' in port:
+                    hubs[fields[0]] = port.rsplit('.', 1)[0]
+                else:
+                    hubs[fields[0]] = port.split('-')[0]
+    return dict((device, hubs.get(device)) for device in devices)
+
+
+class _HubThrottle(object):
+    # Limits the installs running at once on the devices of a USB hub, and
+    # the bytes per second sent to them. Entering it takes an install slot.
+    # unpaced holds the devices whose installs can't be paced.
+
+    def __init__(self, workers=None, bandwidth=None):
+        self.slots = threading.Semaphore(workers) if workers else None
+        self.bucket = _TokenBucket(bandwidth) if bandwidth else None
+        self.unpaced = set()
+
+    def __enter__(self):
+        if self.slots:
+            self.slots.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.slots:
+            self.slots.release()
+
+
+class _TokenBucket(object):
+    # Hands out rate bytes per second, in bursts of up to a second's worth.
+    # Consumers that overdraw it wait until the debt is paid back, so
+    # concurrent consumers share the rate.
+
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.tokens = self.rate
+        self.time = time.time()
+        self.lock = threading.Lock()
+
+    def consume(self, count):
+        with self.lock:
+            now = time.time()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.time) * self.rate)
+            self.time = now
+            self.tokens -= count
+            wait = -self.tokens / self.rate
+        if wait > 0:
+            time.sleep(wait)
+
+
+# Local APK path to a ((size, mtime), ApkInfo) tuple
+_local_apks = {}
+_local_apks_lock = threading.Lock()
+
+
+def _identify_apks(local_files):
+    # Returns a dict of local files to their ApkInfo. Files that can't be
+    # identified are left out, so they are always installed.
+    apks = {}
+    for local_file in local_files:
+        try:
+            st = os.stat(local_file)
+            stamp = (st.st_size, st.st_mtime)
+            with _local_apks_lock:
+                cached = _local_apks.get(local_file)
+            if cached and cached[0] == stamp:
+                apks[local_file] = cached[1]
+                continue
+            info = apk.identify(local_file)
+        except (apk.ApkError, OSError) as e:
+            _warn("can't identify %s, it will be installed: %s", local_file, e)
+            continue
+        with _local_apks_lock:
+            _local_apks[local_file] = (stamp, info)
+        apks[local_file] = info
+    return apks
+
+
+# (device, package, version code, last update time, remote path) tuple to
+# the digest of an installed APK
+_remote_digests = {}
+_remote_digests_lock = threading.Lock()
+
+
+def _unchanged_apks(device, apks):
+    # Returns the set of local files in apks, a dict of local files to their
+    # ApkInfo, whose exact content is installed on the device. A base APK
+    # and its splits, grouped as _apk_groups does, are unchanged if their
+    # digests are those of all the APKs of the package on the device. The
+    # version of each package is checked first, the installed APKs are
+    # hashed only if it matches.
+    packages = sorted(set(info.package for info in apks.values()))
+    with ShellBatch(device) as batch:
+        for package in packages:
+            batch.add(['dumpsys', 'package', package])
+            batch.add(['pm', 'path', package])
+    installed = {}
+    for i, package in enumerate(packages):
+        dumpsys = batch.results[2 * i][0]
+        paths = [line.split(':', 1)[1].strip()
+                 for line in batch.results[2 * i + 1][0].splitlines()
+                 if line.startswith('package:')]
+        version = _parse_version_code(dumpsys)
+        if version is None or not paths:
+            continue
+        update = re.search(r'lastUpdateTime=([^\r\n]*)', dumpsys)
+        installed[package] = [(device, package, version,
+                               update.group(1) if update else None, path)
+                              for path in paths]
+
+    candidates = set(key for info in apks.values()
+                     for key in installed.get(info.package, [])
+                     if key[2] == info.version_code)
+    with _remote_digests_lock:
+        digests = dict((key, _remote_digests[key]) for key in candidates
+                       if key in _remote_digests)
+    missing = sorted(candidates - set(digests))
+    if missing:
+        with ShellBatch(device) as batch:
+            for key in missing:
+                batch.add(_DIGEST_COMMAND % (key[4], key[4]))
+        for key, (out, _) in zip(missing, batch.results):
+            digest = _parse_digest(out)
+            if digest:
+                digests[key] = digest
+        with _remote_digests_lock:
+            _remote_digests.update(digests)
+
+    unchanged = set()
+    for group in _apk_groups(sorted(apks), apks):
+        info = apks[group[0]]
+        keys = installed.get(info.package)
+        if not keys or keys[0][2] != info.version_code:
+            continue
+        remote = [digests.get(key) for key in keys]
+        if None in remote:
+            continue
+        # Devices without sha256sum report MD5 digests.
+        local = [apks[local_file].sha256 if len(remote[0]) == 64
+                 else apks[local_file].md5 for local_file in group]
+        if sorted(local) == sorted(remote):
+            unchanged.update(group)
+    return unchanged
+
+
+# Prints the digest of a remote file: SHA-256, or MD5 on devices without
+# sha256sum. Takes the path twice.
+_DIGEST_COMMAND = '(sha256sum %s || md5sum %s) 2>/dev/null'
+
+# Prints the size of a remote file, or its ls -l line on devices without
+# stat. Takes the path twice.
+_SIZE_COMMAND = 'stat -c %%s %s 2>/dev/null || ls -l %s'
+
+
+def _parse_version_code(dumpsys):
+    # Returns the version code in the dumpsys output of a package, or None.
+    version = re.search(r'versionCode=(\d+)', dumpsys)
+    return int(version.group(1)) if version else None
+
+
+def _parse_digest(output):
+    # Returns the lowercase digest printed by _DIGEST_COMMAND, or None.
+    fields = output.split()
+    return fields[0].lower() if fields else None
+
+
+def _parse_size(output):
+    # Returns the size printed by _SIZE_COMMAND, or None. The size is the
+    # fourth field of toolbox ls -l lines.
+    fields = output.split()
+    if len(fields) == 1 and fields[0].isdigit():
+        return int(fields[0])
+    if len(fields) > 3 and fields[3].isdigit():
+        return int(fields[3])
+    return None
+
+
+def _apk_files(local_dir, recursive):
+    files = []
+    for item in sorted(os.listdir(local_dir)):
         item_path = os.path.join(local_dir, item)
         if item.endswith(".apk"):
-            _install_from_file(item_path, devices)
+            files.append(item_path)
         elif recursive and os.path.isdir(item_path):
-            _install_from_dir(item_path, devices, recursive)
-
-
-def _install_from_file(local_file, devices):
-    for device in devices:
-        adb(['install', local_file], device)
-        _inform('%s installed on %s', local_file, device)
+            files.extend(_apk_files(item_path, recursive))
+    return files
 
 
 def _uninstall_package(package, device):
     adb(['uninstall', package], device)
+    invalidate_packages([device])
     _inform('%s uninstalled from %s', package, device)
 
 
-def _package_iter(regex, devices, func, force=False, *args):
-    affected_devices = []
+# Each batched command is wrapped by a begin and an end marker. The end
+# marker carries the exit status, the bare echo terminates any output that
+# lacks a trailing newline.
+_BATCH_FRAME = ('echo %(marker)sB%(index)d; %(command)s; _s=$?; echo; '
+                'echo %(marker)sE%(index)d $_s')
+
+# Random part of a batch marker will be a number between the following
+# MIN and MAX
+_BATCH_MARKER_MIN = 100000000
+_BATCH_MARKER_MAX = 999999999
+
+
+def _parse_batch_output(output, marker, count):
+    text = output.replace('\r\n', '\n')
+    results = []
+    for index in range(count):
+        match = re.search(r'%sB%d\n(.*?)\n%sE%d (\d+)'
+                          % (marker, index, marker, index), text, re.DOTALL)
+        if not match:
+            raise Exception('no output for batched command %d' % index)
+        results.append((match.group(1), int(match.group(2))))
+    return results
+
+
+def _shell_str(command):
+    return command if isinstance(command, str) else _to_str(command, ' ')
+
+
+def _package_iter(regex, devices, func, force=False, *args, **kwargs):
+    # The only keyword argument is max_workers, see _fan_out.
     compiled_regex = re.compile(regex)
-    for device in devices:
+
+    def run(device):
         packages = _package_list(device, compiled_regex)
         if not packages:
             _warn("nothing found for regex '%s' on %s", regex, device)
         elif len(packages) > 1 and not force:
             _warn("multiple apps found for regex '%s' on %s: %s", regex,
                   device, _to_str(packages))
+        elif len(packages) > 1 and func in _BATCH_COMMANDS:
+            _batch_packages(func, packages, device)
+            return True
+        elif len(packages) > 1 and func in _MULTI_PACKAGE_FUNCS:
+            _MULTI_PACKAGE_FUNCS[func](packages, device, *args)
+            return True
         else:
-            affected_devices.append(device)
             for package in packages:
                 func(package, device, *args)
-    return affected_devices
+            return True
+        return False
+
+    affected = _fan_out(run, devices, kwargs.get('max_workers'))
+    return [device for device in devices if affected[device]]
 
 
-# No force option here - intuitively, it seems paths should always include a
-# sole element. Since I'm not 100% sure, I'm leaving the checks in.
-def _pull_apk(package, device, local_dir):
+def _pull_apk(package, device, local_dir, codec=None, store=None):
     paths = adb(['shell', 'pm', 'path', package], device, _decor_package)
     if not paths:
         _warn('path for package %s on %s not available', package, device)
-    elif len(paths) > 1:
-        _warn('multiple paths available on %s: %s', device, _to_str(paths))
+    elif store is not None:
+        _pull_apk_to_store(package, device, paths, local_dir, store)
     else:
-        path = paths[0]
-        name = _generate_name(device, os.path.basename(path), "apk")
-        local = os.path.join(local_dir, name)
-        pull(path, local, device)
-        _inform('apk from %s downloaded to %s', device, local)
-
-
-def _monkey(package, device, seed, events, before, after, log):
+        for path in paths:
+            name = _apk_name(package, device, path, len(paths) > 1)
+            local = compress.filename(os.path.join(local_dir, name), codec)
+            if codec:
+                _pull_compressed(path, local, device, codec)
+            else:
+                pull(path, local, device)
+            _inform('apk from %s downloaded to %s', device, local)
+
+
+def _pull_apk_to_store(package, device, paths, local_dir, store):
+    # The version code, digests and sizes of the package apks are read in a
+    # single round trip, only the apks the store lacks are pulled.
+    with ShellBatch(device) as batch:
+        batch.add(['dumpsys', 'package', package])
+        for path in paths:
+            batch.add(_DIGEST_COMMAND % (path, path))
+            batch.add(_SIZE_COMMAND % (path, path))
+    version_code = _parse_version_code(batch.results[0][0])
+    if version_code is None:
+        _warn('version of package %s on %s not available', package, device)
+        return
+    for i, path in enumerate(paths):
+        digest = _parse_digest(batch.results[2 * i + 1][0])
+        size = _parse_size(batch.results[2 * i + 2][0])
+        stored = store.find(package, version_code, digest, size)
+        if stored is None:
+            local_tmp = store.temp_path()
+            try:
+                pull(path, local_tmp, device, show_progress=False)
+                stored = store.add(package, version_code, local_tmp)
+            finally:
+                if os.path.exists(local_tmp):
+                    os.remove(local_tmp)
+            _inform('apk %s from %s added to the store', path, device)
+        else:
+            _inform('apk %s from %s is in the store already', path, device)
+        store.record(device, package, version_code, path, stored)
+        if local_dir is not None:
+            name = _apk_name(package, device, path, len(paths) > 1)
+            local = os.path.join(local_dir, name)
+            if apkstore.link(stored, local):
+                _inform('apk from %s linked to %s', device, local)
+            else:
+                _warn("can't link %s to %s, see the store manifest", stored,
+                      local)
+
+
+def _apk_name(package, device, path, split):
+    # Split apks are named after their package too, as their file names,
+    # e.g. base.apk, are the same for every package.
+    name = os.path.basename(path)
+    item = [package, name] if split else name
+    return _generate_name(device, item, "apk")
+
+
+def _reboot(device):
+    adb(["reboot"], device)
+    invalidate_packages([device])
+    invalidate_device_info([device])
+    _inform("%s rebooted", device)
+
+
+def _monkey(package, device, seed, events, before, after, log,
+            sampling=None):
+    # sampling is a (meminfo.Sampler, local directory, format) tuple.
     if before is not None:
         before(package, device)
     if log:
         _inform('starting monkey (seed=%d, events=%d) on %s '
                 'for package %s', seed, events, device, package)
     command = ['shell', 'monkey', '-p', package, '-s', str(seed), str(events)]
-    adb(command, device)
+    if sampling is None:
+        adb(command, device)
+    else:
+        sampler, local_dir, fmt = sampling
+        sampler.start(package, device)
+        try:
+            adb(command, device)
+        finally:
+            series = sampler.stop(package, device)
+            _write_meminfo(package, device, series, local_dir, fmt)
     if after is not None:
         after(package, device)
 
-# Path where a screenshot is temporarily saved on a device
+
+def _memory_usage(device, compiled_regex, refresh=False):
+    packages = _package_list(device, compiled_regex, refresh)
+    with ShellBatch(device) as batch:
+        for package in packages:
+            batch.add(['dumpsys', 'meminfo', package])
+    usage = {}
+    for package, (output, _) in zip(packages, batch.results):
+        sample = meminfo.parse(output)
+        if sample is not None:
+            usage[package] = sample
+    return usage
+
+
+def _write_meminfo(package, device, series, local_dir, fmt):
+    name = _generate_name(device, [package, 'meminfo'], fmt)
+    local_file = os.path.join(local_dir, name)
+    with open(local_file, 'w') as out:
+        series.write(out, fmt)
+    _inform('%d memory samples available at %s', len(series), local_file)
+
+# Path where a screenshot is temporarily saved on devices without exec-out
 _REMOTE_SCREENSHOT_PATH = '/sdcard/_dumpey_screenshot_tmp.png'
 
 
-def _screenshot(device, local_dir):
+def _screenshot(device, local_dir, codec=None):
     now = str(int(time.time()))
     name = _generate_name(device, now, "png")
-    local_file = os.path.join(local_dir, name)
+    local_file = compress.filename(os.path.join(local_dir, name), codec)
+    data = _capture_png(device)
+    _write_local(local_file, codec, lambda dst: dst.write(data))
+    _inform("screenshot downloaded to %s", local_file)
+
+
+def _capture_png(device):
+    # Returns a screenshot as PNG bytes. Devices with exec-out stream it
+    # straight to the host, older ones save it to their storage first.
+    if api_version(device, int) >= _EXEC_OUT_MIN_API:
+        return adb(['exec-out', 'screencap', '-p'], device)
     remote = _REMOTE_SCREENSHOT_PATH
     adb(['shell', 'screencap', remote], device)
-    pull(remote, local_file, device, show_progress=False)
-    remove_file(remote, device)
-    _inform("screenshot downloaded to %s", local_file)
+    fd, local_tmp = tempfile.mkstemp(suffix='.png')
+    os.close(fd)
+    try:
+        pull(remote, local_tmp, device, show_progress=False)
+        with open(local_tmp, 'rb') as f:
+            return f.read()
+    finally:
+        os.remove(local_tmp)
+        remove_file(remote, device)
+
+
+# Max number of burst snapshots waiting to be written. Captures wait for
+# the writer once there are this many.
+_FRAME_QUEUE = 64
+
+# Seconds between checks for Ctrl+C while a burst runs
+_BURST_POLL = 0.2
+
+
+def _burst(devices, local_dir, codec, interval, count, max_workers=None):
+    # Captures every device at once on the pool of _fan_out, run from a
+    # thread of its own, so that Ctrl+C reaches the main thread.
+    writer = _FrameWriter(codec)
+    stop = threading.Event()
+    outcome = {}
+
+    def capture(device):
+        return _capture_frames(device, local_dir, codec, interval, count,
+                               writer, stop)
+
+    def run():
+        try:
+            outcome['frames'] = _fan_out(capture, devices,
+                                         max_workers or len(devices))
+        except Exception as e:
+            outcome['error'] = e
+
+    if count is None:
+        _inform("taking snapshots, press ctrl+c to stop")
+    runner = threading.Thread(target=run)
+    runner.start()
+    try:
+        while runner.is_alive():
+            runner.join(_BURST_POLL)
+    except KeyboardInterrupt:
+        stop.set()
+        runner.join()
+    finally:
+        writer.close()
+    if 'error' in outcome:
+        raise outcome['error']
+    frames = outcome['frames']
+    for device in sorted(frames):
+        _inform('%d snapshots of %s saved to %s', frames[device], device,
+                local_dir)
+    return frames
+
+
+def _capture_frames(device, local_dir, codec, interval, count, writer, stop):
+    # Returns the number of snapshots taken. A device that falls behind
+    # the interval carries on from the current time, without catching up.
+    start = time.time()
+    stamp = str(int(start))
+    due = start
+    index = 0
+    while (count is None or index < count) and not stop.is_set():
+        data = _capture_png(device)
+        name = _generate_name(device, [stamp, '%05d' % index], 'png')
+        writer.put(compress.filename(os.path.join(local_dir, name), codec),
+                   data)
+        index += 1
+        due += interval
+        delay = due - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        else:
+            due = time.time()
+    return index
+
+
+class _FrameWriter(object):
+    # Writes snapshots on a thread of its own, from a bounded queue. A
+    # failed write is reported, and doesn't stop the burst.
+
+    def __init__(self, codec, size=_FRAME_QUEUE):
+        self.codec = codec
+        self.queue = queue.Queue(size)
+        self.thread = threading.Thread(target=self._run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def put(self, local_file, data):
+        self.queue.put((local_file, data))
+
+    def close(self):
+        # Returns once every queued snapshot is written.
+        self.queue.put(None)
+        self.thread.join()
 
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            local_file, data = item
+            try:
+                _write_local(local_file, self.codec,
+                             lambda dst: dst.write(data))
+            except Exception as e:
+                _warn('failed to write %s: %s', local_file, e)
+
+
+# First API level whose 'am dumpheap' returns once the dump is written
+_DUMPHEAP_WAIT_MIN_API = 30
+
+# First API level with adb exec-out, which streams binary output unaltered
+_EXEC_OUT_MIN_API = 21
 
 # Path where a heap dump is temporarily saved on a device
 _REMOTE_HEAP_DUMP_PATH = '/sdcard/_dumpey_hprof_tmp'
 
 
-def _dump_heap(package, device, local_dir, append=None):
+def _dump_heaps(packages, device, local_dir, append=None, codec=None):
+    # Resolves the PIDs of all packages up front, in a single call.
+    found = pids(packages, device)
+    for package in packages:
+        processes = found[package]
+        pid_str = processes[0] if len(processes) == 1 else None
+        _dump_heap(package, device, local_dir, append, codec, pid_str)
+
+
+def _check_dumpheap(result, package, device):
+    # Raises if 'am dumpheap' failed, e.g. for a wrong PID or a path it
+    # can't write to. It exits with 0 on some versions even then, so its
+    # output is checked too.
+    output, status = result
+    if status or re.search(r'\bError\b|Exception', output):
+        raise Exception("heap dump of '%s' on %s failed: %s"
+                        % (package, device, output.strip()))
+
+
+def _dump_heap(package, device, local_dir, append=None, codec=None,
+               pid_str=None):
     api = api_version(device, int)
     if api < 11:
         _warn('heap dumps available on API > 10, device %s is %d', device, api)
         return
 
-    pid_str = pid(package, device)
+    if pid_str is None:
+        pid_str = pid(package, device)
     remote = _REMOTE_HEAP_DUMP_PATH
 
     # Ensure the remote file does not exist, then do a dump.
-    remove_file(remote, device)
-    adb(['shell', 'am', 'dumpheap', pid_str, remote], device)
-
-    # adb dumpheap command runs as a daemon.
-    # We have to wait for it to finish - check the tmp file size
-    # at timed intervals and stop when it's not changing anymore.
-    #
-    # This could be prettier.
-    size = -1
-    while True:
-        time.sleep(1)
-        temp = file_size(remote, device)
-        if temp <= size:
-            break
-        size = temp
+    with ShellBatch(device) as batch:
+        batch.add(['rm', '-f', remote])
+        dump = batch.add(['am', 'dumpheap', pid_str, remote])
+    _check_dumpheap(batch.results[dump], package, device)
+
+    # Before Android 11, 'am dumpheap' returns as soon as the dump starts.
+    # Wait for the file to stop changing.
+    if api < _DUMPHEAP_WAIT_MIN_API:
+        size = wait_for_file(remote, device)
+    else:
+        probe = _remote_stat(remote, device)
+        size = probe[0] if probe else 0
+    if not size:
+        _warn("heap dump is empty, has '%s' crashed?", package)
+        remove_file(remote, device)
+        return
 
-    # Create and pull the non-converted hprof dump.
     name = _generate_name(device, [package, append])
     local_file = os.path.join(local_dir, name + '.hprof')
     local_file_nonconv = local_file + '-nonconv'
-    pull(remote, local_file_nonconv, device)
-
-    # Convert heap dump if size is not 0, warn otherwise.
-    if os.path.getsize(local_file_nonconv):
-        _cmd(['hprof-conv', local_file_nonconv, local_file])
-        os.remove(local_file_nonconv)
-        remove_file(remote, device)
-        _inform('converted hprof file available at %s', local_file)
+    local_file = compress.filename(local_file, codec)
+    # Compressed dumps are converted in-process, so that only compressed
+    # bytes reach the disk.
+    builtin = (_builtin_converter or codec or
+               not _find_executable('hprof-conv'))
+    if api >= _EXEC_OUT_MIN_API:
+        # Stream the dump straight into the converter.
+        command = ['adb', '-s', device, 'exec-out', 'cat', remote]
+        if builtin:
+            _stream(command,
+                    lambda src: _convert_hprof(src, local_file, codec))
+        else:
+            _pipe(command, ['hprof-conv', '-', local_file])
     else:
-        _warn("non-converted heap dump is empty, has '%s' crashed?", package)
+        # Pull the non-converted hprof dump, then convert it.
+        pull(remote, local_file_nonconv, device)
+        if builtin:
+            with open(local_file_nonconv, 'rb') as src:
+                _convert_hprof(src, local_file, codec)
+        else:
+            _cmd(['hprof-conv', local_file_nonconv, local_file])
         os.remove(local_file_nonconv)
+    remove_file(remote, device)
+    _inform('converted hprof file available at %s', local_file)
+    return local_file
 
 
-def _package_list(device, compiled_regex):
-    packages = adb(['shell', 'pm', 'list', 'packages'], device, _decor_package)
+def _diff_heap_dumps(package, device, before_file, after_file, local_dir):
+    # Writes a report of the classes that grew between two heap dumps.
+    before = analysis.class_histogram(before_file)
+    after = analysis.class_histogram(after_file)
+    name = _generate_name(device, [package, 'diff'], 'txt')
+    report = os.path.join(local_dir, name)
+    with open(report, 'w') as out:
+        analysis.write_report(out, before, after)
+    _inform('heap growth report available at %s', report)
+
+
+# Seconds a device package list is served from the cache
+_PACKAGE_CACHE_TTL = 60
+
+# Device serial to a (time listed, packages) tuple
+_package_cache = {}
+_package_cache_lock = threading.Lock()
+
+
+# Package helpers with a faster path for many packages on one device. Values
+# take a list of packages in place of a single package name.
+_MULTI_PACKAGE_FUNCS = {
+    _dump_heap: _dump_heaps,
+}
+
+
+# First API level whose toolbox ships stat
+_STAT_MIN_API = 23
+
+
+# Appended to shell commands whose failure is an expected outcome, so that
+# they exit with 0 over transports that report exit statuses
+_IGNORE_STATUS = '2>/dev/null || true'
+
+
+def _remote_stat(remote_path, device):
+    # Returns a (size, mtime) tuple, or None if the file does not exist.
+    # Devices without stat fall back to ls, which gives the size only. A
+    # missing file is expected, so its non-zero status is ignored.
+    try:
+        if api_version(device, int) < _STAT_MIN_API:
+            out = adb(['shell', 'ls', '-l', remote_path, _IGNORE_STATUS],
+                      device)
+            return int(_split_whitespace(out)[3]), None
+        out = adb(['shell', 'stat', '-c', "'%s %Y'", remote_path,
+                   _IGNORE_STATUS], device)
+        size, mtime = out.split()
+        return int(size), int(mtime)
+    except (ValueError, IndexError):
+        return None
+
+
+# Set by use_builtin_converter
+_builtin_converter = False
+
+
+def _convert_hprof(src, local_file, codec=None):
+    timer = instrument.begin(kind='hprof convert')
+    _write_local(local_file, codec, lambda dst: hprof.convert(src, dst))
+    if timer is not None:
+        timer.end(0, os.path.getsize(local_file))
+
+
+def _pull_compressed(remote, local_file, device, codec):
+    # Devices without exec-out can only pull, so the file is compressed
+    # from a temporary local copy.
+    if api_version(device, int) >= _EXEC_OUT_MIN_API:
+        command = ['adb', '-s', device, 'exec-out', 'cat', remote]
+        _stream(command, lambda src: _write_local(
+            local_file, codec, lambda dst: shutil.copyfileobj(src, dst)))
+        return
+    local_tmp = local_file + '-tmp'
+    pull(remote, local_tmp, device, show_progress=False)
+    try:
+        with open(local_tmp, 'rb') as src:
+            _write_local(local_file, codec,
+                         lambda dst: shutil.copyfileobj(src, dst))
+    finally:
+        os.remove(local_tmp)
+
+
+def _write_local(local_file, codec, write):
+    # Calls write with the file object of local_file, compressed with codec,
+    # leaving no partial file behind on failure.
+    try:
+        with compress.open_write(local_file, codec) as dst:
+            write(dst)
+    except Exception:
+        if os.path.exists(local_file):
+            os.remove(local_file)
+        raise
+
+
+def _package_list(device, compiled_regex, refresh=False):
+    packages = _cached_packages(device, refresh)
     return [p for p in packages if
-            compiled_regex.search(p)] if compiled_regex else packages
+            compiled_regex.search(p)] if compiled_regex else list(packages)
+
+
+def _cached_packages(device, refresh):
+    now = time.time()
+    with _package_cache_lock:
+        cached = _package_cache.get(device)
+    if cached and not refresh and now - cached[0] < _PACKAGE_CACHE_TTL:
+        return cached[1]
+    packages = adb(['shell', 'pm', 'list', 'packages'], device, _decor_package)
+    with _package_cache_lock:
+        _package_cache[device] = (now, packages)
+    return packages
 
 
 def _clear_data(package, device):
@@ -538,6 +1972,34 @@ def _clear_data(package, device):
     _inform("cleared data for '%s' on device %s", package, device)
 
 
+# Package helpers that map to a single shell command, and can therefore run
+# for many packages in one batch. Values are the command and the message
+# printed on success.
+_BATCH_COMMANDS = {
+    _clear_data: (lambda p: ['pm', 'clear', p],
+                  "cleared data for '%s' on device %s"),
+    _uninstall_package: (lambda p: ['pm', 'uninstall', p],
+                         '%s uninstalled from %s'),
+}
+
+
+def _batch_packages(func, packages, device):
+    command, message = _BATCH_COMMANDS[func]
+    with ShellBatch(device) as batch:
+        for package in packages:
+            batch.add(command(package))
+    if func is _uninstall_package:
+        invalidate_packages([device])
+    failed = []
+    for package, (output, status) in zip(packages, batch.results):
+        if status or 'Success' not in output:
+            failed.append(package)
+        else:
+            _inform(message, package, device)
+    if failed:
+        raise Exception('failed for %s' % _to_str(failed))
+
+
 def _ensure_package_or_regex_given(package, regex):
     if not (package or regex):
         raise Exception("either package or regex must be given")
@@ -558,6 +2020,23 @@ def _decor_package(output):
     return _decor_split(output, lambda l: l.strip().split('package:')[1])
 
 
+def _decor_ps(output):
+    # Columns are USER PID PPID ... NAME, the name being the last one.
+    processes = {}
+    for line in _decor_split(output):
+        columns = line.split()
+        if len(columns) > 2 and columns[1] != 'PID':
+            processes.setdefault(columns[-1], []).append(columns[1])
+    return processes
+
+
+def _decor_getprop(output):
+    # Lines are formatted as '[name]: [value]'
+    properties = re.findall(r'^\[([^\]]*)\]: \[(.*?)\]\s*$',
+                            output.replace('\r\n', '\n'), re.M | re.S)
+    return dict(properties)
+
+
 def _split_whitespace(string):
     return re.sub(' +', ' ', string).split(' ')
 
@@ -575,9 +2054,14 @@ _SHELL_COLOR_WARNING = '\033[91m'
 _SHELL_COLOR_END = '\033[0m'
 
 
+# Keeps lines printed from concurrent device workers from interleaving
+_print_lock = threading.Lock()
+
+
 def _print(shell_color, string_format, *string_args):
     message = string_format % string_args
-    print(shell_color + message + _SHELL_COLOR_END)
+    with _print_lock:
+        print(shell_color + message + _SHELL_COLOR_END)
 
 
 def _warn(string_format, *string_args):
@@ -592,6 +2076,18 @@ def _dumpey_args_parser():
     parser = argparse.ArgumentParser(
         description="Dumpey, an Android Debug Bridge utility tool."
     )
+    parser.add_argument("--native", action='store_true',
+                        help="talk to the adb server socket directly instead "
+                             "of running adb for each command")
+    parser.add_argument("--builtin-conv", action='store_true',
+                        help="convert heap dumps with the built-in converter "
+                             "instead of hprof-conv")
+    parser.add_argument("--profile", action='store_true',
+                        help="time each adb call, and print a latency and "
+                             "throughput report when done")
+    parser.add_argument("--profile-json", metavar="FILE",
+                        help="write the timing of each adb call to a JSON "
+                             "file")
 
     devices_parser = argparse.ArgumentParser(add_help=False)
     devices_parser.add_argument("-s",
@@ -600,6 +2096,12 @@ def _dumpey_args_parser():
                                 metavar="SERIAL",
                                 dest="devices",
                                 help="device serials to run the command on")
+    devices_parser.add_argument("-j", "--jobs",
+                                type=int,
+                                metavar="N",
+                                help="max number of devices to run the "
+                                     "command on at once (default: %d)"
+                                     % _MAX_WORKERS)
 
     package_regex_parser = argparse.ArgumentParser(add_help=False)
     package_regex_parser.add_argument("-p", "--package", help="package name")
@@ -613,6 +2115,10 @@ def _dumpey_args_parser():
     path_parser.add_argument("-o", "--source", help="file or directory path",
                              dest="path")
 
+    codec_parser = argparse.ArgumentParser(add_help=False)
+    codec_parser.add_argument("--codec", choices=compress.CODECS,
+                              help="compress downloaded files")
+
     subparsers = parser.add_subparsers(title="dumpey commands", dest="sub",
                                        help="commands")
 
@@ -620,39 +2126,111 @@ def _dumpey_args_parser():
                               help="install APKs from path")
     i.add_argument("-r", "--recursive", action='store_true', help="recursive",
                    default=False)
+    i.add_argument("--reinstall", action='store_true',
+                   help="install APKs even if the device has them already")
+    i.add_argument("--hub-jobs", type=int, metavar="N",
+                   help="max number of installs at once per USB hub")
+    i.add_argument("--bandwidth", type=float, metavar="MB",
+                   help="max megabytes per second sent per USB hub, "
+                        "on devices with API 24 or higher")
 
     subparsers.add_parser("u", parents=[devices_parser, package_regex_parser],
                           help="uninstall apps")
-    subparsers.add_parser("a", parents=[devices_parser, package_regex_parser,
-                                        path_parser], help="download APKs")
+    a = subparsers.add_parser("a", parents=[devices_parser,
+                                            package_regex_parser,
+                                            path_parser, codec_parser],
+                              help="download APKs")
+    a.add_argument("--store", metavar="DIR",
+                   help="keep APKs in a content-addressed store, "
+                        "downloading only the ones it lacks")
     subparsers.add_parser("c", parents=[devices_parser, package_regex_parser],
                           help="stop and clear package data")
     subparsers.add_parser("r", parents=[devices_parser], help="reboot devices")
     subparsers.add_parser("h", parents=[devices_parser, package_regex_parser,
-                                        path_parser],
+                                        path_parser, codec_parser],
                           help="do a heap dump")
 
     l = subparsers.add_parser("l", parents=[devices_parser],
                               help="list installed packages")
     l.add_argument("-r", "--regex", help="regex")
+    l.add_argument("--refresh", action='store_true',
+                   help="list packages again instead of using the cache")
 
     monkey_parser = subparsers.add_parser("m",
                                           parents=[devices_parser,
                                                    package_regex_parser,
-                                                   path_parser],
+                                                   path_parser, codec_parser],
                                           help="run the monkey")
     monkey_parser.add_argument('--seed', type=int, help="seed value")
     monkey_parser.add_argument('--events', type=int,
                                help="number of events")
     monkey_parser.add_argument('--dump', choices=['b', 'a', 'ba', 'ab'],
                                help="perform heap dumps before (b), after(a) "
-                                    "or before and after the monkey (ab|ba)")
-
-    s = subparsers.add_parser("s", parents=[path_parser],
+                                    "or before and after the monkey (ab|ba), "
+                                    "the latter with a report of the "
+                                    "classes that grew")
+    monkey_parser.add_argument('--meminfo', type=float, metavar="SECONDS",
+                               help="sample the app memory use every "
+                                    "SECONDS while the monkey runs")
+    monkey_parser.add_argument('--meminfo-format', choices=meminfo.FORMATS,
+                               default=meminfo.CSV,
+                               help="memory samples file format "
+                                    "(default: csv)")
+
+    s = subparsers.add_parser("s", parents=[devices_parser, path_parser,
+                                            codec_parser],
                               help="do snapshots")
     s.add_argument("-d", "--device", help="device serial")
     s.add_argument("-m", "--multi", help="take multiple snapshots",
                    action='store_true')
+    rate = s.add_mutually_exclusive_group()
+    rate.add_argument("--interval", type=float, metavar="SECONDS",
+                      help="take snapshots continuously, one every SECONDS "
+                           "on each device")
+    rate.add_argument("--fps", type=float, metavar="N",
+                      help="take snapshots continuously, N per second on "
+                           "each device")
+    s.add_argument("--count", type=int, metavar="N",
+                   help="stop after N snapshots per device")
+
+    p = subparsers.add_parser("p", parents=[devices_parser, path_parser],
+                              help="show the memory use of packages on "
+                                   "devices")
+    p.add_argument("-r", "--regex", help="regex")
+    p.add_argument("--format", choices=meminfo.FORMATS,
+                   help="format of the file given with -o (default: csv)")
+    p.add_argument("--repeat", type=float, metavar="SECONDS",
+                   help="show the memory use again every SECONDS, until "
+                        "ctrl+c")
+    p.add_argument("--count", type=int, metavar="N",
+                   help="stop after showing the memory use N times")
+
+    run = subparsers.add_parser("run", help="run the steps of a plan file "
+                                            "in one process")
+    run.add_argument("plan", help="JSON plan file")
+    run.add_argument("-s", "--serials", nargs="+", metavar="SERIAL",
+                     dest="devices",
+                     help="device serials to run steps without -s on")
+    run.add_argument("-j", "--jobs", type=int, metavar="N",
+                     help="max number of steps to run at once, each on one "
+                          "device (default: %d)" % _MAX_WORKERS)
+
+    serve = subparsers.add_parser("serve", help="serve the dumpey API on a "
+                                                "Unix socket")
+    serve.add_argument("--socket", metavar="PATH",
+                       help="socket path (default: $DUMPEY_SOCKET, or "
+                            "dumpey-<uid>.sock in the temp directory)")
+    serve.add_argument("-j", "--jobs", type=int, metavar="N",
+                       help="max number of devices each request runs on at "
+                            "once (default: %d)" % _MAX_WORKERS)
+
+    t = subparsers.add_parser("t", help="show the objects retaining the "
+                                        "most memory in a heap dump")
+    t.add_argument("file", help="hprof file, e.g. made by 'h'")
+    t.add_argument("-p", "--package",
+                   help="show the objects of this package's classes")
+    t.add_argument("-n", "--count", type=int, default=20,
+                   help="number of objects shown (default: 20)")
 
     return parser
 
@@ -662,16 +2240,42 @@ def _handle_monkey(args, devices):
     dump = args.dump
     if dump:
         local_dir = args.path if args.path else os.getcwd()
-        if 'b' in dump:
-            before = lambda p, d: _dump_heap(p, d, local_dir, 'before')
-        if 'a' in dump:
-            after = lambda p, d: _dump_heap(p, d, local_dir, 'after')
+        codec = args.codec
+        # (package, device) tuple to the path of its 'before' heap dump
+        before_files = {}
+
+        def before(p, d):
+            before_files[(p, d)] = _dump_heap(p, d, local_dir, 'before',
+                                              codec)
+
+        def after(p, d):
+            after_file = _dump_heap(p, d, local_dir, 'after', codec)
+            before_file = before_files.pop((p, d), None)
+            if before_file and after_file:
+                _diff_heap_dumps(p, d, before_file, after_file, local_dir)
+
+        if 'b' not in dump:
+            before = None
+        if 'a' not in dump:
+            after = None
     monkey(args.package, args.regex, devices, args.seed, args.events, before,
-           after, True, args.force)
+           after, True, args.force, args.jobs, args.meminfo, args.path,
+           args.meminfo_format)
 
 
-def _handle_list(regex, devices):
-    packages_dict = package_list(devices, regex)
+def _handle_install(local_path, devices, recursive=False, max_workers=None,
+                    reinstall=False, hub_workers=None, bandwidth=None):
+    results = install(local_path, devices, recursive, max_workers, reinstall,
+                      hub_workers, bandwidth)
+    for device in sorted(results):
+        outcome = results[device]
+        _inform('%s: %d installed, %d skipped, %d failed', device,
+                len(outcome['installed']), len(outcome['skipped']),
+                len(outcome['failed']))
+
+
+def _handle_list(regex, devices, max_workers=None, refresh=False):
+    packages_dict = package_list(devices, regex, max_workers, refresh)
     for device in packages_dict:
         if regex:
             _inform("installed packages on %s for '%s':", device, regex)
@@ -681,34 +2285,189 @@ def _handle_list(regex, devices):
             print(package)
 
 
+def _handle_memory(regex, devices, max_workers=None, local_file=None,
+                   fmt=None, repeat=None, count=None):
+    # Shows the memory use once, or every repeat seconds, as a table or
+    # appended to local_file. Failing devices are left out of the rows.
+    shown = 0
+    try:
+        while True:
+            now = time.time()
+            try:
+                usage = memory_usage(devices, regex, max_workers)
+            except DeviceError as e:
+                usage = e.results
+            if local_file:
+                header = (not os.path.exists(local_file) or
+                          not os.path.getsize(local_file))
+                with open(local_file, 'a') as out:
+                    meminfo.write_usage(out, usage, fmt or meminfo.CSV, now,
+                                        header)
+                _inform('memory use of %d packages written to %s',
+                        sum(len(u) for u in usage.values()), local_file)
+            else:
+                _inform('memory use in kB at %s:',
+                        time.strftime('%H:%M:%S', time.localtime(now)))
+                meminfo.write_usage(sys.stdout, usage)
+            shown += 1
+            if not repeat or (count and shown >= count):
+                return
+            time.sleep(max(0, now + repeat - time.time()))
+    except KeyboardInterrupt:
+        pass
+
+
+def _handle_top(path, package=None, count=20):
+    tree = analysis.dominator_tree(path)
+    if package:
+        _inform("objects of %s retaining the most memory in %s:", package,
+                path)
+        analysis.write_retainers(sys.stdout, tree, count, package + '.')
+    else:
+        _inform("objects retaining the most memory in %s:", path)
+        analysis.write_retainers(sys.stdout, tree, count)
+
+
+def _write_profile(recorder, report, json_file):
+    if report:
+        sys.stderr.write('\n')
+        instrument.write_report(sys.stderr, recorder)
+    if json_file:
+        with open(json_file, 'w') as f:
+            instrument.write_json(f, recorder)
+        _inform('profile written to %s', json_file)
+
+
+def _handle_run(path, devices=None, max_workers=None):
+    steps = plan.load(path)
+    parser = _dumpey_args_parser()
+    parsed = dict((step.name, _parse_step(parser, step)) for step in steps)
+    # Steps without serials run on the devices attached when the plan
+    # starts, each device on its own.
+    step_devices = {}
+    for step in steps:
+        args = parsed[step.name]
+        if not hasattr(args, 'devices') or getattr(args, 'device', None):
+            continue
+        if args.devices is None and devices is None:
+            devices = attached_devices()
+        step_devices[step.name] = args.devices or devices
+
+    def execute(task):
+        args = argparse.Namespace(**vars(parsed[task.step.name]))
+        if task.device is not None:
+            args.devices = [task.device]
+        _dispatch(args)
+
+    graph = plan.tasks(steps, step_devices)
+    outcomes = plan.run(graph, execute, max_workers or _MAX_WORKERS)
+    failed = 0
+    for task in graph:
+        outcome = outcomes[task]
+        where = ' on %s' % task.device if task.device else ''
+        if outcome is plan.SKIPPED:
+            _warn("step '%s' skipped%s", task.step.name, where)
+        elif outcome is not None:
+            _warn("step '%s' failed%s: %s", task.step.name, where, outcome)
+        else:
+            continue
+        failed += 1
+    if failed:
+        raise Exception('%d of %d tasks did not complete'
+                        % (failed, len(graph)))
+    _inform('%d tasks done', len(graph))
+
+
+def _parse_step(parser, step):
+    if step.args[0].startswith('-'):
+        raise plan.PlanError("step '%s': global options go before 'run'"
+                             % step.name)
+    if step.args[0] in ('run', 'serve'):
+        raise plan.PlanError("step '%s': '%s' can't be a step"
+                             % (step.name, step.args[0]))
+    try:
+        return parser.parse_args(list(step.args))
+    except SystemExit:
+        raise plan.PlanError("step '%s': invalid command '%s'"
+                             % (step.name, _to_str(step.args, ' ')))
+
+
+def _handle_serve(path=None, max_workers=None):
+    # The server module imports this one.
+    from . import server
+    daemon = server.Server(path, max_workers)
+    try:
+        watch_devices()
+    except Exception as e:
+        _warn("can't watch devices, they are listed on each request: %s", e)
+    _inform('serving on %s, ctrl+c to stop', daemon.path)
+    try:
+        daemon.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watch_devices(False)
+
+
+def _dispatch(args):
+    # Runs the command of parsed command line arguments.
+    sub = args.sub
+    if 'a' == sub:
+        pull_apk(args.package, args.regex, args.devices, args.path,
+                 args.force, args.jobs, args.codec, args.store)
+    elif 'c' == sub:
+        clear_data(args.package, args.regex, args.devices, args.force,
+                   args.jobs)
+    elif 'h' == sub:
+        dump_heap(args.package, args.regex, args.devices, args.path,
+                  args.force, args.jobs, args.codec)
+    elif 'i' == sub:
+        bandwidth = args.bandwidth * 1e6 if args.bandwidth else None
+        _handle_install(args.path, args.devices, args.recursive, args.jobs,
+                        args.reinstall, args.hub_jobs, bandwidth)
+    elif 'p' == sub:
+        _handle_memory(args.regex, args.devices, args.jobs, args.path,
+                       args.format, args.repeat, args.count)
+    elif 'r' == sub:
+        reboot(args.devices, args.jobs)
+    elif 'l' == sub:
+        _handle_list(args.regex, args.devices, args.jobs, args.refresh)
+    elif 'm' == sub:
+        _handle_monkey(args, args.devices)
+    elif 's' == sub:
+        interval = 1.0 / args.fps if args.fps else args.interval
+        snapshots(args.device, args.path, args.multi, args.codec, interval,
+                  args.count, args.devices, args.jobs)
+    elif 't' == sub:
+        _handle_top(args.file, args.package, args.count)
+    elif 'u' == sub:
+        uninstall(args.package, args.regex, args.devices, args.force,
+                  args.jobs)
+    elif 'run' == sub:
+        _handle_run(args.plan, args.devices, args.jobs)
+    elif 'serve' == sub:
+        _handle_serve(args.socket, args.jobs)
+
+
 def _main():
     parser = _dumpey_args_parser()
     args = parser.parse_args()
 
-    sub = args.sub
+    if args.native:
+        use_native_transport()
+    if args.builtin_conv:
+        use_builtin_converter()
+    recorder = None
+    if args.profile or args.profile_json:
+        recorder = instrument.enable()
     try:
-        if 'a' == sub:
-            pull_apk(args.package, args.regex, args.devices, args.path,
-                     args.force)
-        elif 'c' == sub:
-            clear_data(args.package, args.regex, args.devices, args.force)
-        elif 'h' == sub:
-            dump_heap(args.package, args.regex, args.devices, args.path,
-                      args.force)
-        elif 'i' == sub:
-            install(args.path, args.devices, args.recursive)
-        elif 'r' == sub:
-            reboot(args.devices)
-        elif 'l' == sub:
-            _handle_list(args.regex, args.devices)
-        elif 'm' == sub:
-            _handle_monkey(args, args.devices)
-        elif 's' == sub:
-            snapshots(args.device, args.path, args.multi)
-        elif 'u' == sub:
-            uninstall(args.package, args.regex, args.devices, args.force)
+        _dispatch(args)
     except Exception as e:
         print(str(e))
+    finally:
+        if recorder is not None:
+            instrument.disable()
+            _write_profile(recorder, args.profile, args.profile_json)
 
 
 if __name__ == "__main__":
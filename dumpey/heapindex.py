@@ -0,0 +1,412 @@
+"""
+Random access to big heap dumps.
+
+build_index() walks a heap dump once and writes a sidecar index next to
+it, holding a fixed-width record for every class, instance and array dump:
+its object id, class id, file offset and shallow size. The records are
+stored three times, sorted by object id, by class and by array size, with
+an external merge sort that keeps memory use flat.
+
+HeapIndex memory-maps the index and the dump. Queries are binary searches
+over the index, object data is read straight from the dump, so repeated
+queries take milliseconds whatever the dump size.
+"""
+
+import collections
+import itertools
+import tempfile
+import shutil
+import struct
+import heapq
+import mmap
+import os
+
+from . import compress
+from . import hprof
+
+# File name extension of the index, appended to the heap dump path
+INDEX_EXTENSION = '.idx'
+
+# Record kinds
+CLASS = 0
+INSTANCE = 1
+OBJECT_ARRAY = 2
+PRIMITIVE_ARRAY = 3
+
+# An indexed object. The class id of primitive arrays is their basic type,
+# the one of classes their super class id. Sizes are shallow sizes in bytes,
+# the instance size for classes, capped at 2^32 - 1.
+Record = collections.namedtuple('Record',
+                                'object_id class_id offset size kind')
+
+_MAGIC = b'DUMPEYIX'
+_FORMAT_VERSION = 1
+
+# Magic, format version, id size, dump size, dump mtime, record count,
+# object record count, primitive array count, class names offset
+_HEADER = struct.Struct('<8sBB6xQQQQQQ')
+
+# Object id, class id, offset, size, kind
+_RECORD = struct.Struct('<QQQIB3x')
+_SIZE_MAX = 0xffffffff
+
+# Class id, name length
+_NAME = struct.Struct('<QH')
+
+# Records sorted in memory at once, before being merged from disk
+_SORT_RUN = 1 << 18
+
+# Records read or written at once
+_IO_RECORDS = 4096
+
+
+def build_index(path, index_path=None):
+    """
+    Index a heap dump.
+
+    Args:
+        path: local path of an uncompressed Android or J2SE hprof file, as
+              string.
+        index_path: local path of the index, as string. Defaults to path
+                    with INDEX_EXTENSION appended.
+    Returns:
+        the index path.
+    Raises:
+        Exception: if the heap dump is compressed.
+        HprofError: if the file is not a heap dump, or it is malformed.
+    """
+    if compress.detect(path):
+        raise Exception("can't index compressed heap dump %s, decompress "
+                        "it first" % path)
+    if index_path is None:
+        index_path = path + INDEX_EXTENSION
+    stat = os.stat(path)
+    tmp_dir = tempfile.mkdtemp(
+        dir=os.path.dirname(os.path.abspath(index_path)))
+    try:
+        unsorted = os.path.join(tmp_dir, 'records')
+        with open(unsorted, 'wb') as out:
+            visitor = _IndexVisitor(out)
+            with open(path, 'rb') as src:
+                hprof.walk(src, visitor)
+            visitor.flush()
+        tmp_index = os.path.join(tmp_dir, 'index')
+        with open(tmp_index, 'wb') as out:
+            out.write(b'\0' * _HEADER.size)
+            count = _write_sorted(unsorted, out, tmp_dir,
+                                  lambda r: r[0])
+            objects = _write_sorted(unsorted, out, tmp_dir,
+                                    lambda r: (r[1], r[0]),
+                                    lambda r: r[4] != CLASS)
+            arrays = _write_sorted(unsorted, out, tmp_dir,
+                                   lambda r: (-r[3], r[0]),
+                                   lambda r: r[4] == PRIMITIVE_ARRAY)
+            names_offset = out.tell()
+            for class_id, name in visitor.class_names():
+                name = name[:0xffff]
+                out.write(_NAME.pack(class_id, len(name)) + name)
+            out.seek(0)
+            out.write(_HEADER.pack(_MAGIC, _FORMAT_VERSION, visitor.id_size,
+                                   stat.st_size, int(stat.st_mtime), count,
+                                   objects, arrays, names_offset))
+        if os.path.exists(index_path):
+            os.remove(index_path)
+        shutil.move(tmp_index, index_path)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return index_path
+
+
+class HeapIndex(object):
+    """
+    Queries a heap dump through its index, building the index first if it
+    is missing or older than the dump.
+
+    Args:
+        path: local path of an uncompressed hprof file, as string.
+        index_path: local path of the index, as string. Defaults to path
+                    with INDEX_EXTENSION appended.
+    Raises:
+        Exception: if the heap dump is compressed.
+        HprofError: if the file is not a heap dump, or it is malformed.
+    """
+
+    def __init__(self, path, index_path=None):
+        if index_path is None:
+            index_path = path + INDEX_EXTENSION
+        if not _is_current(path, index_path):
+            build_index(path, index_path)
+        self.path = path
+        self._files = [open(path, 'rb'), open(index_path, 'rb')]
+        self._dump, self._index = [mmap.mmap(f.fileno(), 0,
+                                             access=mmap.ACCESS_READ)
+                                   for f in self._files]
+        header = _HEADER.unpack_from(self._index, 0)
+        self.id_size = header[2]
+        self._count, self._objects, self._arrays = header[5:8]
+        self._names_offset = header[8]
+        self._by_id = _HEADER.size
+        self._by_class = self._by_id + self._count * _RECORD.size
+        self._by_size = self._by_class + self._objects * _RECORD.size
+        self._names = None
+
+    def close(self):
+        """Unmap and close the heap dump and its index."""
+        self._dump.close()
+        self._index.close()
+        for f in self._files:
+            f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def get(self, object_id):
+        """Return the Record of an object id, or None if there is none."""
+        i = self._lower_bound(self._by_id, self._count, object_id,
+                              lambda r: r[0])
+        if i < self._count:
+            record = self._record(self._by_id, i)
+            if record.object_id == object_id:
+                return record
+        return None
+
+    def records(self):
+        """Yield the Records of all classes and objects, by object id."""
+        unpack_from = _RECORD.unpack_from
+        for pos in range(self._by_id, self._by_class, _RECORD.size):
+            yield Record(*unpack_from(self._index, pos)[:5])
+
+    def class_names(self):
+        """Return a dict of class ids to class names."""
+        if self._names is None:
+            names = {}
+            pos = self._names_offset
+            while pos < len(self._index):
+                class_id, length = _NAME.unpack_from(self._index, pos)
+                pos += _NAME.size
+                name = self._index[pos:pos + length]
+                names[class_id] = name.decode('utf-8', 'replace')
+                pos += length
+            self._names = names
+        return self._names
+
+    def class_name(self, class_id):
+        """Return the name of a class id, or None if it is unknown."""
+        return self.class_names().get(class_id)
+
+    def class_ids(self, name):
+        """
+        Return the ids of the classes with a given name, one for each class
+        loader that loaded it.
+        """
+        return sorted(class_id for class_id, class_name
+                      in self.class_names().items() if class_name == name)
+
+    def instances(self, cls):
+        """
+        Yield the Records of the instances and object arrays of a class.
+
+        Args:
+            cls: class name as string, or class id as int.
+        """
+        class_ids = self.class_ids(cls) if _is_str(cls) else [cls]
+        for class_id in class_ids:
+            i = self._lower_bound(self._by_class, self._objects, class_id,
+                                  lambda r: r[1])
+            while i < self._objects:
+                record = self._record(self._by_class, i)
+                if record.class_id != class_id:
+                    break
+                yield record
+                i += 1
+
+    def largest_arrays(self, count=10, kind=None):
+        """
+        Return the Records of the largest primitive arrays, largest first.
+
+        Args:
+            count: max number of records returned, as int.
+            kind: basic type of the arrays as int, e.g. 8 for byte arrays,
+                  or None for arrays of any type.
+        """
+        records = []
+        for i in range(self._arrays):
+            if len(records) == count:
+                break
+            record = self._record(self._by_size, i)
+            if kind is None or record.class_id == kind:
+                records.append(record)
+        return records
+
+    def data(self, record):
+        """
+        Return the field values of an instance, the element ids of an object
+        array or the elements of a primitive array, as bytes. Returns None
+        for classes and for primitive arrays dumped without data.
+        """
+        id_size = self.id_size
+        if record.kind in (INSTANCE, OBJECT_ARRAY):
+            start = record.offset + 2 * id_size + 9
+        elif (record.kind == PRIMITIVE_ARRAY and
+              self._dump[record.offset:record.offset + 1] ==
+              struct.pack('>B', hprof.PRIMITIVE_ARRAY_DUMP)):
+            start = record.offset + id_size + 10
+        else:
+            return None
+        return self._dump[start:start + record.size]
+
+    def _record(self, section, i):
+        return Record(*_RECORD.unpack_from(self._index,
+                                           section + i * _RECORD.size)[:5])
+
+    def _lower_bound(self, section, count, value, key):
+        # Returns the first index whose key is not less than value.
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if key(self._record(section, mid)) < value:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+
+class _IndexVisitor(hprof.HeapVisitor):
+    # Writes an unsorted record for every class and object dump.
+
+    def __init__(self, out):
+        self.out = out
+        self.pending = []
+        self.strings = {}
+        self.loaded = {}
+        self.id_size = 4
+
+    def header(self, version, id_size):
+        self.id_size = id_size
+
+    def string(self, string_id, value):
+        self.strings[string_id] = value
+
+    def load_class(self, class_id, name_id):
+        self.loaded[class_id] = name_id
+
+    def add(self, object_id, class_id, offset, size, kind):
+        pending = self.pending
+        pending.append(_RECORD.pack(object_id, class_id, offset,
+                                    min(size, _SIZE_MAX), kind))
+        if len(pending) == _IO_RECORDS:
+            self.flush()
+
+    def flush(self):
+        self.out.write(b''.join(self.pending))
+        self.pending = []
+
+    def class_dump(self, offset, class_id, super_id, instance_size, statics,
+                   fields):
+        self.add(class_id, super_id, offset, instance_size, CLASS)
+
+    def instance(self, offset, object_id, class_id, size, data):
+        self.add(object_id, class_id, offset, size, INSTANCE)
+
+    def object_array(self, offset, object_id, class_id, count, data):
+        self.add(object_id, class_id, offset, count * self.id_size,
+                 OBJECT_ARRAY)
+
+    def primitive_array(self, offset, object_id, kind, count):
+        self.add(object_id, kind, offset, count * hprof.TYPE_SIZES[kind],
+                 PRIMITIVE_ARRAY)
+
+    def class_names(self):
+        # Yields (class id, UTF-8 name) tuples, with '/' replaced by '.'.
+        for class_id, name_id in sorted(self.loaded.items()):
+            name = self.strings.get(name_id)
+            if name is not None:
+                yield class_id, name.replace(b'/', b'.')
+
+
+def _is_current(path, index_path):
+    # Returns True if index_path indexes the current content of path.
+    try:
+        with open(index_path, 'rb') as f:
+            header = f.read(_HEADER.size)
+    except (IOError, OSError):
+        return False
+    if len(header) < _HEADER.size:
+        return False
+    header = _HEADER.unpack(header)
+    stat = os.stat(path)
+    return (header[:2] == (_MAGIC, _FORMAT_VERSION) and
+            header[3:5] == (stat.st_size, int(stat.st_mtime)))
+
+
+def _read_records(path):
+    unpack_from = _RECORD.unpack_from
+    size = _RECORD.size
+    with open(path, 'rb') as f:
+        while True:
+            chunk = f.read(size * _IO_RECORDS)
+            if not chunk:
+                return
+            for record in [unpack_from(chunk, pos)
+                           for pos in range(0, len(chunk), size)]:
+                yield record
+
+
+def _write_records(records, out):
+    # Returns the number of records written.
+    pack = _RECORD.pack
+    records = iter(records)
+    count = 0
+    while True:
+        chunk = [pack(*r) for r in itertools.islice(records, _IO_RECORDS)]
+        if not chunk:
+            return count
+        out.write(b''.join(chunk))
+        count += len(chunk)
+
+
+def _write_sorted(path, out, tmp_dir, key, accept=None):
+    # Writes the records of path that accept returns True for, sorted by
+    # key. Runs of records are sorted in memory, spilled to tmp_dir and
+    # merged. Returns the number of records written.
+    runs = []
+    run = []
+    for record in _read_records(path):
+        if accept is None or accept(record):
+            run.append(record)
+            if len(run) == _SORT_RUN:
+                runs.append(_spill(run, key, tmp_dir, len(runs)))
+                run = []
+    if not runs:
+        run.sort(key=key)
+        return _write_records(run, out)
+    if run:
+        runs.append(_spill(run, key, tmp_dir, len(runs)))
+    try:
+        merged = heapq.merge(*[((key(r), r) for r in _read_records(run_path))
+                               for run_path in runs])
+        return _write_records((r for _, r in merged), out)
+    finally:
+        for run_path in runs:
+            os.remove(run_path)
+
+
+def _spill(run, key, tmp_dir, number):
+    run.sort(key=key)
+    run_path = os.path.join(tmp_dir, 'run%d' % number)
+    with open(run_path, 'wb') as out:
+        _write_records(run, out)
+    return run_path
+
+
+def _is_str(value):
+    try:
+        return isinstance(value, basestring)
+    except NameError:
+        return isinstance(value, str)
@@ -0,0 +1,600 @@
+"""
+Streaming hprof heap dump conversion and traversal.
+
+Android writes heap dumps in its own flavour of the hprof format, which
+tools such as MAT can't open. convert() turns them into standard J2SE
+hprof, the same way the SDK hprof-conv tool does, reading records
+incrementally through a fixed-size buffer. Memory use does not depend on
+the dump size.
+
+walk() reads a dump the same way and hands its records to a HeapVisitor,
+for analyses that need a single pass over the heap.
+"""
+
+import struct
+
+# Format version strings
+ANDROID_VERSION = b'JAVA PROFILE 1.0.3'
+J2SE_VERSION = b'JAVA PROFILE 1.0.2'
+
+# Top level record tags
+TAG_STRING = 0x01
+TAG_LOAD_CLASS = 0x02
+TAG_HEAP_DUMP = 0x0c
+TAG_HEAP_DUMP_SEGMENT = 0x1c
+TAG_HEAP_DUMP_END = 0x2c
+
+# Heap dump sub-record tags
+ROOT_UNKNOWN = 0xff
+ROOT_JNI_GLOBAL = 0x01
+ROOT_JNI_LOCAL = 0x02
+ROOT_JAVA_FRAME = 0x03
+ROOT_NATIVE_STACK = 0x04
+ROOT_STICKY_CLASS = 0x05
+ROOT_THREAD_BLOCK = 0x06
+ROOT_MONITOR_USED = 0x07
+ROOT_THREAD_OBJECT = 0x08
+CLASS_DUMP = 0x20
+INSTANCE_DUMP = 0x21
+OBJECT_ARRAY_DUMP = 0x22
+PRIMITIVE_ARRAY_DUMP = 0x23
+
+# Android specific heap dump sub-record tags
+ROOT_INTERNED_STRING = 0x89
+ROOT_FINALIZING = 0x8a
+ROOT_DEBUGGER = 0x8b
+ROOT_REFERENCE_CLEANUP = 0x8c
+ROOT_VM_INTERNAL = 0x8d
+ROOT_JNI_MONITOR = 0x8e
+UNREACHABLE = 0x90
+PRIMITIVE_ARRAY_NODATA_DUMP = 0xc3
+HEAP_DUMP_INFO = 0xfe
+
+# Basic type codes
+TYPE_OBJECT = 2
+
+# Sizes of the basic types by type code. Objects are id sized.
+TYPE_SIZES = {4: 1, 5: 2, 6: 4, 7: 8, 8: 1, 9: 2, 10: 4, 11: 8}
+
+# Bytes read from the source at once
+_BUFFER_SIZE = 1 << 16
+
+# Converted sub-records are gathered into heap dump segments of about this
+# many bytes. Bigger sub-records are streamed in a segment of their own.
+_SEGMENT_SIZE = 1 << 16
+
+_U1 = struct.Struct('>B')
+_U2 = struct.Struct('>H')
+_U4 = struct.Struct('>I')
+_RECORD = struct.Struct('>BII')
+
+
+class HprofError(Exception):
+    """Raised when a heap dump is malformed or truncated."""
+
+
+class Buffer(object):
+    """
+    Reads a binary stream through a fixed-size buffer.
+
+    Args:
+        fileobj: binary file-like object with a read method.
+        size: number of bytes read from fileobj at once.
+    """
+
+    def __init__(self, fileobj, size=_BUFFER_SIZE):
+        self.fileobj = fileobj
+        self.size = size
+        self.data = bytearray()
+        self.pos = 0
+        # Stream offset of data[0]
+        self.base = 0
+
+    def tell(self):
+        """Return the stream offset of the next unread byte."""
+        return self.base + self.pos
+
+    def ensure(self, count):
+        """
+        Make count bytes available at pos. Returns False if the stream
+        ends first.
+        """
+        available = len(self.data) - self.pos
+        if available >= count:
+            return True
+        chunks = [self.data[self.pos:]]
+        self.base += self.pos
+        self.pos = 0
+        while available < count:
+            chunk = self.fileobj.read(max(self.size, count - available))
+            if not chunk:
+                break
+            chunks.append(chunk)
+            available += len(chunk)
+        self.data = bytearray().join(chunks)
+        return available >= count
+
+    def read(self, count):
+        """Return the next count bytes."""
+        if not self.ensure(count):
+            raise HprofError('unexpected end of heap dump at %d' % self.tell())
+        start = self.pos
+        self.pos += count
+        return self.data[start:self.pos]
+
+    def unpack(self, st):
+        """Read and unpack a struct.Struct, returning the value tuple."""
+        if not self.ensure(st.size):
+            raise HprofError('unexpected end of heap dump at %d' % self.tell())
+        values = st.unpack_from(self.data, self.pos)
+        self.pos += st.size
+        return values
+
+    def u1(self):
+        return self.unpack(_U1)[0]
+
+    def u2(self):
+        return self.unpack(_U2)[0]
+
+    def u4(self):
+        return self.unpack(_U4)[0]
+
+    def copy(self, count, write):
+        """Pass the next count bytes to write, a buffer at a time."""
+        while count > 0:
+            chunk = self.read(min(count, self.size))
+            write(chunk)
+            count -= len(chunk)
+
+    def skip(self, count):
+        """Drop the next count bytes."""
+        available = len(self.data) - self.pos
+        if count <= available:
+            self.pos += count
+            return
+        self.pos = len(self.data)
+        self.copy(count - available, lambda chunk: None)
+
+
+def read_header(buf):
+    """
+    Read a heap dump header.
+
+    Returns:
+        a (version, id size, timestamp) tuple.
+    """
+    version = bytearray()
+    while True:
+        byte = buf.read(1)
+        if byte == b'\0':
+            break
+        version += byte
+        if len(version) > 32:
+            raise HprofError('not a heap dump')
+    version = bytes(version)
+    if not version.startswith(b'JAVA PROFILE 1.0'):
+        raise HprofError('not a heap dump')
+    id_size = buf.u4()
+    if id_size not in (4, 8):
+        raise HprofError('unsupported id size %d' % id_size)
+    return version, id_size, bytes(buf.read(8))
+
+
+def convert(src, dst, buffer_size=_BUFFER_SIZE):
+    """
+    Convert an Android heap dump into a standard J2SE one.
+
+    Android specific roots become unknown roots, heap info records are
+    dropped and primitive arrays dumped without data are filled with
+    zeros. Standard heap dumps pass through unchanged.
+
+    Args:
+        src: binary file-like object the Android heap dump is read from.
+        dst: binary file-like object the converted heap dump is written to.
+        buffer_size: number of bytes read from src at once.
+    Raises:
+        HprofError: if src is not a heap dump, or it is truncated.
+    """
+    buf = Buffer(src, buffer_size)
+    version, id_size, timestamp = read_header(buf)
+    if version == ANDROID_VERSION:
+        version = J2SE_VERSION
+    dst.write(version + b'\0' + _U4.pack(id_size) + timestamp)
+    converter = _SegmentConverter(buf, dst, id_size)
+    while buf.ensure(_RECORD.size):
+        tag, time, length = buf.unpack(_RECORD)
+        if tag in (TAG_HEAP_DUMP, TAG_HEAP_DUMP_SEGMENT):
+            converter.convert(time, length)
+            if tag == TAG_HEAP_DUMP:
+                # Converted heap dumps are always split into segments.
+                dst.write(_RECORD.pack(TAG_HEAP_DUMP_END, time, 0))
+        else:
+            dst.write(_RECORD.pack(tag, time, length))
+            buf.copy(length, dst.write)
+    if buf.ensure(1):
+        raise HprofError('unexpected end of heap dump at %d' % buf.tell())
+
+
+def _root_sizes(id_size):
+    # Returns the body sizes of standard and of Android root sub-records,
+    # as two dicts keyed by tag.
+    standard = {
+        ROOT_UNKNOWN: id_size,
+        ROOT_JNI_GLOBAL: 2 * id_size,
+        ROOT_JNI_LOCAL: id_size + 8,
+        ROOT_JAVA_FRAME: id_size + 8,
+        ROOT_NATIVE_STACK: id_size + 4,
+        ROOT_STICKY_CLASS: id_size,
+        ROOT_THREAD_BLOCK: id_size + 4,
+        ROOT_MONITOR_USED: id_size,
+        ROOT_THREAD_OBJECT: id_size + 8,
+    }
+    android = {
+        ROOT_INTERNED_STRING: id_size,
+        ROOT_FINALIZING: id_size,
+        ROOT_DEBUGGER: id_size,
+        ROOT_REFERENCE_CLEANUP: id_size,
+        ROOT_VM_INTERNAL: id_size,
+        ROOT_JNI_MONITOR: id_size + 8,
+        UNREACHABLE: id_size,
+    }
+    return standard, android
+
+
+def _type_sizes(id_size):
+    sizes = dict(TYPE_SIZES)
+    sizes[TYPE_OBJECT] = id_size
+    return sizes
+
+
+class _SegmentConverter(object):
+    # Converts the sub-records of heap dump records and writes them out as
+    # heap dump segments.
+
+    def __init__(self, buf, dst, id_size):
+        self.buf = buf
+        self.dst = dst
+        self.id_size = id_size
+        self.out = bytearray()
+        self.time = 0
+        self.fixed, self.android_roots = _root_sizes(id_size)
+        self.type_sizes = _type_sizes(id_size)
+
+    def convert(self, time, length):
+        buf = self.buf
+        self.time = time
+        end = buf.tell() + length
+        while buf.tell() < end:
+            if self.pass_through(end):
+                continue
+            tag = buf.u1()
+            if tag in self.fixed:
+                self.out += bytearray([tag]) + buf.read(self.fixed[tag])
+            elif tag in self.android_roots:
+                size = self.android_roots[tag]
+                self.out += bytearray([ROOT_UNKNOWN]) + buf.read(self.id_size)
+                buf.skip(size - self.id_size)
+            elif tag == INSTANCE_DUMP:
+                head = buf.read(2 * self.id_size + 8)
+                count = _U4.unpack_from(head, len(head) - 4)[0]
+                self.sub_record(tag, head, count)
+            elif tag == OBJECT_ARRAY_DUMP:
+                head = buf.read(2 * self.id_size + 8)
+                count = _U4.unpack_from(head, self.id_size + 4)[0]
+                self.sub_record(tag, head, count * self.id_size)
+            elif tag == PRIMITIVE_ARRAY_DUMP:
+                head = buf.read(self.id_size + 9)
+                count, kind = struct.unpack_from('>IB', head, self.id_size + 4)
+                self.sub_record(tag, head, count * self.type_size(kind))
+            elif tag == PRIMITIVE_ARRAY_NODATA_DUMP:
+                head = buf.read(self.id_size + 9)
+                count, kind = struct.unpack_from('>IB', head, self.id_size + 4)
+                self.sub_record(PRIMITIVE_ARRAY_DUMP, head,
+                                count * self.type_size(kind), zeros=True)
+            elif tag == CLASS_DUMP:
+                self.class_dump()
+            elif tag == HEAP_DUMP_INFO:
+                buf.skip(4 + self.id_size)
+            else:
+                raise HprofError('unknown heap dump sub-record 0x%02x at %d'
+                                 % (tag, buf.tell() - 1))
+            if len(self.out) >= _SEGMENT_SIZE:
+                self.flush()
+        if buf.tell() != end:
+            raise HprofError('heap dump sub-record crosses its record end')
+        self.flush()
+
+    def pass_through(self, end):
+        # Copies the run of buffered sub-records that need no conversion in
+        # one go, which is most of a heap dump. Returns False if there is
+        # no such run at the current position.
+        buf = self.buf
+        data = buf.data
+        start = pos = buf.pos
+        limit = min(len(data), pos + end - buf.tell())
+        id_size = self.id_size
+        fixed = self.fixed
+        type_sizes = self.type_sizes
+        unpack_u4 = _U4.unpack_from
+        instance_head = 2 * id_size + 9
+        array_head = id_size + 10
+        while pos < limit:
+            tag = data[pos]
+            if tag == INSTANCE_DUMP:
+                if pos + instance_head > limit:
+                    break
+                size = instance_head + unpack_u4(data,
+                                                 pos + instance_head - 4)[0]
+            elif tag in fixed:
+                size = 1 + fixed[tag]
+            elif tag == OBJECT_ARRAY_DUMP:
+                if pos + array_head > limit:
+                    break
+                count = unpack_u4(data, pos + id_size + 5)[0]
+                size = 2 * id_size + 9 + count * id_size
+            elif tag == PRIMITIVE_ARRAY_DUMP:
+                if pos + array_head > limit:
+                    break
+                count = unpack_u4(data, pos + id_size + 5)[0]
+                kind = data[pos + id_size + 9]
+                if kind not in type_sizes:
+                    break
+                size = array_head + count * type_sizes[kind]
+            else:
+                break
+            if pos + size > limit:
+                break
+            pos += size
+        if pos == start:
+            return False
+        self.out += data[start:pos]
+        buf.pos = pos
+        if len(self.out) >= _SEGMENT_SIZE:
+            self.flush()
+        return True
+
+    def type_size(self, kind):
+        try:
+            return self.type_sizes[kind]
+        except KeyError:
+            raise HprofError('unknown basic type %d' % kind)
+
+    def sub_record(self, tag, head, size, zeros=False):
+        # A sub-record with a fixed head, followed by size bytes of data.
+        if size < _SEGMENT_SIZE:
+            self.out += bytearray([tag]) + head
+            if zeros:
+                self.out += bytearray(size)
+            else:
+                self.out += self.buf.read(size)
+            return
+        self.flush()
+        self.dst.write(_RECORD.pack(TAG_HEAP_DUMP_SEGMENT, self.time,
+                                    1 + len(head) + size))
+        self.dst.write(bytearray([tag]) + head)
+        if zeros:
+            while size > 0:
+                chunk = min(size, _SEGMENT_SIZE)
+                self.dst.write(bytearray(chunk))
+                size -= chunk
+        else:
+            self.buf.copy(size, self.dst.write)
+
+    def class_dump(self):
+        buf = self.buf
+        id_size = self.id_size
+        out = self.out
+        out += bytearray([CLASS_DUMP]) + buf.read(7 * id_size + 8)
+        # Constant pool: index, type, value
+        count = buf.u2()
+        out += _U2.pack(count)
+        for _ in range(count):
+            head = buf.read(3)
+            out += head
+            out += buf.read(self.type_size(bytearray(head)[2]))
+        # Static fields: name, type, value
+        count = buf.u2()
+        out += _U2.pack(count)
+        for _ in range(count):
+            head = buf.read(id_size + 1)
+            out += head
+            out += buf.read(self.type_size(bytearray(head)[id_size]))
+        # Instance fields: name, type
+        count = buf.u2()
+        out += _U2.pack(count)
+        out += buf.read(count * (id_size + 1))
+
+    def flush(self):
+        if self.out:
+            self.dst.write(_RECORD.pack(TAG_HEAP_DUMP_SEGMENT, self.time,
+                                        len(self.out)))
+            self.dst.write(self.out)
+            self.out = bytearray()
+
+
+class HeapVisitor(object):
+    """
+    Receives the records of a heap dump from walk(). Every method does
+    nothing by default, subclasses override the ones they need.
+
+    Offsets are stream offsets of the sub-record tag byte. Instance and
+    object array data is passed only if want_data is True, None otherwise.
+    """
+
+    want_data = False
+
+    def header(self, version, id_size):
+        pass
+
+    def string(self, string_id, value):
+        pass
+
+    def load_class(self, class_id, name_id):
+        pass
+
+    def root(self, tag, object_id):
+        pass
+
+    def class_dump(self, offset, class_id, super_id, instance_size, statics,
+                   fields):
+        # statics is a list of (name id, type, value) tuples, fields a list
+        # of (name id, type) tuples.
+        pass
+
+    def instance(self, offset, object_id, class_id, size, data):
+        pass
+
+    def object_array(self, offset, object_id, class_id, count, data):
+        pass
+
+    def primitive_array(self, offset, object_id, kind, count):
+        pass
+
+
+def walk(src, visitor, buffer_size=_BUFFER_SIZE):
+    """
+    Read a heap dump, Android or standard, passing its strings, classes,
+    roots and objects to a HeapVisitor.
+
+    Args:
+        src: binary file-like object the heap dump is read from.
+        visitor: HeapVisitor.
+        buffer_size: number of bytes read from src at once.
+    Raises:
+        HprofError: if src is not a heap dump, or it is malformed.
+    """
+    buf = Buffer(src, buffer_size)
+    version, id_size, _ = read_header(buf)
+    visitor.header(version, id_size)
+    walker = _Walker(buf, visitor, id_size)
+    while buf.ensure(_RECORD.size):
+        tag, _, length = buf.unpack(_RECORD)
+        if tag in (TAG_HEAP_DUMP, TAG_HEAP_DUMP_SEGMENT):
+            walker.walk(length)
+        elif tag == TAG_STRING:
+            string_id = walker.ident()
+            visitor.string(string_id, bytes(buf.read(length - id_size)))
+        elif tag == TAG_LOAD_CLASS:
+            buf.skip(4)
+            class_id = walker.ident()
+            buf.skip(4)
+            visitor.load_class(class_id, walker.ident())
+        else:
+            buf.skip(length)
+    if buf.ensure(1):
+        raise HprofError('unexpected end of heap dump at %d' % buf.tell())
+
+
+class _Walker(object):
+    # Reads heap dump sub-records and passes them to a HeapVisitor.
+
+    def __init__(self, buf, visitor, id_size):
+        self.buf = buf
+        self.visitor = visitor
+        self.id_size = id_size
+        self.id_struct = struct.Struct('>I' if id_size == 4 else '>Q')
+        standard, android = _root_sizes(id_size)
+        self.roots = dict(standard)
+        self.roots.update(android)
+        self.type_sizes = _type_sizes(id_size)
+        self.value_structs = {
+            TYPE_OBJECT: self.id_struct,
+            4: struct.Struct('>B'), 5: struct.Struct('>H'),
+            6: struct.Struct('>f'), 7: struct.Struct('>d'),
+            8: struct.Struct('>b'), 9: struct.Struct('>h'),
+            10: struct.Struct('>i'), 11: struct.Struct('>q'),
+        }
+        i = 'I' if id_size == 4 else 'Q'
+        # Heads of instances (id, serial, class id, size), object arrays (id,
+        # serial, count, class id) and primitive arrays (id, serial, count,
+        # type).
+        self.instance_head = struct.Struct('>%sI%sI' % (i, i))
+        self.array_head = struct.Struct('>%sII%s' % (i, i))
+        self.primitive_head = struct.Struct('>%sIIB' % i)
+
+    def ident(self):
+        return self.buf.unpack(self.id_struct)[0]
+
+    def walk(self, length):
+        buf = self.buf
+        visitor = self.visitor
+        want_data = visitor.want_data
+        id_size = self.id_size
+        roots = self.roots
+        end = buf.tell() + length
+        while True:
+            offset = buf.tell()
+            if offset >= end:
+                break
+            if not buf.ensure(1):
+                raise HprofError('unexpected end of heap dump at %d' % offset)
+            # Inlined buf.u1(), this loop runs once per object.
+            tag = buf.data[buf.pos]
+            buf.pos += 1
+            if tag == INSTANCE_DUMP:
+                object_id, _, class_id, size = buf.unpack(self.instance_head)
+                if want_data:
+                    data = bytes(buf.read(size))
+                else:
+                    data = None
+                    buf.skip(size)
+                visitor.instance(offset, object_id, class_id, size, data)
+            elif tag in roots:
+                object_id = self.ident()
+                buf.skip(roots[tag] - id_size)
+                visitor.root(tag, object_id)
+            elif tag == OBJECT_ARRAY_DUMP:
+                object_id, _, count, class_id = buf.unpack(self.array_head)
+                if want_data:
+                    data = bytes(buf.read(count * id_size))
+                else:
+                    data = None
+                    buf.skip(count * id_size)
+                visitor.object_array(offset, object_id, class_id, count, data)
+            elif tag in (PRIMITIVE_ARRAY_DUMP, PRIMITIVE_ARRAY_NODATA_DUMP):
+                object_id, _, count, kind = buf.unpack(self.primitive_head)
+                size = count * self.type_size(kind)
+                if tag == PRIMITIVE_ARRAY_DUMP:
+                    buf.skip(size)
+                visitor.primitive_array(offset, object_id, kind, count)
+            elif tag == CLASS_DUMP:
+                self.class_dump(offset)
+            elif tag == HEAP_DUMP_INFO:
+                buf.skip(4 + id_size)
+            else:
+                raise HprofError('unknown heap dump sub-record 0x%02x at %d'
+                                 % (tag, offset))
+        if offset != end:
+            raise HprofError('heap dump sub-record crosses its record end')
+
+    def type_size(self, kind):
+        try:
+            return self.type_sizes[kind]
+        except KeyError:
+            raise HprofError('unknown basic type %d' % kind)
+
+    def value(self, kind):
+        self.type_size(kind)
+        return self.buf.unpack(self.value_structs[kind])[0]
+
+    def class_dump(self, offset):
+        buf = self.buf
+        class_id = self.ident()
+        buf.skip(4)
+        super_id = self.ident()
+        buf.skip(5 * self.id_size)
+        instance_size = buf.u4()
+        for _ in range(buf.u2()):
+            buf.skip(2)
+            buf.skip(self.type_size(buf.u1()))
+        statics = []
+        for _ in range(buf.u2()):
+            name_id = self.ident()
+            kind = buf.u1()
+            statics.append((name_id, kind, self.value(kind)))
+        fields = []
+        for _ in range(buf.u2()):
+            name_id = self.ident()
+            fields.append((name_id, buf.u1()))
+        self.visitor.class_dump(offset, class_id, super_id, instance_size,
+                                statics, fields)
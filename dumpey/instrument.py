@@ -0,0 +1,261 @@
+"""
+Timing of the adb calls and other phases of a Dumpey run.
+
+Once enable() is called, every adb command, converter run and wait for a
+device file is recorded with its kind, e.g. 'adb shell dumpsys' or
+'adb pull', its device, wall time, exit status and the bytes it
+transferred. write_report() prints a latency histogram and a throughput
+summary per kind, write_json() exports the calls to compare runs.
+
+Recording is off by default. Instrumented code calls begin(), which then
+only checks a module variable and returns None.
+"""
+
+from bisect import bisect_right
+import collections
+import threading
+import timeit
+import json
+import time
+import os
+
+# Set by enable
+recorder = None
+
+# A recorded call. start is seconds since the epoch, seconds the wall time.
+# status is None if the call raised before it finished, size None if its
+# bytes were not counted.
+Call = collections.namedtuple('Call',
+                              'kind device start seconds status size')
+
+# Upper bounds of the latency histogram buckets, in milliseconds
+BUCKETS = (1, 3, 10, 30, 100, 300, 1000, 3000, 10000)
+
+_JSON_VERSION = 1
+
+
+def enable():
+    """Start recording, and return the new Recorder."""
+    global recorder
+    recorder = Recorder()
+    return recorder
+
+
+def disable():
+    """Stop recording, and return the Recorder that was in use, if any."""
+    global recorder
+    previous, recorder = recorder, None
+    return previous
+
+
+def begin(args=None, kind=None, device=None):
+    """
+    Start timing a call, if recording is on.
+
+    Args:
+        args: command as list, its kind and device are read from it.
+        kind: kind of the call as string, read from args if not given.
+        device: device serial as string, read from args if not given.
+    Returns:
+        a _Timer to end() once the call is done, or None if recording is
+        off.
+    """
+    current = recorder
+    if current is None:
+        return None
+    if kind is None:
+        kind = command_kind(args)
+    if device is None and args is not None:
+        device = _device(args)
+    return _Timer(current, kind, device)
+
+
+def command_kind(args):
+    """
+    Return the kind of a command: the executable name, followed by the adb
+    command and the shell command run, if any. Batched shell sessions are
+    'adb shell batch'.
+
+    Args:
+        args: command as list, e.g.
+              ['adb', '-s', 'serial', 'shell', 'dumpsys', 'meminfo', 'p'].
+    """
+    name = os.path.basename(args[0]) if args else ''
+    if name.endswith('.exe'):
+        name = name[:-4]
+    if name != 'adb':
+        return name
+    rest = list(args[1:])
+    if rest[:1] == ['-s']:
+        rest = rest[2:]
+    kind = ['adb'] + rest[:1]
+    if rest[:1] in (['shell'], ['exec-out']) and len(rest) > 1:
+        words = rest[1].split()
+        if '_dumpey_' in rest[1]:
+            kind.append('batch')
+        elif words:
+            kind.append(words[0])
+    return ' '.join(kind)
+
+
+class Recorder(object):
+    """
+    Recorded calls of a run. Safe to use from multiple threads.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self._calls = []
+        self._lock = threading.Lock()
+
+    def record(self, kind, device, start, seconds, status=0, size=None):
+        """Record a call, see Call."""
+        call = Call(kind, device, start, seconds, status, size)
+        with self._lock:
+            self._calls.append(call)
+
+    def calls(self):
+        """Return the list of recorded Calls, in the order they ended."""
+        with self._lock:
+            return list(self._calls)
+
+    def summary(self):
+        """
+        Return a dict of call kinds to their statistics: calls, errors,
+        total, p50, p90 and max seconds, bytes and bytes per second, and
+        the histogram, a call count per BUCKETS entry and one for slower
+        calls.
+        """
+        by_kind = collections.defaultdict(list)
+        for call in self.calls():
+            by_kind[call.kind].append(call)
+        summary = {}
+        for kind, calls in by_kind.items():
+            times = sorted(c.seconds for c in calls)
+            counted = [c for c in calls if c.size is not None]
+            size = sum(c.size for c in counted)
+            counted_time = sum(c.seconds for c in counted)
+            histogram = [0] * (len(BUCKETS) + 1)
+            for seconds in times:
+                histogram[bisect_right(BUCKETS, seconds * 1000)] += 1
+            summary[kind] = {
+                'calls': len(calls),
+                'errors': sum(1 for c in calls if c.status != 0),
+                'total': sum(times),
+                'p50': _percentile(times, 0.5),
+                'p90': _percentile(times, 0.9),
+                'max': times[-1],
+                'bytes': size if counted else None,
+                'throughput': (size / counted_time
+                               if counted and counted_time else None),
+                'histogram': histogram,
+            }
+        return summary
+
+
+def write_report(out, recorder):
+    """
+    Write a text report of a Recorder: the time and bytes of each call
+    kind, the slowest total first, then their latency histograms.
+
+    Args:
+        out: text file-like object.
+        recorder: Recorder.
+    """
+    summary = recorder.summary()
+    kinds = sorted(summary, key=lambda k: (-summary[k]['total'], k))
+    width = max([len(k) for k in kinds] + [4])
+    out.write('%-*s %6s %6s %9s %8s %8s %8s %9s %8s\n'
+              % (width, 'kind', 'calls', 'errors', 'total s', 'p50 ms',
+                 'p90 ms', 'max ms', 'MB', 'MB/s'))
+    for kind in kinds:
+        s = summary[kind]
+        out.write('%-*s %6d %6d %9.2f %8.1f %8.1f %8.1f %9s %8s\n'
+                  % (width, kind, s['calls'], s['errors'], s['total'],
+                     s['p50'] * 1000, s['p90'] * 1000, s['max'] * 1000,
+                     _megabytes(s['bytes']), _megabytes(s['throughput'])))
+    labels = ['<%s' % _ms_label(b) for b in BUCKETS]
+    labels.append('>=%s' % _ms_label(BUCKETS[-1]))
+    out.write('\nlatency histogram, calls per bucket in ms\n')
+    out.write('%-*s %s\n' % (width, 'kind',
+                             ' '.join('%6s' % l for l in labels)))
+    for kind in kinds:
+        out.write('%-*s %s\n' % (width, kind, ' '.join(
+            '%6s' % (n or '.') for n in summary[kind]['histogram'])))
+
+
+def write_json(out, recorder):
+    """
+    Write the calls and the summary of a Recorder as a JSON object.
+
+    Args:
+        out: text file-like object.
+        recorder: Recorder.
+    """
+    data = {
+        'version': _JSON_VERSION,
+        'started': recorder.started,
+        'buckets': list(BUCKETS),
+        'summary': recorder.summary(),
+        'calls': [call._asdict() for call in recorder.calls()],
+    }
+    json.dump(data, out, indent=1, sort_keys=True)
+    out.write('\n')
+
+
+class CountingReader(object):
+    """
+    Wraps a binary file object, counting the bytes read from it.
+    """
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.count += len(data)
+        return data
+
+    def readinto(self, b):
+        n = self.f.readinto(b)
+        self.count += n or 0
+        return n
+
+    def __getattr__(self, name):
+        return getattr(self.f, name)
+
+
+class _Timer(object):
+
+    def __init__(self, recorder, kind, device):
+        self.recorder = recorder
+        self.kind = kind
+        self.device = device
+        self.start = time.time()
+        self.clock = timeit.default_timer()
+
+    def end(self, status=0, size=None):
+        self.recorder.record(self.kind, self.device, self.start,
+                             timeit.default_timer() - self.clock, status,
+                             size)
+
+
+def _device(args):
+    try:
+        return args[args.index('-s') + 1]
+    except (ValueError, IndexError):
+        return None
+
+
+def _percentile(values, fraction):
+    # values are sorted
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def _megabytes(value):
+    return '-' if value is None else '%.2f' % (value / 1e6)
+
+
+def _ms_label(ms):
+    return '%dk' % (ms // 1000) if ms >= 1000 else str(ms)
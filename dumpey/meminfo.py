@@ -0,0 +1,247 @@
+"""
+Memory usage of app processes, from dumpsys meminfo.
+
+parse() reads the total PSS, Java heap, native heap and graphics memory of
+a process from the output of 'dumpsys meminfo <package>'. Sampler polls it
+on a thread of its own, e.g. while the monkey runs, into a MemorySeries: a
+compact columnar time series written as CSV or NDJSON.
+
+write_usage() writes the memory use of many packages on many devices at
+once, as a table sorted by PSS, or as CSV or NDJSON rows.
+"""
+
+from array import array
+import threading
+import json
+import time
+import re
+
+try:
+    array('q')
+    _LONG = 'q'
+except ValueError:
+    _LONG = 'l'
+
+# Sampled values, in kilobytes
+FIELDS = ('pss', 'java_heap', 'native_heap', 'graphics')
+
+# Output formats of MemorySeries.write
+CSV = 'csv'
+NDJSON = 'ndjson'
+FORMATS = (CSV, NDJSON)
+
+# Stored in place of values missing from a sample
+_MISSING = -1
+
+# App summary lines, Android 6.0 and later. Newer versions add an RSS
+# column after the PSS one.
+_SUMMARY = {
+    'pss': re.compile(r'^\s*TOTAL(?: PSS)?:\s+(\d+)', re.M),
+    'java_heap': re.compile(r'^\s*Java Heap:\s+(\d+)', re.M),
+    'native_heap': re.compile(r'^\s*Native Heap:\s+(\d+)', re.M),
+    'graphics': re.compile(r'^\s*Graphics:\s+(\d+)', re.M),
+}
+
+# Rows of the detailed table, whose first column is the PSS total, for
+# older versions. Graphics memory is the sum of the graphics rows.
+_TABLE = {
+    'pss': re.compile(r'^\s*TOTAL\s+(\d+)', re.M),
+    'java_heap': re.compile(r'^\s*Dalvik Heap\s+(\d+)', re.M),
+    'native_heap': re.compile(r'^\s*Native Heap\s+(\d+)', re.M),
+}
+_GRAPHICS_ROWS = re.compile(r'^\s*(?:Gfx dev|EGL mtrack|GL mtrack)\s+(\d+)',
+                            re.M)
+
+
+def parse(output):
+    """
+    Parse the output of 'dumpsys meminfo <package>'.
+
+    Args:
+        output: command output as string.
+    Returns:
+        a dict of FIELDS to kilobytes as int, None for values the output
+        lacks, or None if the output holds no process memory info, e.g. if
+        the process is not running.
+    """
+    sample = {}
+    for field in FIELDS:
+        match = _SUMMARY[field].search(output)
+        if match is None and field in _TABLE:
+            match = _TABLE[field].search(output)
+        sample[field] = int(match.group(1)) if match else None
+    if sample['graphics'] is None:
+        rows = _GRAPHICS_ROWS.findall(output)
+        if rows:
+            sample['graphics'] = sum(int(row) for row in rows)
+    if sample['pss'] is None:
+        return None
+    return sample
+
+
+def write_usage(out, usage, fmt=None, timestamp=None, header=True):
+    """
+    Write the memory use of packages on devices, largest PSS first.
+
+    Args:
+        out: text file-like object.
+        usage: dict of device serials to dicts of package names to samples,
+               as returned by dumpey.memory_usage.
+        fmt: one of FORMATS, or None for a text table.
+        timestamp: seconds since the epoch as float, added to each CSV or
+                   NDJSON row if given.
+        header: boolean, write the CSV or table header line.
+    """
+    rows = sorted(((device, package, sample)
+                   for device, samples in usage.items()
+                   for package, sample in samples.items()),
+                  key=lambda r: (-(r[2].get('pss') or 0), r[0], r[1]))
+    keys = ('time',) if timestamp is not None else ()
+    keys += ('device', 'package') + FIELDS
+    if fmt is None:
+        if header:
+            out.write('%10s %10s %10s %10s  %s\n'
+                      % ('pss', 'java', 'native', 'graphics',
+                         'device / package'))
+        for device, package, sample in rows:
+            values = tuple('-' if sample.get(f) is None else sample[f]
+                           for f in FIELDS)
+            out.write('%10s %10s %10s %10s  %s / %s\n'
+                      % (values + (device, package)))
+    elif fmt == CSV:
+        if header:
+            out.write(','.join(keys) + '\n')
+        for device, package, sample in rows:
+            values = [device, package] + [
+                '' if sample.get(f) is None else str(sample[f])
+                for f in FIELDS]
+            if timestamp is not None:
+                values.insert(0, '%.3f' % timestamp)
+            out.write(','.join(values) + '\n')
+    elif fmt == NDJSON:
+        for device, package, sample in rows:
+            row = dict(sample, device=device, package=package)
+            if timestamp is not None:
+                row['time'] = round(timestamp, 3)
+            out.write(json.dumps(row, sort_keys=True) + '\n')
+    else:
+        raise Exception('unknown format %s, expected one of %s'
+                        % (fmt, ', '.join(FORMATS)))
+
+
+class MemorySeries(object):
+    """
+    A time series of memory samples, stored in a column per field.
+    """
+
+    def __init__(self):
+        self.times = array('d')
+        self.columns = dict((field, array(_LONG)) for field in FIELDS)
+
+    def add(self, timestamp, sample):
+        """
+        Append a sample.
+
+        Args:
+            timestamp: seconds since the epoch, as float.
+            sample: dict of FIELDS to kilobytes, as returned by parse().
+        """
+        self.times.append(timestamp)
+        for field in FIELDS:
+            value = sample.get(field)
+            self.columns[field].append(_MISSING if value is None else value)
+
+    def __len__(self):
+        return len(self.times)
+
+    def __iter__(self):
+        """Yield (timestamp, sample) tuples, oldest first."""
+        for i, timestamp in enumerate(self.times):
+            yield timestamp, dict((field, self._value(field, i))
+                                  for field in FIELDS)
+
+    def write(self, out, fmt=CSV):
+        """
+        Write the series, a line per sample.
+
+        Args:
+            out: text file-like object.
+            fmt: one of FORMATS. CSV has a header line and leaves missing
+                 values empty, NDJSON writes them as null.
+        """
+        if fmt == CSV:
+            out.write(','.join(('time',) + FIELDS) + '\n')
+            for timestamp, sample in self:
+                values = ['' if sample[f] is None else str(sample[f])
+                          for f in FIELDS]
+                out.write(','.join(['%.3f' % timestamp] + values) + '\n')
+        elif fmt == NDJSON:
+            for timestamp, sample in self:
+                sample['time'] = round(timestamp, 3)
+                out.write(json.dumps(sample, sort_keys=True) + '\n')
+        else:
+            raise Exception('unknown format %s, expected one of %s'
+                            % (fmt, ', '.join(FORMATS)))
+
+    def _value(self, field, i):
+        value = self.columns[field][i]
+        return None if value == _MISSING else value
+
+
+class Sampler(object):
+    """
+    Samples the memory of packages on devices at an interval, each on a
+    thread of its own, between start() and stop(). Samples that fail, or
+    that are taken while the process is not running, are skipped.
+
+    Args:
+        query: function of a package name and a device serial, returning
+               the output of 'dumpsys meminfo <package>' on that device.
+        interval: seconds between samples, as float.
+    """
+
+    def __init__(self, query, interval):
+        self.query = query
+        self.interval = interval
+        self._running = {}
+        self._lock = threading.Lock()
+
+    def start(self, package, device):
+        """Start sampling a package on a device."""
+        series = MemorySeries()
+        stop = threading.Event()
+        thread = threading.Thread(target=self._run,
+                                  args=(package, device, series, stop))
+        thread.daemon = True
+        with self._lock:
+            self._running[(package, device)] = (thread, stop, series)
+        thread.start()
+
+    def stop(self, package, device):
+        """
+        Stop sampling a package on a device.
+
+        Returns:
+            the MemorySeries sampled, or None if it was not started.
+        """
+        with self._lock:
+            running = self._running.pop((package, device), None)
+        if running is None:
+            return None
+        thread, stop, series = running
+        stop.set()
+        thread.join()
+        return series
+
+    def _run(self, package, device, series, stop):
+        due = time.time()
+        while not stop.is_set():
+            try:
+                sample = parse(self.query(package, device))
+            except Exception:
+                sample = None
+            if sample is not None:
+                series.add(time.time(), sample)
+            # A sampler that falls behind carries on from the current time.
+            due = max(due + self.interval, time.time())
+            stop.wait(due - time.time())
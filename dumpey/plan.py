@@ -0,0 +1,242 @@
+"""
+Plans: a list of Dumpey commands run in a single process.
+
+A plan is a JSON list of steps, or an object with a "steps" list. Each
+step is a Dumpey command line, as a list of arguments or as a string, with
+an optional name and the names of the steps it runs after:
+
+    {"steps": [
+        {"name": "install", "args": ["i", "-o", "apks"]},
+        {"name": "clear", "args": "c -p com.example"},
+        {"name": "monkey", "args": "m -p com.example --dump ba",
+         "after": ["clear"]},
+        {"name": "pull", "args": "a -p com.example", "after": []}
+    ]}
+
+A step without "after" runs after the step before it, so a plain list runs
+in order. An empty "after" lets a step start right away.
+
+Steps are split into a task per device, and a task starts as soon as the
+tasks it depends on are done on the same device, so devices don't wait for
+each other. A device runs one task at a time. If a task fails, the tasks
+that depend on it are skipped.
+"""
+
+import collections
+import threading
+import shlex
+import json
+
+try:
+    _STRING_TYPES = basestring
+except NameError:
+    _STRING_TYPES = str
+
+# A plan step. args is a tuple of command line arguments, after a tuple of
+# the names of the steps it runs after.
+Step = collections.namedtuple('Step', 'name args after')
+
+# A step on one device, or on no device in particular if device is None
+Task = collections.namedtuple('Task', 'step device')
+
+# Outcome of tasks that did not run, because a task they depend on failed
+SKIPPED = 'skipped'
+
+
+class PlanError(Exception):
+    """Raised when a plan is malformed."""
+
+
+def load(path):
+    """
+    Read a plan file.
+
+    Args:
+        path: path to a JSON plan file, as string.
+    Returns:
+        a list of Steps.
+    Raises:
+        PlanError: if the plan is malformed.
+    """
+    with open(path) as f:
+        try:
+            data = json.load(f)
+        except ValueError as e:
+            raise PlanError('%s is not valid JSON: %s' % (path, e))
+    return parse(data)
+
+
+def parse(data):
+    """
+    Read the steps of a plan.
+
+    Args:
+        data: plan as a list of steps, or a dict with a 'steps' list.
+    Returns:
+        a list of Steps, in an order that has each step after the steps it
+        depends on.
+    Raises:
+        PlanError: if the plan is malformed, or has circular dependencies.
+    """
+    if isinstance(data, dict):
+        data = data.get('steps')
+    if not isinstance(data, list) or not data:
+        raise PlanError('a plan needs a list of steps')
+    steps = []
+    names = set()
+    for index, item in enumerate(data):
+        if not isinstance(item, dict):
+            item = {'args': item}
+        name = str(item.get('name', index + 1))
+        if name in names:
+            raise PlanError("step name '%s' is not unique" % name)
+        names.add(name)
+        args = item.get('args')
+        if isinstance(args, _STRING_TYPES):
+            args = shlex.split(str(args))
+        if not args or not isinstance(args, list):
+            raise PlanError("step '%s' has no command" % name)
+        after = item.get('after')
+        if after is None:
+            after = [steps[-1].name] if steps else []
+        elif not isinstance(after, list):
+            after = [after]
+        steps.append(Step(name, tuple(str(a) for a in args),
+                          tuple(str(a) for a in after)))
+    for step in steps:
+        for name in step.after:
+            if name not in names:
+                raise PlanError("step '%s' runs after unknown step '%s'"
+                                % (step.name, name))
+    return _sorted(steps)
+
+
+def tasks(steps, devices):
+    """
+    Split steps into tasks.
+
+    Args:
+        steps: list of Steps, as returned by parse.
+        devices: dict of step names to the lists of device serials they run
+                 on, or None for steps that run once.
+    Returns:
+        a dict of Tasks to the sets of Tasks they depend on. A task
+        depends on the tasks of the steps it runs after on the same device,
+        or on all of them if such a step does not run on that device.
+    """
+    by_step = collections.OrderedDict()
+    for step in steps:
+        by_step[step.name] = [Task(step, device)
+                              for device in devices.get(step.name) or [None]]
+    graph = collections.OrderedDict()
+    for step in steps:
+        for task in by_step[step.name]:
+            depends = set()
+            for name in step.after:
+                same = [t for t in by_step[name] if t.device == task.device]
+                depends.update(same if task.device is not None and same
+                               else by_step[name])
+            graph[task] = depends
+    return graph
+
+
+def run(graph, execute, max_workers):
+    """
+    Run tasks, each once the tasks it depends on are done, at most
+    max_workers at a time, and at most one at a time on a device, since
+    commands on a device share its temporary files.
+
+    Args:
+        graph: dict of Tasks to the sets of Tasks they depend on, as
+               returned by tasks.
+        execute: function of a Task that runs it.
+        max_workers: max number of tasks run at once, as int.
+    Returns:
+        a dict of Tasks to their outcome: None if they succeeded, the
+        exception they raised, or SKIPPED.
+    """
+    dependents = dict((task, []) for task in graph)
+    waiting = {}
+    for task, depends in graph.items():
+        waiting[task] = len(depends)
+        for depend in depends:
+            dependents[depend].append(task)
+    outcomes = {}
+    ready = [task for task in graph if waiting[task] == 0]
+    busy = set()
+    done = threading.Condition()
+
+    def finish(task, outcome):
+        # Called with done held. Skips the dependents of failed tasks.
+        outcomes[task] = outcome
+        for dependent in dependents[task]:
+            if dependent in outcomes:
+                continue
+            if outcome is not None:
+                finish(dependent, SKIPPED)
+                continue
+            waiting[dependent] -= 1
+            if waiting[dependent] == 0:
+                ready.append(dependent)
+        done.notify_all()
+
+    def next_task():
+        # Called with done held. Returns the first ready task whose device
+        # is idle, or None once every task is done.
+        while len(outcomes) < len(graph):
+            for task in ready:
+                if task.device not in busy:
+                    ready.remove(task)
+                    if task.device is not None:
+                        busy.add(task.device)
+                    return task
+            done.wait()
+        return None
+
+    def work():
+        while True:
+            with done:
+                task = next_task()
+            if task is None:
+                return
+            try:
+                execute(task)
+                outcome = None
+            except Exception as e:
+                outcome = e
+            with done:
+                busy.discard(task.device)
+                finish(task, outcome)
+
+    workers = [threading.Thread(target=work)
+               for _ in range(max(1, min(max_workers, len(graph))))]
+    for worker in workers:
+        worker.daemon = True
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return outcomes
+
+
+def _sorted(steps):
+    # Orders steps after the steps they depend on, keeping the plan order
+    # otherwise.
+    by_name = dict((step.name, step) for step in steps)
+    ordered = []
+    state = {}
+
+    def visit(step, path):
+        if state.get(step.name) == 'done':
+            return
+        if state.get(step.name) == 'visiting':
+            raise PlanError('circular dependency: %s'
+                            % ' -> '.join(path + [step.name]))
+        state[step.name] = 'visiting'
+        for name in step.after:
+            visit(by_name[name], path + [step.name])
+        state[step.name] = 'done'
+        ordered.append(step)
+
+    for step in steps:
+        visit(step, [])
+    return ordered
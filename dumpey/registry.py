@@ -0,0 +1,198 @@
+"""
+A registry of attached devices, kept current in the background.
+
+The registry lists the devices once when it starts, then follows the adb
+server's device tracking service, which sends the device list whenever a
+device changes state. If the server can't be reached, the device list is
+polled at an interval instead, until tracking works again.
+
+Listeners are called on every state change, including devices that go
+away and come back, from the thread that watches the devices.
+"""
+
+import traceback
+import threading
+import socket
+import time
+import sys
+
+from . import adbclient
+
+# State of devices ready for commands
+DEVICE = 'device'
+
+# Default seconds between polls of the device list
+_POLL_INTERVAL = 2.0
+
+
+def parse_devices(output):
+    """
+    Parse a device list, as printed by 'adb devices' or sent by the device
+    tracking service.
+
+    Args:
+        output: device list as string.
+    Returns:
+        a list of (serial, state) tuples, in the order listed.
+    """
+    devices = []
+    for line in output.splitlines():
+        if '\t' in line:
+            serial, state = line.split('\t', 1)
+            devices.append((serial.strip(), state.strip()))
+    return devices
+
+
+class DeviceRegistry(object):
+    """
+    Attached devices and their states, updated by a watcher thread between
+    start() and stop().
+
+    Args:
+        list_devices: function returning the device list, as 'adb devices'
+                      prints it. Used to fill the registry when it starts,
+                      and to poll it.
+        track: function returning an adbclient.DeviceTracker, or None to
+               always poll.
+        interval: seconds between polls, as float.
+    """
+
+    def __init__(self, list_devices, track=None, interval=None):
+        self.list_devices = list_devices
+        self.track = track
+        self.interval = interval or _POLL_INTERVAL
+        self._states = {}
+        self._order = []
+        self._listeners = []
+        self._condition = threading.Condition()
+        self._stop = threading.Event()
+        self._tracker = None
+        self._thread = None
+
+    def start(self):
+        """
+        List the devices, then start watching them.
+
+        Raises:
+            Exception: if the devices can't be listed.
+        """
+        self._update(parse_devices(self.list_devices()))
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        """Stop watching the devices."""
+        self._stop.set()
+        with self._condition:
+            tracker = self._tracker
+        if tracker is not None:
+            tracker.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def devices(self, state=DEVICE):
+        """
+        Return a list of serials of the devices in the given state, in the
+        order adb lists them.
+
+        Args:
+            state: device state as string, or None for every device.
+        """
+        with self._condition:
+            return [serial for serial in self._order
+                    if state is None or self._states[serial] == state]
+
+    def states(self):
+        """Return a dict of device serials to their states."""
+        with self._condition:
+            return dict(self._states)
+
+    def add_listener(self, listener):
+        """
+        Call a function whenever a device changes state.
+
+        Args:
+            listener: function of the device serial, its previous state and
+                      its new state. The previous state is None for new
+                      devices, the new state None for devices that are
+                      gone.
+        """
+        with self._condition:
+            self._listeners.append(listener)
+
+    def remove_listener(self, listener):
+        """Stop calling a function added with add_listener."""
+        with self._condition:
+            self._listeners.remove(listener)
+
+    def wait_for(self, serial, state=DEVICE, timeout=None):
+        """
+        Wait until a device is in the given state.
+
+        Args:
+            serial: device serial as string.
+            state: device state as string.
+            timeout: max number of seconds to wait, as float.
+        Returns:
+            True if the device is in the state, False on timeout.
+        """
+        end = None if timeout is None else time.time() + timeout
+        with self._condition:
+            while self._states.get(serial) != state:
+                remaining = None if end is None else end - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+    def _run(self):
+        while not self._stop.is_set():
+            if self.track is not None:
+                try:
+                    self._follow()
+                except (adbclient.AdbError, adbclient.ServerUnavailable,
+                        socket.error, ValueError):
+                    pass
+                if self._stop.is_set():
+                    return
+            try:
+                self._update(parse_devices(self.list_devices()))
+            except Exception:
+                pass
+            self._stop.wait(self.interval)
+
+    def _follow(self):
+        # Updates the registry from the device tracking service, until the
+        # connection fails or the registry stops.
+        tracker = self.track()
+        with self._condition:
+            self._tracker = tracker
+        try:
+            while not self._stop.is_set():
+                self._update(parse_devices(tracker.next()))
+        finally:
+            with self._condition:
+                self._tracker = None
+            tracker.close()
+
+    def _update(self, devices):
+        with self._condition:
+            old = self._states
+            new = dict(devices)
+            self._states = new
+            self._order = [serial for serial, _ in devices]
+            listeners = list(self._listeners)
+            self._condition.notify_all()
+        changes = [(serial, old.get(serial), new.get(serial))
+                   for serial in sorted(set(old) | set(new))
+                   if old.get(serial) != new.get(serial)]
+        for change in changes:
+            for listener in listeners:
+                try:
+                    listener(*change)
+                except Exception:
+                    traceback.print_exc(file=sys.stderr)
+
@@ -0,0 +1,338 @@
+"""
+A long-running Dumpey process, serving its API over a Unix socket.
+
+Several scripts driving the same devices share one server: it lists the
+devices once and keeps the list current, keeps the package and property
+caches warm, and runs the commands of all its clients on a device one at
+a time, so that a heap dump and a monkey run from two clients don't
+compete for the same phone. Only attached_devices and the cache
+invalidation functions, which don't run commands on a device, skip the
+queue. A request costs a socket round trip.
+
+Requests and responses are JSON objects, one per line:
+
+    {"id": 1, "method": "package_list", "params": {"regex": "google"}}
+    {"id": 1, "result": {"device_1": ["com.google.android.youtube"]}}
+    {"id": 2, "error": {"type": "DeviceError", "message": "...",
+                        "results": {...}, "errors": {"device_2": "..."}}}
+
+Client wraps the protocol, with a method per function of the API:
+
+    from dumpey.server import Client
+
+    with Client() as client:
+        client.dump_heap(package='com.example', local_dir='dumps')
+
+Paths are resolved on the client side, so relative paths are relative to
+the client's working directory.
+"""
+
+import collections
+import threading
+import tempfile
+import socket
+import json
+import os
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+from . import dumpey
+
+# Functions of the API that are served. Those taking a devices list run
+# on each device separately, those taking a device serial on that device,
+# holding a lock per device, so that clients take turns on a device. The
+# ones that don't run commands on a device run right away.
+_DEVICES_METHODS = ('clear_data', 'dump_heap', 'install', 'memory_usage',
+                    'monkey', 'package_list', 'pull_apk', 'reboot',
+                    'uninstall')
+_DEVICE_METHODS = ('api_version', 'file_size', 'pid', 'pids', 'pull',
+                   'remove_file', 'wait_for_file')
+_LOCAL_METHODS = ('attached_devices', 'invalidate_device_info',
+                  'invalidate_packages')
+METHODS = _DEVICES_METHODS + _DEVICE_METHODS + _LOCAL_METHODS
+
+# Parameters holding local paths, made absolute by the client
+_PATH_PARAMS = ('local', 'local_dir', 'local_path', 'store')
+
+# Environment variable naming the server socket
+SOCKET_ENV = 'DUMPEY_SOCKET'
+
+
+class RemoteError(Exception):
+    """
+    Raised by Client when a request fails on the server.
+
+    Attributes:
+        type: name of the exception class raised on the server, as string.
+    """
+
+    def __init__(self, type_name, message):
+        Exception.__init__(self, message)
+        self.type = type_name
+
+
+def default_path():
+    """
+    Return the socket path of the server: the DUMPEY_SOCKET environment
+    variable, or a per user path in the temporary directory.
+    """
+    path = os.environ.get(SOCKET_ENV)
+    if path:
+        return path
+    return os.path.join(tempfile.gettempdir(),
+                        'dumpey-%d.sock' % os.getuid())
+
+
+class Server(object):
+    """
+    Serves the API on a Unix socket, between serve_forever() and
+    shutdown().
+
+    Args:
+        path: socket path as string, see default_path.
+        max_workers: max number of devices each request runs on at once,
+                     as int.
+    Raises:
+        Exception: if another server is listening on path.
+    """
+
+    def __init__(self, path=None, max_workers=None):
+        self.path = path or default_path()
+        self.max_workers = max_workers
+        self._locks = collections.defaultdict(threading.Lock)
+        self._locks_lock = threading.Lock()
+        if os.path.exists(self.path):
+            if _listening(self.path):
+                raise Exception('a server is already listening on %s'
+                                % self.path)
+            os.remove(self.path)
+        self._server = _UnixServer(self.path, _Handler)
+        self._server.dumpey = self
+
+    def serve_forever(self, poll_interval=0.5):
+        """
+        Handle requests until shutdown() is called, which takes up to
+        poll_interval seconds to be noticed.
+        """
+        try:
+            self._server.serve_forever(poll_interval)
+        finally:
+            self._server.server_close()
+            if os.path.exists(self.path):
+                os.remove(self.path)
+
+    def shutdown(self):
+        """Stop serve_forever, from another thread."""
+        self._server.shutdown()
+
+    def call(self, method, params):
+        """
+        Run a function of the API.
+
+        Args:
+            method: one of METHODS.
+            params: dict of keyword arguments.
+        Returns:
+            the function result.
+        """
+        if method not in METHODS:
+            raise Exception('unknown method %s' % method)
+        func = getattr(dumpey, method)
+        if method in _DEVICE_METHODS:
+            with self._lock(params.get('device')):
+                return func(**params)
+        if method == 'install' and (params.get('hub_workers') or
+                                    params.get('bandwidth')):
+            # USB hub limits are shared by the devices of a hub, so the
+            # install can't be split per device.
+            return self._all_devices(func, params)
+        if method in _DEVICES_METHODS:
+            return self._per_device(func, params)
+        return func(**params)
+
+    def _all_devices(self, func, params):
+        # Runs func once on all devices, holding all their locks. They are
+        # taken in sorted order, so that two such calls can't deadlock.
+        devices = sorted(set(params.pop('devices', None) or
+                             dumpey.attached_devices()))
+        params['max_workers'] = params.get('max_workers') or self.max_workers
+        locks = [self._lock(device) for device in devices]
+        for lock in locks:
+            lock.acquire()
+        try:
+            return func(devices=devices, **params)
+        finally:
+            for lock in reversed(locks):
+                lock.release()
+
+    def _per_device(self, func, params):
+        # Runs func on each device on its own, holding the device lock.
+        # Results of functions that return a dict per device are merged.
+        devices = params.pop('devices', None) or dumpey.attached_devices()
+        max_workers = params.pop('max_workers', None) or self.max_workers
+
+        def run(device):
+            with self._lock(device):
+                try:
+                    result = func(devices=[device], **params)
+                except dumpey.DeviceError as e:
+                    raise e.errors[device]
+            return result.get(device) if isinstance(result, dict) else None
+
+        results = dumpey._fan_out(run, devices, max_workers)
+        if all(result is None for result in results.values()):
+            return None
+        return results
+
+    def _lock(self, device):
+        with self._locks_lock:
+            return self._locks[device]
+
+
+class Client(object):
+    """
+    Connects to a Server, and calls the functions of the API on it. Each
+    function of METHODS is a method taking the same keyword arguments.
+    Callbacks, such as those of monkey, can't be passed.
+
+    The connection is opened on the first call and reused by the following
+    ones. Calls from several threads are sent one at a time.
+
+    Args:
+        path: socket path as string, see default_path.
+        timeout: max seconds to wait for a response, as float, or None to
+                 wait for as long as a command takes.
+    """
+
+    def __init__(self, path=None, timeout=None):
+        self.path = path or default_path()
+        self.timeout = timeout
+        self._sock = None
+        self._file = None
+        self._id = 0
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __getattr__(self, name):
+        if name not in METHODS:
+            raise AttributeError(name)
+        return lambda **params: self.call(name, **params)
+
+    def call(self, method, **params):
+        """
+        Call a function of the API on the server.
+
+        Args:
+            method: one of METHODS.
+            params: keyword arguments of the function.
+        Returns:
+            the function result.
+        Raises:
+            DeviceError: if the function fails on any of the devices.
+            RemoteError: if the function fails otherwise.
+        """
+        for name in _PATH_PARAMS:
+            if params.get(name):
+                params[name] = os.path.abspath(params[name])
+        with self._lock:
+            self._id += 1
+            request = json.dumps({'id': self._id, 'method': method,
+                                  'params': params})
+            response = self._send(request + '\n')
+        if 'error' in response:
+            raise _error(response['error'])
+        return response.get('result')
+
+    def close(self):
+        """Close the connection to the server."""
+        if self._sock is not None:
+            self._file.close()
+            self._sock.close()
+            self._sock = self._file = None
+
+    def _send(self, request):
+        if self._sock is None:
+            self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self._sock.settimeout(self.timeout)
+            try:
+                self._sock.connect(self.path)
+            except socket.error as e:
+                self._sock = None
+                raise Exception('no dumpey server at %s: %s' % (self.path, e))
+            self._file = self._sock.makefile('rb')
+        try:
+            self._sock.sendall(request.encode('utf-8'))
+            line = self._file.readline()
+        except Exception:
+            self.close()
+            raise
+        if not line:
+            self.close()
+            raise Exception('connection closed by the dumpey server')
+        return json.loads(line.decode('utf-8'))
+
+
+#
+# Helpers
+#
+
+class _UnixServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    # Answers the requests of a connection in turn.
+
+    def handle(self):
+        server = self.server.dumpey
+        for line in self.rfile:
+            if not line.strip():
+                continue
+            request_id = None
+            try:
+                request = json.loads(line.decode('utf-8'))
+                request_id = request.get('id')
+                result = server.call(request['method'],
+                                     request.get('params') or {})
+                response = {'id': request_id, 'result': result}
+            except Exception as e:
+                response = {'id': request_id, 'error': _encode_error(e)}
+            data = json.dumps(response, default=str) + '\n'
+            self.wfile.write(data.encode('utf-8'))
+
+
+def _encode_error(e):
+    error = {'type': type(e).__name__, 'message': str(e)}
+    if isinstance(e, dumpey.DeviceError):
+        error['results'] = e.results
+        error['errors'] = dict((device, str(err))
+                               for device, err in e.errors.items())
+    return error
+
+
+def _error(error):
+    if error.get('type') == 'DeviceError':
+        return dumpey.DeviceError(
+            error.get('results') or {},
+            dict((device, RemoteError('Exception', message))
+                 for device, message in error.get('errors', {}).items()))
+    return RemoteError(error.get('type'), error.get('message'))
+
+
+def _listening(path):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+        return True
+    except socket.error:
+        return False
+    finally:
+        sock.close()
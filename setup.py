@@ -20,6 +20,8 @@ setup(
     tests_require=tests_require,
     extras_require={
         'test': tests_require,
+        'zstd': ['zstandard'],
+        'lz4': ['lz4'],
     },
     classifiers=[
         "Development Status :: 4 - Beta",
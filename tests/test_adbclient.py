@@ -0,0 +1,303 @@
+from dumpey import adbclient
+from dumpey import dumpey
+
+import threading
+import unittest
+import tempfile
+import shutil
+import socket
+import struct
+import mock
+import os
+
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+
+class FakeAdbHandler(socketserver.BaseRequestHandler):
+    """Answers the subset of the adb host protocol dumpey uses."""
+
+    def handle(self):
+        device = None
+        while True:
+            payload = self.read_request()
+            if payload is None:
+                return
+            if payload == 'host:devices':
+                self.okay(self.device_list(self.server.devices))
+                return
+            elif payload == 'host:track-devices':
+                # Sends the device lists put into server.updates.
+                self.okay(self.device_list(self.server.devices))
+                while True:
+                    devices = self.server.updates.get()
+                    if devices is None:
+                        return
+                    self.request.sendall(self.device_list(devices))
+            elif payload.startswith('host:transport:'):
+                device = payload[len('host:transport:'):]
+                if device not in self.server.devices:
+                    return self.fail("device '%s' not found" % device)
+                self.okay()
+            elif payload == 'host:transport-any':
+                device = self.server.devices[0]
+                self.okay()
+            elif (payload.startswith('host-serial:') and
+                  payload.endswith(':features')):
+                if payload.split(':')[1] not in self.server.devices:
+                    return self.fail('device not found')
+                features = ','.join(self.server.features).encode('ascii')
+                self.okay(b'%04x' % len(features) + features)
+                return
+            elif payload.startswith('shell:') and device:
+                self.server.commands.append((device, payload[6:]))
+                self.okay(self.server.outputs.get(payload[6:], b''))
+                return
+            elif payload.startswith('shell,v2,raw:') and device:
+                # Sends the output in a stdout packet, then the exit status
+                # from server.statuses.
+                command = payload[len('shell,v2,raw:'):]
+                self.server.commands.append((device, command))
+                out = self.server.outputs.get(command, b'')
+                status = self.server.statuses.get(command, 0)
+                self.okay(struct.pack('<BI', 1, len(out)) + out +
+                          struct.pack('<BIB', 3, 1, status))
+                return
+            elif payload.startswith('exec:') and device:
+                # Reads the number of bytes given by -S, like the package
+                # manager does.
+                command = payload[5:]
+                args = command.split()
+                size = int(args[args.index('-S') + 1])
+                data = b''
+                self.okay()
+                while len(data) < size:
+                    data += self.request.recv(size - len(data))
+                self.server.commands.append((device, command))
+                self.server.inputs.append(data)
+                self.request.sendall(b'Success: streamed %d bytes\n'
+                                     % len(data))
+                return
+            else:
+                return self.fail('unknown service')
+
+    def read_request(self):
+        length = self.request.recv(4)
+        if not length:
+            return None
+        return self.request.recv(int(length, 16)).decode('utf-8')
+
+    def device_list(self, devices):
+        body = ''.join('%s\tdevice\n' % d for d in devices).encode('ascii')
+        return b'%04x' % len(body) + body
+
+    def okay(self, body=b''):
+        self.request.sendall(b'OKAY' + body)
+
+    def fail(self, message):
+        message = message.encode('utf-8')
+        self.request.sendall(b'FAIL' + b'%04x' % len(message) + message)
+
+
+class FakeAdbServer(socketserver.ThreadingTCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, devices, outputs=None):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 FakeAdbHandler)
+        self.devices = devices
+        self.outputs = outputs or {}
+        self.statuses = {}
+        self.features = []
+        self.commands = []
+        self.inputs = []
+        self.updates = queue.Queue()
+
+
+class AdbClientTest(unittest.TestCase):
+    DEVICE_1 = "dummy_device_1"
+    DEVICE_2 = "dummy_device_2"
+    PACKAGE = "com.dummy.package.fst"
+
+    def setUp(self):
+        dumpey.invalidate_packages()
+        outputs = {'getprop ro.build.version.sdk': b'18\n',
+                   'pm list packages': b'package:%s\n'
+                                       % AdbClientTest.PACKAGE.encode()}
+        self.server = FakeAdbServer([AdbClientTest.DEVICE_1,
+                                     AdbClientTest.DEVICE_2], outputs)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.port = self.server.server_address[1]
+        self.client = adbclient.AdbClient(port=self.port, timeout=5)
+
+    def tearDown(self):
+        dumpey.watch_devices(False)
+        dumpey.use_native_transport(False)
+        self.server.updates.put(None)
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_devices(self):
+        out = self.client.devices()
+        self.assertEqual('List of devices attached\n%s\tdevice\n%s\tdevice\n'
+                         % (AdbClientTest.DEVICE_1, AdbClientTest.DEVICE_2),
+                         out)
+
+    def test_shell(self):
+        out = self.client.shell(['getprop', 'ro.build.version.sdk'],
+                                AdbClientTest.DEVICE_2)
+        self.assertEqual('18\n', out)
+        self.assertEqual([(AdbClientTest.DEVICE_2,
+                           'getprop ro.build.version.sdk')],
+                         self.server.commands)
+
+    def test_shell_any_device(self):
+        self.client.shell('ls')
+        self.assertEqual([(AdbClientTest.DEVICE_1, 'ls')],
+                         self.server.commands)
+
+    def test_shell_v2(self):
+        self.server.features = ['cmd', 'shell_v2']
+        self.server.outputs['rm /dummy'] = b'rm: /dummy: No such file\n'
+        self.server.statuses['rm /dummy'] = 1
+        device = AdbClientTest.DEVICE_1
+        self.assertEqual('18\n', self.client.shell(
+            ['getprop', 'ro.build.version.sdk'], device))
+        with self.assertRaises(adbclient.ShellError) as cm:
+            self.client.shell(['rm', '/dummy'], device)
+        self.assertEqual(1, cm.exception.status)
+        self.assertEqual('rm: /dummy: No such file\n', cm.exception.output)
+        self.assertEqual(frozenset(['cmd', 'shell_v2']),
+                         self.client.features(device))
+
+    def test_shell_v1_status_unknown(self):
+        self.server.outputs['rm /dummy'] = b'rm: /dummy: No such file\n'
+        self.server.statuses['rm /dummy'] = 1
+        self.assertEqual('rm: /dummy: No such file\n', self.client.shell(
+            ['rm', '/dummy'], AdbClientTest.DEVICE_1))
+
+    @mock.patch('subprocess.Popen', autospec=True)
+    def test_dumpey_adb_native_failure(self, popen_mock):
+        self.server.features = ['shell_v2']
+        self.server.outputs['rm /dummy'] = b'rm: /dummy: No such file\n'
+        self.server.statuses['rm /dummy'] = 1
+        dumpey.use_native_transport(port=self.port)
+        with self.assertRaises(Exception) as cm:
+            dumpey.adb(['shell', 'rm', '/dummy'], AdbClientTest.DEVICE_1)
+        self.assertIn('status=1', str(cm.exception))
+        self.assertIn('No such file', str(cm.exception))
+        self.assertEqual(0, popen_mock.call_count)
+
+    def test_shell_unknown_device(self):
+        self.assertRaises(adbclient.AdbError, self.client.shell, ['ls'],
+                          'unknown')
+
+    def test_server_unavailable(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+        client = adbclient.AdbClient(port=port)
+        self.assertRaises(adbclient.ServerUnavailable, client.devices)
+
+    def test_exec_in(self):
+        out = self.client.exec_in(['cat', '-S', '6'], [b'abc', b'def'],
+                                  AdbClientTest.DEVICE_1)
+        self.assertEqual('Success: streamed 6 bytes\n', out)
+        self.assertEqual([b'abcdef'], self.server.inputs)
+
+    def test_track_devices(self):
+        tracker = self.client.track_devices()
+        try:
+            self.assertEqual('%s\tdevice\n%s\tdevice\n'
+                             % (AdbClientTest.DEVICE_1,
+                                AdbClientTest.DEVICE_2), tracker.next())
+            self.server.updates.put([AdbClientTest.DEVICE_2])
+            self.assertEqual('%s\tdevice\n' % AdbClientTest.DEVICE_2,
+                             tracker.next())
+        finally:
+            tracker.close()
+
+    @mock.patch('subprocess.Popen', autospec=True)
+    def test_dumpey_watch_devices(self, popen_mock):
+        dumpey.use_native_transport(port=self.port)
+        changes = queue.Queue()
+        devices = dumpey.watch_devices()
+        devices.add_listener(lambda *change: changes.put(change))
+        self.assertEqual([AdbClientTest.DEVICE_1, AdbClientTest.DEVICE_2],
+                         dumpey.attached_devices())
+        self.server.updates.put([AdbClientTest.DEVICE_2])
+        self.assertEqual((AdbClientTest.DEVICE_1, 'device', None),
+                         changes.get(timeout=5))
+        self.assertEqual([AdbClientTest.DEVICE_2], dumpey.attached_devices())
+        self.assertEqual(0, popen_mock.call_count)
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=24)
+    def test_dumpey_install_streamed(self, api_mock):
+        self.server.outputs.update({
+            'cmd package install-create -r':
+                b'Success: created install session [7]\n',
+            'cmd package install-commit 7': b'Success\n',
+        })
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            local_files = [os.path.join(tmp_dir, name)
+                           for name in ('base.apk', 'split.apk')]
+            for local_file, content in zip(local_files, [b'a' * 100,
+                                                         b'b' * 10]):
+                with open(local_file, 'wb') as f:
+                    f.write(content)
+            dumpey.use_native_transport(port=self.port)
+            throttle = dumpey._HubThrottle(1, 1e9)
+            dumpey._install_apks(local_files, AdbClientTest.DEVICE_2,
+                                 throttle)
+        finally:
+            shutil.rmtree(tmp_dir)
+        self.assertEqual([b'a' * 100, b'b' * 10], self.server.inputs)
+        device = AdbClientTest.DEVICE_2
+        self.assertEqual(
+            [(device, 'cmd package install-create -r'),
+             (device, 'cmd package install-write -S 100 7 0_base.apk -'),
+             (device, 'cmd package install-write -S 10 7 1_split.apk -'),
+             (device, 'cmd package install-commit 7')],
+            self.server.commands)
+
+    @mock.patch('subprocess.Popen', autospec=True)
+    def test_dumpey_adb_native(self, popen_mock):
+        dumpey.use_native_transport(port=self.port)
+        self.assertEqual([AdbClientTest.DEVICE_1, AdbClientTest.DEVICE_2],
+                         dumpey.attached_devices())
+        self.assertEqual([AdbClientTest.PACKAGE],
+                         dumpey._package_list(AdbClientTest.DEVICE_1, None))
+        self.assertRaises(Exception, dumpey.adb, ['shell', 'ls'], 'unknown')
+        self.assertEqual(0, popen_mock.call_count)
+
+    @mock.patch('subprocess.Popen', autospec=True)
+    def test_dumpey_adb_fallback(self, popen_mock):
+        popen = mock.MagicMock()
+        popen.poll = mock.Mock(return_value=0)
+        popen.communicate = mock.Mock(return_value=('out', ''))
+        popen_mock.return_value = popen
+        self.server.shutdown()
+        self.server.server_close()
+        dumpey.use_native_transport(port=self.port)
+        device = AdbClientTest.DEVICE_1
+        self.assertEqual('out', dumpey.adb(['shell', 'ls'], device))
+        # Commands without a native equivalent always use the executable.
+        dumpey.adb(['reboot'], device)
+        self.assertEqual(2, popen_mock.call_count)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,261 @@
+from dumpey import dumpey
+
+import unittest
+import tempfile
+import shutil
+import mock
+import os
+
+try:
+    import asyncio
+    from dumpey import aio
+except (ImportError, SyntaxError):
+    aio = None
+
+DEVICE_1 = 'dummy_device_1'
+DEVICE_2 = 'dummy_device_2'
+PACKAGE = 'com.dummy.package.fst'
+
+
+class FakeProcess(object):
+    # A finished process, or one that never finishes if out is None. Writes
+    # out to stdout if it is a file or a pipe.
+
+    def __init__(self, out='', returncode=0, stdout=None):
+        self.out = out
+        self.exit_value = returncode
+        self.returncode = None
+        self.stdout = stdout
+        self.killed = False
+        if isinstance(stdout, int) and stdout >= 0 and out is not None:
+            os.write(stdout, out.encode())
+
+    def wait(self):
+        future = asyncio.Future()
+        if self.out is not None:
+            self.returncode = self.exit_value
+            future.set_result(self.returncode)
+        return future
+
+    def communicate(self):
+        future = asyncio.Future()
+        if self.out is not None:
+            self.returncode = self.exit_value
+            if hasattr(self.stdout, 'write'):
+                self.stdout.write(self.out.encode())
+                future.set_result((None, b''))
+            else:
+                future.set_result((self.out.encode(), b'err'))
+        return future
+
+    def kill(self):
+        self.killed = True
+        self.returncode = -9
+
+
+@unittest.skipIf(aio is None, 'asyncio API needs Python 3.5+')
+class AioTest(unittest.TestCase):
+
+    def setUp(self):
+        dumpey.invalidate_packages()
+        dumpey.invalidate_device_info()
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.commands = []
+        self.outputs = {}
+        self.processes = []
+        patcher = mock.patch('asyncio.create_subprocess_exec',
+                             self.exec_mock)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        self.loop.close()
+        asyncio.set_event_loop(None)
+
+    def exec_mock(self, *args, **kwargs):
+        # Replies with the output of the longest matching command prefix.
+        args = list(args)
+        self.commands.append(args)
+        out = ''
+        returncode = 0
+        for prefix in sorted(self.outputs, key=len, reverse=True):
+            if ' '.join(args).startswith(prefix):
+                out = self.outputs[prefix]
+                if isinstance(out, tuple):
+                    out, returncode = out
+                break
+        process = FakeProcess(out, returncode, kwargs.get('stdout'))
+        self.processes.append(process)
+        future = asyncio.Future()
+        future.set_result(process)
+        return future
+
+    def wait(self, coroutine):
+        return self.loop.run_until_complete(coroutine)
+
+    def test_adb(self):
+        self.outputs['adb -s %s shell echo' % DEVICE_1] = 'dummy\n'
+        out = self.wait(aio.adb(['shell', 'echo'], DEVICE_1, str.split))
+        self.assertEqual(['dummy'], out)
+        self.assertEqual([['adb', '-s', DEVICE_1, 'shell', 'echo']],
+                         self.commands)
+
+    def test_adb_raise(self):
+        self.outputs['adb'] = ('', 1)
+        self.assertRaises(Exception, self.wait, aio.adb(['dummy']))
+
+    def test_adb_timeout(self):
+        self.outputs['adb'] = None
+        self.assertRaises(asyncio.TimeoutError, self.wait,
+                          aio.adb(['shell', 'sleep'], DEVICE_1, timeout=0.01))
+        self.assertTrue(self.processes[0].killed)
+
+    def test_adb_cancel(self):
+        self.outputs['adb'] = None
+        task = self.loop.create_task(aio.adb(['shell', 'sleep'], DEVICE_1))
+        self.loop.call_soon(task.cancel)
+        self.assertRaises(asyncio.CancelledError, self.wait, task)
+        self.assertTrue(self.processes[0].killed)
+
+    def test_attached_devices(self):
+        self.outputs['adb devices'] = ('List of devices attached\n'
+                                       '%s\tdevice\n%s\toffline\n'
+                                       % (DEVICE_1, DEVICE_2))
+        self.assertEqual([DEVICE_1], self.wait(aio.attached_devices()))
+
+    def test_api_version(self):
+        self.outputs['adb -s %s shell getprop' % DEVICE_1] = (
+            '[ro.build.version.sdk]: [26]\n')
+        self.assertEqual(26, self.wait(aio.api_version(DEVICE_1, int)))
+        self.assertEqual(26, dumpey.api_version(DEVICE_1, int))
+        self.assertEqual(1, len(self.commands))
+
+    def test_pids(self):
+        self.outputs['adb -s %s shell getprop' % DEVICE_1] = (
+            '[ro.build.version.sdk]: [19]\n')
+        self.outputs['adb -s %s shell ps' % DEVICE_1] = (
+            'USER PID PPID VSIZE RSS WCHAN PC NAME\n'
+            'u0_a1 101 1 0 0 0 0 S %s\n' % PACKAGE)
+        self.assertEqual({PACKAGE: ['101'], 'other': []},
+                         self.wait(aio.pids([PACKAGE, 'other'], DEVICE_1)))
+        self.assertEqual('101', self.wait(aio.pid(PACKAGE, DEVICE_1)))
+
+    def test_clear_data_fan_out(self):
+        self.outputs['adb -s %s' % DEVICE_2] = ('', 1)
+        with self.assertRaises(dumpey.DeviceError) as cm:
+            self.wait(aio.clear_data(PACKAGE, devices=[DEVICE_1, DEVICE_2],
+                                     max_workers=1))
+        self.assertEqual([DEVICE_1], list(cm.exception.results))
+        self.assertEqual([DEVICE_2], list(cm.exception.errors))
+        self.assertEqual(2, len(self.commands))
+
+    def test_install_skip_unchanged(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        files = [os.path.join(tmp_dir, name) for name in ('a.apk', 'b.apk')]
+        for local_file in files:
+            open(local_file, 'w').close()
+        apks = dict((local_file, dumpey.apk.ApkInfo(PACKAGE, 1, local_file,
+                                                    local_file, None))
+                    for local_file in files)
+        self.outputs['adb -s %s install' % DEVICE_1] = 'Success\n'
+        with mock.patch('dumpey.dumpey._identify_apks', return_value=apks):
+            with mock.patch('dumpey.dumpey._unchanged_apks',
+                            return_value=set(files[:1])) as unchanged_mock:
+                out = self.wait(aio.install(tmp_dir, devices=[DEVICE_1]))
+                self.assertEqual({DEVICE_1: {'installed': files[1:],
+                                             'skipped': files[:1],
+                                             'failed': []}}, out)
+                unchanged_mock.assert_called_once_with(DEVICE_1, apks)
+                out = self.wait(aio.install(tmp_dir, devices=[DEVICE_1],
+                                            reinstall=True))
+                self.assertEqual(files, out[DEVICE_1]['installed'])
+                self.assertEqual(1, unchanged_mock.call_count)
+
+    def test_uninstall_regex(self):
+        self.outputs['adb -s %s shell pm list packages' % DEVICE_1] = (
+            'package:%s\npackage:com.other\n' % PACKAGE)
+        self.wait(aio.uninstall(regex='dummy', devices=[DEVICE_1]))
+        self.assertEqual(['adb', '-s', DEVICE_1, 'uninstall', PACKAGE],
+                         self.commands[-1])
+
+    def test_monkey_awaitable_callbacks(self):
+        called = []
+
+        def before(package, device):
+            called.append(('before', package, device))
+            future = asyncio.Future()
+            future.set_result(None)
+            return future
+
+        self.wait(aio.monkey(PACKAGE, devices=[DEVICE_1], seed=1, events=2,
+                             before=before, after=lambda p, d: called.append(
+                                 ('after', p, d)), log=False))
+        self.assertEqual([('before', PACKAGE, DEVICE_1),
+                          ('after', PACKAGE, DEVICE_1)], called)
+        self.assertEqual([['adb', '-s', DEVICE_1, 'shell', 'monkey', '-p',
+                           PACKAGE, '-s', '1', '2']], self.commands)
+
+    @mock.patch('dumpey.dumpey._find_executable', return_value=None)
+    def test_dump_heap(self, find_mock):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        head = 'adb -s %s ' % DEVICE_1
+        remote = dumpey._REMOTE_HEAP_DUMP_PATH + '_com_dummy_package_fst'
+        self.outputs[head + 'shell getprop'] = (
+            '[ro.build.version.sdk]: [30]\n')
+        self.outputs[head + 'shell pidof'] = '101\n'
+        self.outputs[head + 'shell stat'] = '611 1\n'
+        self.outputs[head + 'exec-out cat %s' % remote] = 'hprof'
+
+        batches = []
+
+        def parse(output, marker, count):
+            batches.append(count)
+            return [('101\n', 0)] * count
+
+        converted = []
+
+        def convert(src, local_file, codec):
+            # The dump is streamed, nothing is written to disk before it is
+            # converted.
+            converted.append((src.read(), local_file, codec,
+                              os.listdir(tmp_dir)))
+
+        with mock.patch('dumpey.dumpey._parse_batch_output',
+                        side_effect=parse):
+            with mock.patch('dumpey.dumpey._convert_hprof',
+                            side_effect=convert):
+                local_file = self.wait(aio.dump_heap(
+                    PACKAGE, devices=[DEVICE_1], local_dir=tmp_dir,
+                    codec='gzip'))
+        self.assertIsNone(local_file)
+        self.assertEqual([1, 2], batches)
+        self.assertEqual([(b'hprof', os.path.join(
+            tmp_dir, 'dummy_device_1_com_dummy_package_fst.hprof.gz'),
+            'gzip', [])], converted)
+        self.assertEqual([], os.listdir(tmp_dir))
+        self.assertEqual(['adb', '-s', DEVICE_1, 'shell', 'rm', '-f', remote],
+                         self.commands[-1])
+
+    def test_dump_heap_failed(self):
+        head = 'adb -s %s ' % DEVICE_1
+        self.outputs[head + 'shell getprop'] = (
+            '[ro.build.version.sdk]: [30]\n')
+
+        def parse(output, marker, count):
+            if count == 1:
+                return [('101\n', 0)]
+            return [('', 0), ('Error: Unable to open file: x\n', 0)]
+
+        with mock.patch('dumpey.dumpey._parse_batch_output',
+                        side_effect=parse):
+            with self.assertRaises(dumpey.DeviceError) as cm:
+                self.wait(aio.dump_heap(PACKAGE, devices=[DEVICE_1]))
+        self.assertIn('Unable to open file', str(cm.exception.errors[DEVICE_1]))
+        self.assertFalse(any('stat' in c for c in self.commands))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,145 @@
+from dumpey import analysis
+from dumpey import compress
+from dumpey import hprof
+
+from tests.test_hprof import HprofBuilder, u4
+
+import unittest
+import tempfile
+import shutil
+import os
+import io
+
+
+class AnalysisTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_dump(self, name, strings, objects, codec=None,
+                   version=hprof.ANDROID_VERSION):
+        b = HprofBuilder(version=version)
+        b.string(1, b'java.lang.String')
+        b.load_class(0x10, 1)
+        b.string(2, b'com/dummy/Leak')
+        b.load_class(0x11, 2)
+        segment = b.class_dump(0x10, 0, 8, [])
+        for i in range(strings):
+            segment += b.instance(0x100 + i, 0x10, u4(i) + u4(0))
+        for i in range(objects):
+            segment += b.instance(0x200 + i, 0x11, u4(i))
+        segment += b.object_array(0x300, 0x12, [0x100, 0x200])
+        segment += b.primitive_array(0x301, 8, b'\0' * (10 * objects))
+        b.record(hprof.TAG_HEAP_DUMP_SEGMENT, segment)
+        b.record(hprof.TAG_HEAP_DUMP_END, b'')
+        path = compress.filename(os.path.join(self.tmp_dir, name), codec)
+        with compress.open_write(path, codec) as f:
+            f.write(b.data)
+        return path
+
+    def test_class_histogram(self):
+        histogram = analysis.class_histogram(self.write_dump('h', 3, 2))
+        self.assertEqual(sorted([('java.lang.String', 3, 24),
+                                 ('com.dummy.Leak', 2, 8),
+                                 ('0x12', 1, 8),
+                                 ('byte[]', 1, 20)]),
+                         sorted(histogram))
+        self.assertEqual((7, 60), histogram.total())
+        self.assertEqual((0, 0), histogram.get('unknown'))
+
+    def test_class_histogram_compressed(self):
+        path = self.write_dump('h', 3, 2, compress.GZIP,
+                               hprof.J2SE_VERSION)
+        histogram = analysis.class_histogram(path)
+        self.assertEqual((2, 8), histogram.get('com.dummy.Leak'))
+
+    def test_diff_histograms(self):
+        before = analysis.class_histogram(self.write_dump('b', 3, 1))
+        after = analysis.class_histogram(self.write_dump('a', 2, 5))
+        self.assertEqual([('byte[]', 0, 40), ('com.dummy.Leak', 4, 16)],
+                         analysis.diff_histograms(before, after))
+
+    def test_write_report(self):
+        before = analysis.class_histogram(self.write_dump('b', 3, 1))
+        after = analysis.class_histogram(self.write_dump('a', 3, 5))
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        analysis.write_report(out, before, after, limit=1)
+        lines = out.getvalue().splitlines()
+        self.assertEqual('instances: 6 -> 10 (+4)', lines[0])
+        self.assertEqual('shallow bytes: 46 -> 102 (+56)', lines[1])
+        self.assertEqual('2 classes grew', lines[2])
+        self.assertEqual(['+40', '+0', 'byte[]'], lines[-1].split())
+        self.assertEqual(6, len(lines))
+
+    def write_graph(self, codec=None):
+        b = HprofBuilder()
+        b.string(1, b'com/dummy/Node')
+        b.load_class(0x10, 1)
+        b.string(2, b'com/dummy/Leaf')
+        b.load_class(0x11, 2)
+        ref = b.ident
+        segment = (b.root(hprof.ROOT_JNI_GLOBAL, 0x20, ref(0)) +
+                   b.root(hprof.ROOT_JAVA_FRAME, 0x25, u4(0) + u4(0)) +
+                   b.class_dump(0x10, 0, 8, [(92, hprof.TYPE_OBJECT),
+                                             (93, hprof.TYPE_OBJECT)]) +
+                   b.class_dump(0x11, 0x10, 12, [(94, 10)]))
+        # 0x20 -> 0x21, 0x22 -> 0x23 -> byte[] 0x30 <- 0x24 <- 0x25
+        for object_id, fst, snd in [(0x20, 0x21, 0x22), (0x21, 0x23, 0),
+                                    (0x22, 0x23, 0), (0x23, 0x30, 0),
+                                    (0x24, 0x30, 0)]:
+            segment += b.instance(object_id, 0x10, ref(fst) + ref(snd))
+        segment += b.instance(0x25, 0x11, u4(7) + ref(0x24) + ref(0))
+        segment += b.instance(0x26, 0x10, ref(0x20) + ref(0))
+        segment += b.primitive_array(0x30, 8, b'\0' * 100)
+        b.record(hprof.TAG_HEAP_DUMP_SEGMENT, segment)
+        b.record(hprof.TAG_HEAP_DUMP_END, b'')
+        path = compress.filename(os.path.join(self.tmp_dir, 'g.hprof'), codec)
+        with compress.open_write(path, codec) as f:
+            f.write(b.data)
+        return path
+
+    def perform_dominator_tree_test(self, codec=None):
+        tree = analysis.dominator_tree(self.write_graph(codec))
+        self.assertEqual(10, len(tree))
+        self.assertEqual(32, tree.retained_size(0x20))
+        self.assertEqual(8, tree.retained_size(0x23))
+        self.assertEqual(20, tree.retained_size(0x25))
+        self.assertEqual(100, tree.retained_size(0x30))
+        # Unreachable
+        self.assertEqual(0, tree.retained_size(0x26))
+        self.assertIsNone(tree.retained_size(0x99))
+        self.assertEqual(0x20, tree.dominator(0x23))
+        self.assertEqual(0x25, tree.dominator(0x24))
+        self.assertIsNone(tree.dominator(0x30))
+        self.assertIsNone(tree.dominator(0x26))
+        self.assertEqual([(0x30, 'byte[]', 100, 100),
+                          (0x20, 'com.dummy.Node', 8, 32),
+                          (0x25, 'com.dummy.Leaf', 12, 20)], tree.top(3))
+        self.assertEqual([0x20, 0x25],
+                         [t[0] for t in tree.top(2, 'com.dummy.')])
+        self.assertEqual([], tree.top(2, 'com.other.'))
+        return tree
+
+    def test_dominator_tree(self):
+        self.perform_dominator_tree_test()
+
+    def test_dominator_tree_compressed(self):
+        self.perform_dominator_tree_test(compress.GZIP)
+        self.assertEqual(['g.hprof.gz'], os.listdir(self.tmp_dir))
+
+    def test_write_retainers(self):
+        tree = analysis.dominator_tree(self.write_graph())
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        analysis.write_retainers(out, tree, 1, 'com.dummy.')
+        lines = out.getvalue().splitlines()
+        self.assertEqual(['retained', 'shallow', 'object'], lines[0].split())
+        self.assertEqual(['32', '8', 'com.dummy.Node', '@', '0x20'],
+                         lines[1].split())
+        self.assertEqual(2, len(lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+from dumpey import apk
+
+import unittest
+import tempfile
+import zipfile
+import hashlib
+import shutil
+import struct
+import os
+
+NO_INDEX = 0xffffffff
+
+
+def chunk(kind, header, body):
+    header_size = 8 + len(header)
+    return (struct.pack('<HHI', kind, header_size, header_size + len(body)) +
+            header + body)
+
+
+def string_pool(strings, utf8):
+    data = b''
+    offsets = []
+    for s in strings:
+        offsets.append(len(data))
+        if utf8:
+            encoded = s.encode('utf-8')
+            data += struct.pack('<BB', len(s), len(encoded)) + encoded + b'\0'
+        else:
+            data += (struct.pack('<H', len(s)) + s.encode('utf-16-le') +
+                     b'\0\0')
+    data += b'\0' * (-len(data) % 4)
+    header = struct.pack('<IIIII', len(strings), 0, 0x100 if utf8 else 0,
+                         28 + 4 * len(strings), 0)
+    return chunk(0x0001, header,
+                 struct.pack('<%dI' % len(offsets), *offsets) + data)
+
+
+def manifest(package='com.dummy.app', version_code=42, major=None,
+             split=None, utf8=True, names=True):
+    """
+    Builds a binary manifest. Without names, attribute names are empty
+    strings, as in APKs processed by resource shrinkers.
+    """
+    strings = ['versionCode', 'versionCodeMajor', 'package', 'manifest',
+               package, '', 'split', split or '']
+    attrs = [(0, 0x10, version_code), (2, 0x03, 4)]
+    if major is not None:
+        attrs.append((1, 0x10, major))
+    if split is not None:
+        attrs.append((6, 0x03, 7))
+    if not names:
+        strings[0] = strings[1] = ''
+    resource_map = chunk(0x0180, b'',
+                         struct.pack('<II', 0x0101021b, 0x01010576))
+    body = b''
+    for name, data_type, value in attrs:
+        raw = value if data_type == 0x03 else NO_INDEX
+        body += struct.pack('<IIIHBBI', NO_INDEX, name, raw, 8, 0, data_type,
+                            value)
+    element = chunk(0x0102, struct.pack('<II', 1, NO_INDEX),
+                    struct.pack('<IIHHHHHH', NO_INDEX, 3, 20, 20,
+                                len(attrs), 0, 0, 0) + body)
+    return chunk(0x0003, b'', string_pool(strings, utf8) + resource_map +
+                 element)
+
+
+class ApkTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_apk(self, data):
+        path = os.path.join(self.tmp_dir, 'app.apk')
+        with zipfile.ZipFile(path, 'w') as z:
+            z.writestr('AndroidManifest.xml', data)
+            z.writestr('classes.dex', b'dex\n035\0')
+        return path
+
+    def test_read_manifest_utf8(self):
+        path = self.write_apk(manifest())
+        self.assertEqual(('com.dummy.app', 42, None),
+                         apk.read_manifest(path))
+
+    def test_read_manifest_utf16(self):
+        path = self.write_apk(manifest(utf8=False))
+        self.assertEqual(('com.dummy.app', 42, None),
+                         apk.read_manifest(path))
+
+    def test_read_manifest_stripped_names(self):
+        path = self.write_apk(manifest(major=1, names=False))
+        self.assertEqual(('com.dummy.app', (1 << 32) | 42, None),
+                         apk.read_manifest(path))
+
+    def test_read_manifest_split(self):
+        path = self.write_apk(manifest(split='config.arm64_v8a'))
+        self.assertEqual(('com.dummy.app', 42, 'config.arm64_v8a'),
+                         apk.read_manifest(path))
+
+    def test_identify(self):
+        path = self.write_apk(manifest())
+        with open(path, 'rb') as f:
+            content = f.read()
+        self.assertEqual(apk.ApkInfo('com.dummy.app', 42,
+                                     hashlib.sha256(content).hexdigest(),
+                                     hashlib.md5(content).hexdigest(),
+                                     None),
+                         apk.identify(path))
+
+    def test_not_apk(self):
+        path = os.path.join(self.tmp_dir, 'app.apk')
+        with open(path, 'wb') as f:
+            f.write(b'not a zip')
+        self.assertRaises(apk.ApkError, apk.read_manifest, path)
+
+    def test_malformed_manifest(self):
+        path = self.write_apk(manifest()[:60])
+        self.assertRaises(apk.ApkError, apk.read_manifest, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
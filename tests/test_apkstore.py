@@ -0,0 +1,79 @@
+from dumpey import apkstore
+
+import unittest
+import tempfile
+import hashlib
+import shutil
+import os
+
+
+class ApkStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, 'store')
+        self.store = apkstore.ApkStore(self.root)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def add(self, content, package='com.dummy.app', version_code=1):
+        path = self.store.temp_path()
+        with open(path, 'wb') as f:
+            f.write(content)
+        return self.store.add(package, version_code, path)
+
+    def test_add(self):
+        stored = self.add(b'apk')
+        sha256 = hashlib.sha256(b'apk').hexdigest()
+        self.assertEqual(self.store.path(sha256), stored)
+        with open(stored, 'rb') as f:
+            self.assertEqual(b'apk', f.read())
+        self.assertEqual([('com.dummy.app', 1, 3, sha256,
+                           hashlib.md5(b'apk').hexdigest())],
+                         self.store.entries())
+        self.assertEqual([], os.listdir(os.path.join(self.root, 'tmp')))
+
+    def test_add_same_content(self):
+        self.assertEqual(self.add(b'apk'), self.add(b'apk'))
+        self.assertEqual(self.add(b'apk'), self.add(b'apk', version_code=2))
+        self.assertEqual([1, 2],
+                         [e.version_code for e in self.store.entries()])
+
+    def test_find(self):
+        stored = self.add(b'apk')
+        sha256 = hashlib.sha256(b'apk').hexdigest()
+        md5 = hashlib.md5(b'apk').hexdigest()
+        self.assertEqual(stored, self.store.find('com.dummy.app', 1, sha256))
+        self.assertEqual(stored, self.store.find('com.dummy.app', 1, md5))
+        self.assertEqual(stored, self.store.find('com.dummy.app', 1, size=3))
+        self.assertIsNone(self.store.find('com.dummy.app', 2, sha256))
+        self.assertIsNone(self.store.find('com.dummy.other', 1, sha256))
+        self.assertIsNone(self.store.find('com.dummy.app', 1, 'f' * 64))
+        self.assertIsNone(self.store.find('com.dummy.app', 1, size=4))
+        self.assertIsNone(self.store.find('com.dummy.app', 1))
+
+    def test_reopen(self):
+        stored = self.add(b'apk')
+        self.store.record('device', 'com.dummy.app', 1, '/data/base.apk',
+                          stored)
+        store = apkstore.ApkStore(self.root)
+        self.assertEqual(self.store.entries(), store.entries())
+        self.assertEqual(stored, store.find('com.dummy.app', 1, size=3))
+        manifest = store.manifest()
+        self.assertEqual([('device', 'com.dummy.app', 1, '/data/base.apk',
+                           hashlib.sha256(b'apk').hexdigest())],
+                         [e[1:] for e in manifest])
+
+    def test_link(self):
+        stored = self.add(b'apk')
+        local = os.path.join(self.tmp_dir, 'local.apk')
+        with open(local, 'wb') as f:
+            f.write(b'old')
+        self.assertTrue(apkstore.link(stored, local))
+        self.assertTrue(apkstore.link(stored, local))
+        self.assertTrue(os.path.samefile(stored, local))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,58 @@
+from dumpey import compress
+
+import unittest
+import tempfile
+import shutil
+import os
+
+
+class CompressTest(unittest.TestCase):
+    DATA = b'JAVA PROFILE 1.0.2\0' + b'\1\2\3\4' * 4096
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def path(self, name):
+        return os.path.join(self.tmp_dir, name)
+
+    def perform_round_trip_test(self, codec):
+        if not compress.available(codec):
+            self.skipTest('%s is not available' % codec)
+        path = compress.filename(self.path('dump.hprof'), codec)
+        self.assertEqual(self.path('dump.hprof') + compress.EXTENSIONS[codec],
+                         path)
+        with compress.open_write(path, codec) as f:
+            f.write(CompressTest.DATA[:100])
+            f.write(CompressTest.DATA[100:])
+        self.assertTrue(os.path.getsize(path) < len(CompressTest.DATA))
+        with compress.open_read(path) as f:
+            self.assertEqual(CompressTest.DATA, f.read())
+
+    def test_gzip(self):
+        self.perform_round_trip_test(compress.GZIP)
+
+    def test_zstd(self):
+        self.perform_round_trip_test(compress.ZSTD)
+
+    def test_lz4(self):
+        self.perform_round_trip_test(compress.LZ4)
+
+    def test_uncompressed(self):
+        path = compress.filename(self.path('dump.hprof'), None)
+        with compress.open_write(path) as f:
+            f.write(CompressTest.DATA)
+        self.assertEqual(len(CompressTest.DATA), os.path.getsize(path))
+        with compress.open_read(path) as f:
+            self.assertEqual(CompressTest.DATA, f.read())
+
+    def test_unknown_codec(self):
+        self.assertRaises(Exception, compress.open_write, self.path('x'),
+                          'bzip')
+        self.assertFalse(os.path.exists(self.path('x')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,6 +2,8 @@ from dumpey import dumpey
 
 import subprocess
 import unittest
+import tempfile
+import shutil
 import mock
 import re
 
@@ -23,17 +25,50 @@ class DumpeyTest(unittest.TestCase):
 
     LOCAL_DIR = 'local_dir'
 
+    def setUp(self):
+        dumpey.invalidate_packages()
+        dumpey.invalidate_device_info()
+        dumpey._remote_digests.clear()
+
     def test_adb(self, popen_mock):
         popen_mock.return_value = self.create_popen_mock(out=DumpeyTest.DUMMY)
         out = dumpey.adb(DumpeyTest.DUMMY_LIST)
         self.assertEqual(out, DumpeyTest.DUMMY)
         self.assert_popen_mock(popen_mock, 1, ['adb', DumpeyTest.DUMMY])
 
+    def test_cmd_text(self, popen_mock):
+        popen_mock.return_value = self.create_popen_mock(
+            out=u'caf\xe9\n'.encode('utf-8'))
+        out = dumpey._cmd(['adb', 'shell', 'echo'])
+        self.assertIsInstance(out, str)
+        self.assertEqual(u'caf\xe9\n'.encode('utf-8') if str is bytes
+                         else u'caf\xe9\n', out)
+
+    def test_adb_exec_out_binary(self, popen_mock):
+        png = b'\x89PNG\r\n\x1a\n\xff'
+        popen_mock.return_value = self.create_popen_mock(out=png)
+        out = dumpey.adb(['exec-out', 'screencap', '-p'], DumpeyTest.DEVICE_1)
+        self.assertEqual(png, out)
+        self.assertIsInstance(out, bytes)
+
     def test_adb_raise(self, popen_mock):
         popen_mock.return_value = self.create_popen_mock(exit_value=1)
         self.assertRaises(Exception, dumpey.adb, DumpeyTest.DUMMY_LIST)
         self.assert_popen_mock(popen_mock, 1, ['adb', DumpeyTest.DUMMY])
 
+    def test_adb_profile(self, popen_mock):
+        popen_mock.return_value = self.create_popen_mock(out='12345')
+        recorder = dumpey.instrument.enable()
+        self.addCleanup(dumpey.instrument.disable)
+        dumpey.adb(['shell', 'ls'], DumpeyTest.DEVICE_1)
+        popen_mock.return_value = self.create_popen_mock(exit_value=1)
+        self.assertRaises(Exception, dumpey.adb, DumpeyTest.DUMMY_LIST)
+        calls = recorder.calls()
+        self.assertEqual([('adb shell ls', DumpeyTest.DEVICE_1, 0, 5),
+                          ('adb dummy', None, 1, 0)],
+                         [(c.kind, c.device, c.status, c.size)
+                          for c in calls])
+
     def test_adb_decor(self, popen_mock):
         popen_mock.return_value = self.create_popen_mock()
         decor = lambda l: DumpeyTest.DUMMY
@@ -52,14 +87,32 @@ class DumpeyTest(unittest.TestCase):
         self.perform_api_version_test(popen_mock, DumpeyTest.DUMMY, decor)
 
     def perform_api_version_test(self, popen_mock, expected_out, decor=None):
-        raw = '18\n\r\t'
+        raw = '[ro.build.id]: [JSS15J]\r\n[ro.build.version.sdk]: [18]\r\n'
         popen_mock.return_value = self.create_popen_mock(out=raw)
         device = DumpeyTest.DEVICE_1
         out = dumpey.api_version(device, decor)
         self.assertEqual(out, expected_out)
+        self.assertEqual(dumpey.api_version(device, decor), expected_out)
         self.assert_popen_mock(popen_mock, 1,
-                               ['adb', '-s', device, 'shell', 'getprop',
-                                'ro.build.version.sdk'])
+                               ['adb', '-s', device, 'shell', 'getprop'])
+
+    def test_device_info(self, popen_mock):
+        raw = ('[dalvik.vm.heapsize]: [512m]\n'
+               '[ro.build.version.sdk]: [18]\n'
+               '[ro.product.model]: [Nexus 4]\n'
+               '[ro.empty]: []\n')
+        popen_mock.return_value = self.create_popen_mock(out=raw)
+        device = DumpeyTest.DEVICE_1
+        info = dumpey.device_info(device)
+        self.assertEqual(18, info.api)
+        self.assertEqual('Nexus 4', info.get('ro.product.model'))
+        self.assertEqual('', info.get('ro.empty'))
+        self.assertIsNone(info.get('ro.missing'))
+        self.assertIs(info, dumpey.device_info(device))
+        self.assert_called(popen_mock, 1)
+        dumpey._reboot(device)
+        self.assertIsNot(info, dumpey.device_info(device))
+        self.assert_called(popen_mock, 3)  # getprop + reboot + getprop
 
     def test_attached_devices_none(self, popen_mock):
         raw = "List of devices attached\n\n"
@@ -191,6 +244,68 @@ class DumpeyTest(unittest.TestCase):
                                ['adb', '-s', device, "shell", "pm", "clear",
                                 package])
 
+    @mock.patch('random.randint', return_value=7)
+    def test_shell_batch(self, randint_mock, popen_mock):
+        raw = ('_dumpey_7_B0\r\nSuccess\r\n\r\n_dumpey_7_E0 0\r\n'
+               '_dumpey_7_B1\r\n\r\n_dumpey_7_E1 1\r\n'
+               '_dumpey_7_B2\r\nno newline\r\n_dumpey_7_E2 0\r\n')
+        popen_mock.return_value = self.create_popen_mock(out=raw)
+        device = DumpeyTest.DEVICE_1
+        with dumpey.ShellBatch(device) as batch:
+            batch.add(['pm', 'clear', DumpeyTest.PACKAGE_1])
+            batch.add('false')
+            batch.add(['echo', '-n', 'no newline'])
+        self.assertEqual([('Success\n', 0), ('', 1), ('no newline', 0)],
+                         batch.results)
+        script = ('echo _dumpey_7_B0; pm clear %s; _s=$?; echo; '
+                  'echo _dumpey_7_E0 $_s; '
+                  'echo _dumpey_7_B1; false; _s=$?; echo; '
+                  'echo _dumpey_7_E1 $_s; '
+                  'echo _dumpey_7_B2; echo -n no newline; _s=$?; echo; '
+                  'echo _dumpey_7_E2 $_s' % DumpeyTest.PACKAGE_1)
+        self.assert_popen_mock(popen_mock, 1,
+                               ['adb', '-s', device, 'shell', script])
+
+    def test_shell_batch_missing_output(self, popen_mock):
+        popen_mock.return_value = self.create_popen_mock(out='')
+        batch = dumpey.ShellBatch(DumpeyTest.DEVICE_1)
+        batch.add('true')
+        self.assertRaises(Exception, batch.run)
+
+    def test_shell_batch_empty(self, popen_mock):
+        with dumpey.ShellBatch(DumpeyTest.DEVICE_1) as batch:
+            pass
+        self.assertEqual([], batch.results)
+        self.assert_called(popen_mock, 0)
+
+    @mock.patch('dumpey.dumpey._package_list', autospec=True)
+    @mock.patch('random.randint', return_value=7)
+    def test_package_iter_batch(self, randint_mock, package_list_mock,
+                                popen_mock):
+        package_list_mock.return_value = DumpeyTest.PACKAGES
+        raw = ''.join('_dumpey_7_B%d\nSuccess\n\n_dumpey_7_E%d 0\n' % (i, i)
+                      for i in range(len(DumpeyTest.PACKAGES)))
+        popen_mock.return_value = self.create_popen_mock(out=raw)
+        out = dumpey._package_iter("", DumpeyTest.DEVICES, dumpey._clear_data,
+                                   True)
+        self.assertEqual(DumpeyTest.DEVICES, out)
+        # One batched shell session per device, not one per package.
+        self.assert_called(popen_mock, len(DumpeyTest.DEVICES))
+
+    @mock.patch('dumpey.dumpey._package_list', autospec=True)
+    @mock.patch('random.randint', return_value=7)
+    def test_package_iter_batch_failure(self, randint_mock, package_list_mock,
+                                        popen_mock):
+        package_list_mock.return_value = DumpeyTest.PACKAGES
+        raw = ('_dumpey_7_B0\nSuccess\n\n_dumpey_7_E0 0\n'
+               '_dumpey_7_B1\nFailure\n\n_dumpey_7_E1 1\n'
+               '_dumpey_7_B2\nSuccess\n\n_dumpey_7_E2 0\n')
+        popen_mock.return_value = self.create_popen_mock(out=raw)
+        self.assertRaises(dumpey.DeviceError, dumpey._package_iter, "",
+                          [DumpeyTest.DEVICE_1], dumpey._uninstall_package,
+                          True)
+        self.assert_called(popen_mock, 1)
+
     def test_split_whitespace(self, popen_mock):
         fst = "a b  c   d    e     f      g       h"
         snd = "a       b      c     d    e   f  g h"
@@ -219,10 +334,387 @@ class DumpeyTest(unittest.TestCase):
                                ['adb', '-s', DumpeyTest.DEVICE_1, 'shell',
                                 'ls', '-l', remote])
 
-    # MISSING TEST INSTALL
+    def test_fan_out(self, popen_mock):
+        devices = DumpeyTest.DEVICES
+        out = dumpey._fan_out(lambda d: d + DumpeyTest.DUMMY, devices, 2)
+        self.assertEqual({d: d + DumpeyTest.DUMMY for d in devices}, out)
+        self.assert_called(popen_mock, 0)
+
+    def test_fan_out_errors(self, popen_mock):
+        done = []
+
+        def func(device):
+            if device == DumpeyTest.DEVICE_2:
+                raise Exception(DumpeyTest.DUMMY)
+            done.append(device)
+            return device
+
+        try:
+            dumpey._fan_out(func, DumpeyTest.DEVICES, 3)
+            self.fail('DeviceError not raised')
+        except dumpey.DeviceError as e:
+            self.assertEqual([DumpeyTest.DEVICE_2], list(e.errors))
+            self.assertEqual({DumpeyTest.DEVICE_1: DumpeyTest.DEVICE_1,
+                              DumpeyTest.DEVICE_3: DumpeyTest.DEVICE_3},
+                             e.results)
+        self.assertEqual(sorted([DumpeyTest.DEVICE_1, DumpeyTest.DEVICE_3]),
+                         sorted(done))
+
+    @mock.patch('os.path.exists', return_value=True)
+    @mock.patch('os.path.isdir', return_value=False)
+    def test_install_file(self, isdir_mock, exists_mock, popen_mock):
+        popen_mock.return_value = self.create_popen_mock()
+        local = DumpeyTest.DUMMY + '.apk'
+        devices = DumpeyTest.DEVICES
+        out = dumpey.install(local, devices, max_workers=3)
+        self.assert_popen_mock(popen_mock, len(devices),
+                               *[['adb', '-s', d, 'install', '-r', local]
+                                 for d in devices])
+        self.assertEqual({d: {'installed': [local], 'skipped': [],
+                              'failed': []} for d in devices}, out)
+
+    @mock.patch('dumpey.dumpey.ShellBatch.run', autospec=True)
+    @mock.patch('dumpey.dumpey._identify_apks', autospec=True)
+    def test_install_files_skip_unchanged(self, identify_mock, run_mock,
+                                          popen_mock):
+        path = '/data/app/fst-1/base.apk'
+        outputs = {
+            'dumpsys package %s' % DumpeyTest.PACKAGE_1:
+                '    versionCode=5 minSdk=21 targetSdk=30\n'
+                '    lastUpdateTime=2020-01-01 10:00:00\n',
+            'pm path %s' % DumpeyTest.PACKAGE_1: 'package:%s\n' % path,
+            'dumpsys package %s' % DumpeyTest.PACKAGE_2:
+                '    versionCode=2 minSdk=21 targetSdk=30\n',
+            'pm path %s' % DumpeyTest.PACKAGE_2: 'package:/data/app/snd\n',
+            '(sha256sum %s || md5sum %s) 2>/dev/null' % (path, path):
+                'a' * 64 + '  %s\n' % path,
+        }
+
+        def run(batch):
+            batch.results = [(outputs[dumpey._shell_str(c)], 0)
+                             for c in batch.commands]
+
+        run_mock.side_effect = run
+        identify_mock.return_value = {
+            'fst.apk': dumpey.apk.ApkInfo(DumpeyTest.PACKAGE_1, 5, 'a' * 64,
+                                          'b' * 32, None),
+            'snd.apk': dumpey.apk.ApkInfo(DumpeyTest.PACKAGE_2, 3, 'c' * 64,
+                                          'd' * 32, None),
+        }
+        popen_mock.side_effect = [self.create_popen_mock(),
+                                  self.create_popen_mock(out='Failure [X]')]
+        device = DumpeyTest.DEVICE_1
+        out = dumpey._install_from_files(['fst.apk', 'snd.apk', 'trd.apk'],
+                                         [device], 1)
+        self.assertEqual({device: {'installed': ['snd.apk'],
+                                   'skipped': ['fst.apk'],
+                                   'failed': ['trd.apk']}}, out)
+        self.assert_popen_mock(popen_mock, 2,
+                               ['adb', '-s', device, 'install', '-r',
+                                'snd.apk'],
+                               ['adb', '-s', device, 'install', '-r',
+                                'trd.apk'])
+        # The digest of the installed APK is cached.
+        dumpey._install_from_files(['fst.apk'], [device], 1)
+        self.assert_called(run_mock, 3)
+
+    @mock.patch('dumpey.dumpey.ShellBatch.run', autospec=True)
+    def test_unchanged_apks_splits(self, run_mock, popen_mock):
+        package = DumpeyTest.PACKAGE_1
+        base = '/data/app/fst-1/base.apk'
+        split = '/data/app/fst-1/split_config.arm64_v8a.apk'
+        outputs = {
+            'dumpsys package %s' % package: '    versionCode=5 minSdk=21\n',
+            'pm path %s' % package: 'package:%s\npackage:%s\n' % (base,
+                                                                   split),
+            '(sha256sum %s || md5sum %s) 2>/dev/null' % (base, base):
+                'a' * 64 + '  %s\n' % base,
+            '(sha256sum %s || md5sum %s) 2>/dev/null' % (split, split):
+                'b' * 64 + '  %s\n' % split,
+        }
+
+        def run(batch):
+            batch.results = [(outputs[dumpey._shell_str(c)], 0)
+                             for c in batch.commands]
+
+        run_mock.side_effect = run
+        device = DumpeyTest.DEVICE_1
+        apks = {
+            'd/base.apk': dumpey.apk.ApkInfo(package, 5, 'a' * 64, 'x', None),
+            'd/split.apk': dumpey.apk.ApkInfo(package, 5, 'b' * 64, 'y',
+                                              'config.arm64_v8a'),
+        }
+        self.assertEqual(set(apks), dumpey._unchanged_apks(device, apks))
+        # A changed split, or a base without its split, is installed again.
+        apks['d/split.apk'] = apks['d/split.apk']._replace(sha256='c' * 64)
+        self.assertEqual(set(), dumpey._unchanged_apks(device, apks))
+        del apks['d/split.apk']
+        self.assertEqual(set(), dumpey._unchanged_apks(device, apks))
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=21)
+    @mock.patch('dumpey.dumpey._identify_apks', autospec=True)
+    def test_install_files_splits(self, identify_mock, api_mock, popen_mock):
+        popen_mock.return_value = self.create_popen_mock(out='Success')
+        package = DumpeyTest.PACKAGE_1
+        identify_mock.return_value = {
+            'd/split.apk': dumpey.apk.ApkInfo(package, 1, 'c', 'd', 'config'),
+            'd/base.apk': dumpey.apk.ApkInfo(package, 1, 'a', 'b', None),
+            'e/base.apk': dumpey.apk.ApkInfo(package, 1, 'a', 'b', None),
+        }
+        device = DumpeyTest.DEVICE_1
+        files = ['d/split.apk', 'd/base.apk', 'e/base.apk']
+        out = dumpey._install_from_files(files, [device], 1, reinstall=True)
+        self.assertEqual(['d/base.apk', 'd/split.apk', 'e/base.apk'],
+                         out[device]['installed'])
+        self.assert_popen_mock(popen_mock, 2,
+                               ['adb', '-s', device, 'install-multiple', '-r',
+                                'd/base.apk', 'd/split.apk'],
+                               ['adb', '-s', device, 'install', '-r',
+                                'e/base.apk'])
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=21)
+    @mock.patch('dumpey.dumpey._identify_apks', autospec=True)
+    def test_install_files_two_bases(self, identify_mock, api_mock,
+                                     popen_mock):
+        popen_mock.return_value = self.create_popen_mock(out='Success')
+        package = DumpeyTest.PACKAGE_1
+        identify_mock.return_value = {
+            'd/app-debug.apk': dumpey.apk.ApkInfo(package, 1, 'a', 'b', None),
+            'd/app-release.apk': dumpey.apk.ApkInfo(package, 1, 'c', 'd',
+                                                    None),
+        }
+        device = DumpeyTest.DEVICE_1
+        files = ['d/app-debug.apk', 'd/app-release.apk']
+        out = dumpey._install_from_files(files, [device], 1, reinstall=True)
+        self.assertEqual(files, out[device]['installed'])
+        self.assert_popen_mock(popen_mock, 2,
+                               ['adb', '-s', device, 'install', '-r',
+                                'd/app-debug.apk'],
+                               ['adb', '-s', device, 'install', '-r',
+                                'd/app-release.apk'])
+
+    @mock.patch('dumpey.dumpey._warn')
+    @mock.patch('dumpey.dumpey.api_version', return_value=21)
+    def test_install_apks_unpaced(self, api_mock, warn_mock, popen_mock):
+        popen_mock.return_value = self.create_popen_mock(out='Success')
+        device = DumpeyTest.DEVICE_1
+        throttle = dumpey._HubThrottle(1, 1e6)
+        dumpey._install_apks(['a.apk'], device, throttle)
+        dumpey._install_apks(['b.apk'], device, throttle)
+        self.assert_popen_mock(popen_mock, 2,
+                               ['adb', '-s', device, 'install', '-r',
+                                'a.apk'],
+                               ['adb', '-s', device, 'install', '-r',
+                                'b.apk'])
+        self.assertEqual(1, warn_mock.call_count)
+        self.assertIn(device, warn_mock.call_args[0])
+
+    def test_usb_hubs(self, popen_mock):
+        out = ('List of devices attached\n'
+               '%s device usb:1-1.2 product:x model:y transport_id:1\n'
+               '%s device usb:1-1.3 product:x model:y transport_id:2\n'
+               '%s device usb:2-1 product:x model:y transport_id:3\n'
+               'emulator-5554 device product:x model:y transport_id:4\n'
+               % tuple(DumpeyTest.DEVICES))
+        popen_mock.return_value = self.create_popen_mock(out=out)
+        hubs = dumpey._usb_hubs(DumpeyTest.DEVICES + ['emulator-5554'])
+        self.assertEqual({DumpeyTest.DEVICE_1: '1-1',
+                          DumpeyTest.DEVICE_2: '1-1',
+                          DumpeyTest.DEVICE_3: '2',
+                          'emulator-5554': None}, hubs)
+        self.assert_popen_mock(popen_mock, 1, ['adb', 'devices', '-l'])
+
+    def test_token_bucket(self, popen_mock):
+        with FakeClock() as clock:
+            bucket = dumpey._TokenBucket(100)
+            bucket.consume(60)
+            bucket.consume(40)
+            self.assertEqual([], clock.sleeps)
+            bucket.consume(50)
+            self.assertEqual([0.5], clock.sleeps)
+            clock.now += 10
+            bucket.consume(150)
+            self.assertEqual([0.5, 0.5], clock.sleeps)
+
+    @mock.patch('os.listdir', return_value=['b.apk', 'a.apk', 'c.txt'])
+    @mock.patch('os.path.isdir', return_value=False)
+    def test_apk_files(self, isdir_mock, listdir_mock, popen_mock):
+        out = dumpey._apk_files(DumpeyTest.LOCAL_DIR, True)
+        self.assertEqual([DumpeyTest.LOCAL_DIR + '/a.apk',
+                          DumpeyTest.LOCAL_DIR + '/b.apk'],
+                         [p.replace('\\', '/') for p in out])
+        self.assert_called(popen_mock, 0)
 
     # MISSING TEST UNINSTALL
 
+    @mock.patch('dumpey.dumpey._remote_stat', autospec=True)
+    def test_wait_for_file(self, stat_mock, popen_mock):
+        clock = FakeClock()
+        stat_mock.side_effect = [None, (10, 1), (20, 1), (20, 1), (20, 1),
+                                 (20, 1), (20, 1), (20, 1)]
+        with clock:
+            size = dumpey.wait_for_file(DumpeyTest.DUMMY, DumpeyTest.DEVICE_1,
+                                        settle=0.1)
+        self.assertEqual(20, size)
+        # Polling starts fast and backs off once the file stops changing.
+        self.assertEqual([0.02, 0.04, 0.04, 0.04, 0.08], clock.sleeps)
+
+    @mock.patch('dumpey.dumpey._remote_stat', autospec=True)
+    def test_wait_for_file_settle_probes(self, stat_mock, popen_mock):
+        clock = FakeClock()
+        # The file is created once polling has backed off to the longest
+        # interval, which spans the whole settle time.
+        stat_mock.side_effect = [None] * 7 + [(20, 1)] * 3
+        with clock:
+            size = dumpey.wait_for_file(DumpeyTest.DUMMY, DumpeyTest.DEVICE_1,
+                                        settle=0.5)
+        self.assertEqual(20, size)
+        self.assertEqual(10, stat_mock.call_count)
+
+    @mock.patch('dumpey.dumpey._remote_stat', return_value=None)
+    def test_wait_for_file_timeout(self, stat_mock, popen_mock):
+        with FakeClock():
+            self.assertRaises(Exception, dumpey.wait_for_file,
+                              DumpeyTest.DUMMY, DumpeyTest.DEVICE_1, 2)
+
+    @mock.patch('dumpey.dumpey._remote_stat', return_value=(0, 1))
+    def test_wait_for_file_empty(self, stat_mock, popen_mock):
+        with FakeClock() as clock:
+            size = dumpey.wait_for_file(DumpeyTest.DUMMY, DumpeyTest.DEVICE_1)
+        self.assertEqual(0, size)
+        self.assertTrue(clock.now >= dumpey._WAIT_EMPTY_SETTLE)
+
+    def test_pipe(self, popen_mock):
+        producer = self.create_popen_mock()
+        producer.wait = mock.Mock(return_value=0)
+        consumer = self.create_popen_mock()
+        popen_mock.side_effect = [producer, consumer]
+        dumpey._pipe(['fst'], ['snd'])
+        popen_mock.assert_any_call(['fst'], stdout=subprocess.PIPE)
+        popen_mock.assert_any_call(['snd'], stdin=producer.stdout,
+                                   stdout=subprocess.PIPE)
+        producer.stdout.close.assert_called_once_with()
+
+    def test_pipe_raise(self, popen_mock):
+        producer = self.create_popen_mock()
+        producer.wait = mock.Mock(return_value=1)
+        popen_mock.side_effect = [producer, self.create_popen_mock()]
+        self.assertRaises(Exception, dumpey._pipe, ['fst'], ['snd'])
+
+    @mock.patch('dumpey.dumpey._find_executable', return_value='hprof-conv')
+    @mock.patch('dumpey.dumpey.ShellBatch.run', autospec=True)
+    @mock.patch('dumpey.dumpey._pipe', autospec=True)
+    @mock.patch('dumpey.dumpey._remote_stat', return_value=(611, 1))
+    @mock.patch('dumpey.dumpey.api_version', return_value=30)
+    def test_dump_heap_stream(self, api_mock, stat_mock, pipe_mock, run_mock,
+                              find_mock, popen_mock):
+        run_mock.side_effect = self.run_dumpheap
+        popen_mock.return_value = self.create_popen_mock()
+        device = DumpeyTest.DEVICE_1
+        remote = dumpey._REMOTE_HEAP_DUMP_PATH
+        local_file = dumpey._dump_heap(DumpeyTest.PACKAGE_1, device,
+                                       DumpeyTest.LOCAL_DIR, pid_str='101')
+        local = dumpey.os.path.join(DumpeyTest.LOCAL_DIR,
+                                    'dummy_device_1_com_dummy_package_fst'
+                                    '.hprof')
+        self.assertEqual(local, local_file)
+        pipe_mock.assert_called_once_with(
+            ['adb', '-s', device, 'exec-out', 'cat', remote],
+            ['hprof-conv', '-', local])
+        self.assert_called(run_mock, 1)
+        self.assert_popen_mock(popen_mock, 1,
+                               ['adb', '-s', device, 'shell', 'rm', '-f',
+                                remote])
+
+    @mock.patch('dumpey.dumpey._find_executable', return_value=None)
+    @mock.patch('dumpey.dumpey.ShellBatch.run', autospec=True)
+    @mock.patch('dumpey.dumpey._stream', autospec=True)
+    @mock.patch('dumpey.dumpey._remote_stat', return_value=(611, 1))
+    @mock.patch('dumpey.dumpey.api_version', return_value=30)
+    def test_dump_heap_builtin(self, api_mock, stat_mock, stream_mock,
+                               run_mock, find_mock, popen_mock):
+        run_mock.side_effect = self.run_dumpheap
+        popen_mock.return_value = self.create_popen_mock()
+        device = DumpeyTest.DEVICE_1
+        dumpey._dump_heap(DumpeyTest.PACKAGE_1, device, DumpeyTest.LOCAL_DIR,
+                          pid_str='101')
+        self.assert_called(stream_mock, 1)
+        self.assertEqual(['adb', '-s', device, 'exec-out', 'cat',
+                          dumpey._REMOTE_HEAP_DUMP_PATH],
+                         stream_mock.call_args[0][0])
+
+    @mock.patch('dumpey.dumpey.ShellBatch.run', autospec=True)
+    @mock.patch('dumpey.dumpey._pipe', autospec=True)
+    @mock.patch('dumpey.dumpey._remote_stat', return_value=None)
+    @mock.patch('dumpey.dumpey.api_version', return_value=30)
+    def test_dump_heap_empty(self, api_mock, stat_mock, pipe_mock, run_mock,
+                             popen_mock):
+        run_mock.side_effect = self.run_dumpheap
+        popen_mock.return_value = self.create_popen_mock()
+        self.assertIsNone(dumpey._dump_heap(DumpeyTest.PACKAGE_1,
+                                            DumpeyTest.DEVICE_1,
+                                            DumpeyTest.LOCAL_DIR,
+                                            pid_str='101'))
+        self.assert_called(pipe_mock, 0)
+
+    @mock.patch('dumpey.dumpey.ShellBatch.run', autospec=True)
+    @mock.patch('dumpey.dumpey.wait_for_file', autospec=True)
+    @mock.patch('dumpey.dumpey.api_version', return_value=23)
+    def test_dump_heap_failed(self, api_mock, wait_mock, run_mock,
+                              popen_mock):
+        for output, status in (('Error: Unable to open file: x\n', 0),
+                               ('java.lang.IllegalArgumentException: '
+                                'Unknown process: 101\n', 0),
+                               ('', 255)):
+            def run(batch):
+                batch.results = [('', 0), (output, status)]
+
+            run_mock.side_effect = run
+            with self.assertRaises(Exception) as cm:
+                dumpey._dump_heap(DumpeyTest.PACKAGE_1, DumpeyTest.DEVICE_1,
+                                  DumpeyTest.LOCAL_DIR, pid_str='101')
+            self.assertIn(output.strip(), str(cm.exception))
+        self.assert_called(wait_mock, 0)
+
+    @staticmethod
+    def run_dumpheap(batch):
+        batch.results = [('', 0)] * len(batch.commands)
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=23)
+    def test_remote_stat(self, api_mock, popen_mock):
+        popen_mock.return_value = self.create_popen_mock(out='611 1420070400')
+        device = DumpeyTest.DEVICE_1
+        remote = DumpeyTest.DUMMY
+        self.assertEqual((611, 1420070400), dumpey._remote_stat(remote, device))
+        self.assert_popen_mock(popen_mock, 1,
+                               ['adb', '-s', device, 'shell', 'stat', '-c',
+                                "'%s %Y'", remote, '2>/dev/null || true'])
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=18)
+    def test_remote_stat_ls(self, api_mock, popen_mock):
+        popen_mock.return_value = self.create_popen_mock(out='')
+        self.assertIsNone(dumpey._remote_stat(DumpeyTest.DUMMY,
+                                              DumpeyTest.DEVICE_1))
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=30)
+    def test_wait_for_file_missing_status(self, api_mock, popen_mock):
+        # Over shell v2, stat exits with 1 until the file exists.
+        stats = iter([None, None, '611 1', '611 1', '611 1'])
+
+        def popen(args, **kwargs):
+            out = next(stats)
+            ignored = args[-1].endswith('|| true')
+            return self.create_popen_mock(
+                exit_value=1 if out is None and not ignored else 0,
+                out=out or '')
+
+        popen_mock.side_effect = popen
+        with FakeClock():
+            size = dumpey.wait_for_file(DumpeyTest.DUMMY, DumpeyTest.DEVICE_1,
+                                        settle=0.1)
+        self.assertEqual(611, size)
+        self.assert_called(popen_mock, 5)
+
     def test_package_list_no_regex(self, popen_mock):
         package = DumpeyTest.PACKAGE_1
         raw = "\npackage:%s\n" % package
@@ -246,6 +738,37 @@ class DumpeyTest(unittest.TestCase):
                                ['adb', '-s', device, 'shell', 'pm', 'list',
                                 'packages'])
 
+    def test_package_list_cached(self, popen_mock):
+        raw = "\npackage:%s\npackage:%s\n" % (DumpeyTest.PACKAGE_1,
+                                                DumpeyTest.PACKAGE_2)
+        popen_mock.return_value = self.create_popen_mock(out=raw)
+        device = DumpeyTest.DEVICE_1
+        dumpey._package_list(device, None)
+        out = dumpey._package_list(device, re.compile("snd"))
+        self.assertEqual([DumpeyTest.PACKAGE_2], out)
+        self.assert_called(popen_mock, 1)
+        dumpey._package_list(device, None, refresh=True)
+        self.assert_called(popen_mock, 2)
+
+    def test_package_list_expired(self, popen_mock):
+        popen_mock.return_value = self.create_popen_mock()
+        device = DumpeyTest.DEVICE_1
+        with mock.patch('time.time', return_value=0):
+            dumpey._package_list(device, None)
+        with mock.patch('time.time', return_value=dumpey._PACKAGE_CACHE_TTL):
+            dumpey._package_list(device, None)
+        self.assert_called(popen_mock, 2)
+
+    def test_package_list_invalidated(self, popen_mock):
+        popen_mock.return_value = self.create_popen_mock()
+        device = DumpeyTest.DEVICE_1
+        dumpey._package_list(device, None)
+        dumpey._uninstall_package(DumpeyTest.PACKAGE_1, device)
+        dumpey._package_list(device, None)
+        dumpey._reboot(device)
+        dumpey._package_list(device, None)
+        self.assert_called(popen_mock, 5)
+
     def test_pull_progress(self, popen_mock):
         self.exec_pull(popen_mock, True)
 
@@ -287,15 +810,35 @@ class DumpeyTest(unittest.TestCase):
 
     @mock.patch('dumpey.dumpey.pull', autospec=True)
     @mock.patch('dumpey.dumpey.remove_file', autospec=True)
-    def test_snapshot(self, remove_mock, pull_mock, popen_mock):
+    @mock.patch('dumpey.dumpey.api_version', return_value=19)
+    def test_snapshot(self, api_mock, remove_mock, pull_mock, popen_mock):
         popen_mock.return_value = self.create_popen_mock()
         device = DumpeyTest.DEVICE_1
-        dumpey._screenshot(device, DumpeyTest.LOCAL_DIR)
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        dumpey._screenshot(device, tmp_dir)
         self.assert_popen_mock(popen_mock, 1,
                                ['adb', '-s', device, 'shell', 'screencap',
                                 dumpey._REMOTE_SCREENSHOT_PATH])
         self.assert_called(pull_mock, 1)
         self.assert_called(remove_mock, 1)
+        self.assertEqual(1, len(dumpey.os.listdir(tmp_dir)))
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=21)
+    def test_snapshot_exec_out(self, api_mock, popen_mock):
+        popen_mock.return_value = self.create_popen_mock(out=b'png')
+        device = DumpeyTest.DEVICE_1
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        dumpey._screenshot(device, tmp_dir, 'gzip')
+        self.assert_popen_mock(popen_mock, 1,
+                               ['adb', '-s', device, 'exec-out', 'screencap',
+                                '-p'])
+        names = dumpey.os.listdir(tmp_dir)
+        self.assertTrue(names[0].endswith('.png.gz'))
+        with dumpey.compress.open_read(dumpey.os.path.join(tmp_dir,
+                                                           names[0])) as f:
+            self.assertEqual(b'png', f.read())
 
     @mock.patch('dumpey.dumpey.attached_devices', autospec=True)
     def test_snapshots_raise(self, attached_mock, popen_mock):
@@ -303,15 +846,54 @@ class DumpeyTest(unittest.TestCase):
         self.assertRaises(Exception, dumpey.snapshots)
         self.assert_called(popen_mock, 0)
 
+    @mock.patch('dumpey.dumpey._screenshot', autospec=True)
     @mock.patch('dumpey.dumpey.attached_devices', autospec=True)
-    def test_snapshots(self, attached_mock, popen_mock):
-        popen_mock.return_value = self.create_popen_mock()
+    def test_snapshots(self, attached_mock, screenshot_mock, popen_mock):
         device = DumpeyTest.DEVICE_1
         attached_mock.return_value = [device]
-        dumpey.snapshots()
-        self.assert_popen_mock(popen_mock, 3,  # snap + pull + remove
-                               ['adb', '-s', device, 'shell', 'screencap',
-                                dumpey._REMOTE_SCREENSHOT_PATH])
+        dumpey.snapshots(local_dir=DumpeyTest.LOCAL_DIR)
+        screenshot_mock.assert_called_once_with(device, DumpeyTest.LOCAL_DIR,
+                                                None)
+        self.assert_called(popen_mock, 0)
+
+    @mock.patch('dumpey.dumpey._capture_png', return_value=b'png')
+    def test_snapshots_burst(self, capture_mock, popen_mock):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        with FakeClock() as clock:
+            frames = dumpey.snapshots(local_dir=tmp_dir, interval=0.5,
+                                      count=3, devices=DumpeyTest.DEVICES)
+        self.assertEqual(dict((d, 3) for d in DumpeyTest.DEVICES), frames)
+        self.assert_called(capture_mock, 9)
+        names = sorted(dumpey.os.listdir(tmp_dir))
+        self.assertEqual(9, len(names))
+        self.assertTrue(names[0].startswith('dummy_device_1_0_00000'))
+        self.assertTrue(all(s <= 0.5 for s in clock.sleeps))
+        self.assert_called(popen_mock, 0)
+
+    @mock.patch('dumpey.dumpey._capture_png', return_value=b'png')
+    def test_capture_frames_behind(self, capture_mock, popen_mock):
+        writer = mock.Mock()
+        stop = dumpey.threading.Event()
+        with FakeClock() as clock:
+            capture_mock.side_effect = lambda d: clock.sleep(0.3) or b'png'
+            count = dumpey._capture_frames(DumpeyTest.DEVICE_1, 'dir', None,
+                                           0.2, 3, writer, stop)
+        self.assertEqual(3, count)
+        self.assert_called(writer.put, 3)
+        # Captures slower than the interval go on without sleeping.
+        self.assertEqual([0.3] * 3, clock.sleeps)
+
+    def test_frame_writer(self, popen_mock):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        writer = dumpey._FrameWriter(None, 1)
+        for i in range(3):
+            writer.put(dumpey.os.path.join(tmp_dir, '%d.png' % i), b'png')
+        writer.put(dumpey.os.path.join(tmp_dir, 'missing', 'x.png'), b'png')
+        writer.close()
+        self.assertEqual(['0.png', '1.png', '2.png'],
+                         sorted(dumpey.os.listdir(tmp_dir)))
 
     def test_uninstall_package(self, popen_mock):
         popen_mock.return_value = self.create_popen_mock()
@@ -345,17 +927,82 @@ class DumpeyTest(unittest.TestCase):
                                ['adb', '-s', device, 'shell', 'pm', 'path',
                                 package])
 
-    def test_pull_apk_multiple(self, popen_mock):
+    def test_pull_apk_split(self, popen_mock):
         popen_mock.return_value = self.create_popen_mock(
-            out='package:fst\npackage:snd'
+            out='package:/data/app/fst/base.apk\n'
+                'package:/data/app/fst/split_config.en.apk'
         )
         package = DumpeyTest.PACKAGE_1
         device = DumpeyTest.DEVICE_1
         local_dir = DumpeyTest.LOCAL_DIR
         dumpey._pull_apk(package, device, local_dir)
-        self.assert_popen_mock(popen_mock, 1,
+        self.assert_popen_mock(popen_mock, 3,  # path + 2 pulls
                                ['adb', '-s', device, 'shell', 'pm', 'path',
                                 package])
+        self.assertEqual(
+            ['adb', '-s', device, 'pull', '-p',
+             '/data/app/fst/split_config.en.apk',
+             dumpey.os.path.join(local_dir, 'dummy_device_1_com_dummy_'
+                                            'package_fst_split_config_en_'
+                                            'apk.apk')],
+            popen_mock.call_args[0][0])
+
+    def perform_pull_apk_store_test(self, run_mock, popen_mock, store,
+                                    device, local_dir, digest, size='3'):
+        path = '/data/app/fst/base.apk'
+        outputs = {
+            'dumpsys package %s' % DumpeyTest.PACKAGE_1:
+                '    versionCode=5 minSdk=21 targetSdk=30\n',
+            dumpey._DIGEST_COMMAND % (path, path): digest,
+            dumpey._SIZE_COMMAND % (path, path): size,
+        }
+
+        def run(batch):
+            batch.results = [(outputs[dumpey._shell_str(c)], 0)
+                             for c in batch.commands]
+
+        def popen(args, stdout):
+            if 'pull' in args:
+                with open(args[-1], 'wb') as f:
+                    f.write(b'apk')
+            return self.create_popen_mock(out='package:%s\n' % path)
+
+        run_mock.side_effect = run
+        popen_mock.side_effect = popen
+        dumpey._pull_apk(DumpeyTest.PACKAGE_1, device, local_dir,
+                         store=store)
+
+    @mock.patch('dumpey.dumpey.ShellBatch.run', autospec=True)
+    def test_pull_apk_store(self, run_mock, popen_mock):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        store = dumpey.apkstore.ApkStore(dumpey.os.path.join(tmp_dir, 's'))
+        self.perform_pull_apk_store_test(run_mock, popen_mock, store,
+                                         DumpeyTest.DEVICE_1, tmp_dir,
+                                         'f' * 64 + '  base.apk')
+        self.assert_called(popen_mock, 2)  # path + pull
+        entries = store.entries()
+        self.assertEqual([(DumpeyTest.PACKAGE_1, 5, 3)],
+                         [e[:3] for e in entries])
+        local = dumpey.os.path.join(tmp_dir, 'dummy_device_1_base_apk.apk')
+        self.assertTrue(dumpey.os.path.samefile(store.path(entries[0].sha256),
+                                                local))
+
+        # A device without sha256sum, matched by MD5
+        popen_mock.reset_mock()
+        self.perform_pull_apk_store_test(run_mock, popen_mock, store,
+                                         DumpeyTest.DEVICE_2, None,
+                                         entries[0].md5.upper())
+        self.assert_called(popen_mock, 1)  # path only
+        # A device that can't hash, matched by size
+        popen_mock.reset_mock()
+        self.perform_pull_apk_store_test(run_mock, popen_mock, store,
+                                         DumpeyTest.DEVICE_3, None, '',
+                                         '-rw-r--r-- system system 3 base')
+        self.assert_called(popen_mock, 1)
+        self.assertEqual(1, len(store.entries()))
+        self.assertEqual(DumpeyTest.DEVICES,
+                         [e.device for e in store.manifest()])
 
     def test_pull_apk_ok(self, popen_mock):
         package = DumpeyTest.PACKAGE_1
@@ -371,6 +1018,19 @@ class DumpeyTest(unittest.TestCase):
                                ['adb', '-s', device, 'shell', 'pm', 'path',
                                 package])
 
+    @mock.patch('dumpey.dumpey._stream', autospec=True)
+    @mock.patch('dumpey.dumpey.api_version', return_value=21)
+    def test_pull_apk_compressed(self, api_mock, stream_mock, popen_mock):
+        package = DumpeyTest.PACKAGE_1
+        raw = 'package:/data/app/%s.apk\n' % package
+        popen_mock.return_value = self.create_popen_mock(out=raw)
+        device = DumpeyTest.DEVICE_1
+        dumpey._pull_apk(package, device, DumpeyTest.LOCAL_DIR, 'gzip')
+        self.assert_called(popen_mock, 1)
+        self.assertEqual(['adb', '-s', device, 'exec-out', 'cat',
+                          '/data/app/%s.apk' % package],
+                         stream_mock.call_args[0][0])
+
     @mock.patch('dumpey.dumpey.attached_devices')
     def test_monkey(self, attached_mock, popen_mock):
         devices = DumpeyTest.DEVICES
@@ -390,7 +1050,79 @@ class DumpeyTest(unittest.TestCase):
         self.assert_called(before, size)
         self.assert_called(after, size)
 
-    def test_pid_ok(self, popen_mock):
+    @mock.patch('dumpey.dumpey._write_meminfo', autospec=True)
+    @mock.patch('dumpey.dumpey.meminfo.Sampler', autospec=True)
+    def test_monkey_meminfo(self, sampler_mock, write_mock, popen_mock):
+        popen_mock.return_value = self.create_popen_mock()
+        package = DumpeyTest.PACKAGE_1
+        device = DumpeyTest.DEVICE_1
+        dumpey.monkey(package, devices=[device], seed=1, meminfo_interval=0.5,
+                      local_dir=DumpeyTest.LOCAL_DIR, meminfo_format='ndjson')
+        self.assertEqual(0.5, sampler_mock.call_args[0][1])
+        sampler = sampler_mock.return_value
+        sampler.start.assert_called_once_with(package, device)
+        sampler.stop.assert_called_once_with(package, device)
+        write_mock.assert_called_once_with(package, device,
+                                           sampler.stop.return_value,
+                                           DumpeyTest.LOCAL_DIR, 'ndjson')
+        # The query runs dumpsys meminfo.
+        popen_mock.reset_mock()
+        sampler_mock.call_args[0][0](package, device)
+        self.assert_popen_mock(popen_mock, 1,
+                               ['adb', '-s', device, 'shell', 'dumpsys',
+                                'meminfo', package])
+
+    @mock.patch('dumpey.dumpey.ShellBatch.run', autospec=True)
+    @mock.patch('dumpey.dumpey._package_list', autospec=True)
+    def test_memory_usage(self, list_mock, run_mock, popen_mock):
+        list_mock.return_value = [DumpeyTest.PACKAGE_1, DumpeyTest.PACKAGE_2]
+        outputs = {
+            'dumpsys meminfo %s' % DumpeyTest.PACKAGE_1:
+                ' App Summary\n  Java Heap:  30\n  TOTAL:  100\n',
+            'dumpsys meminfo %s' % DumpeyTest.PACKAGE_2:
+                'No process found for: %s\n' % DumpeyTest.PACKAGE_2,
+        }
+
+        def run(batch):
+            batch.results = [(outputs[dumpey._shell_str(c)], 0)
+                             for c in batch.commands]
+
+        run_mock.side_effect = run
+        devices = [DumpeyTest.DEVICE_1, DumpeyTest.DEVICE_2]
+        usage = dumpey.memory_usage(devices, 'dummy')
+        sample = {'pss': 100, 'java_heap': 30, 'native_heap': None,
+                  'graphics': None}
+        self.assertEqual(dict((d, {DumpeyTest.PACKAGE_1: sample})
+                              for d in devices), usage)
+        self.assert_called(run_mock, 2)
+        self.assertEqual('dummy', list_mock.call_args[0][1].pattern)
+        self.assert_called(popen_mock, 0)
+
+    @mock.patch('dumpey.dumpey.memory_usage', autospec=True)
+    def test_handle_memory_repeat(self, usage_mock, popen_mock):
+        usage_mock.side_effect = [
+            {DumpeyTest.DEVICE_1: {DumpeyTest.PACKAGE_1: {'pss': 1}}},
+            dumpey.DeviceError({DumpeyTest.DEVICE_2: {}},
+                               {DumpeyTest.DEVICE_1: Exception('offline')}),
+            {DumpeyTest.DEVICE_1: {DumpeyTest.PACKAGE_1: {'pss': 3}}},
+        ]
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        local_file = dumpey.os.path.join(tmp_dir, 'fleet.csv')
+        with FakeClock() as clock:
+            dumpey._handle_memory(None, None, None, local_file, repeat=10,
+                                  count=3)
+        self.assertEqual([10, 10], clock.sleeps)
+        with open(local_file) as f:
+            lines = f.read().splitlines()
+        self.assertEqual(3, len(lines))
+        self.assertTrue(lines[0].startswith('time,device,package,pss'))
+        self.assertTrue(lines[2].startswith('20.000,%s,%s,3,'
+                                            % (DumpeyTest.DEVICE_1,
+                                               DumpeyTest.PACKAGE_1)))
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=18)
+    def test_pid_ok(self, api_mock, popen_mock):
         package = DumpeyTest.PACKAGE_1
         device = DumpeyTest.DEVICE_1
         raw = 'root   31187 2   0   0   ffffffff 00000000 S %s' % package
@@ -400,7 +1132,8 @@ class DumpeyTest(unittest.TestCase):
         self.assert_popen_mock(popen_mock, 1,
                                ['adb', '-s', device, 'shell', 'ps'])
 
-    def test_pid_retry(self, popen_mock):
+    @mock.patch('dumpey.dumpey.api_version', return_value=18)
+    def test_pid_retry(self, api_mock, popen_mock):
         popen_mock.return_value = self.create_popen_mock()
         package = DumpeyTest.PACKAGE_1
         device = DumpeyTest.DEVICE_1
@@ -410,6 +1143,60 @@ class DumpeyTest(unittest.TestCase):
                                 package, '-s', str(0), str(1)],
                                ['adb', '-s', device, 'shell', 'ps'])
 
+    @mock.patch('dumpey.dumpey.api_version', return_value=18)
+    def test_pids_ps(self, api_mock, popen_mock):
+        raw = ('USER     PID   PPID  VSIZE  RSS     WCHAN    PC         NAME\n'
+               'u0_a1    101   99    0      0       ffffffff 00000000 S %s\n'
+               'u0_a1    102   99    0      0       ffffffff 00000000 S %s:bg\n'
+               'u0_a2    103   99    0      0       ffffffff 00000000 S %s\n'
+               % (DumpeyTest.PACKAGE_1, DumpeyTest.PACKAGE_1,
+                  DumpeyTest.PACKAGE_2))
+        popen_mock.return_value = self.create_popen_mock(out=raw)
+        device = DumpeyTest.DEVICE_1
+        out = dumpey.pids(DumpeyTest.PACKAGES, device)
+        self.assertEqual({DumpeyTest.PACKAGE_1: ['101'],
+                          DumpeyTest.PACKAGE_2: ['103'],
+                          DumpeyTest.PACKAGE_3: []}, out)
+        self.assert_popen_mock(popen_mock, 1,
+                               ['adb', '-s', device, 'shell', 'ps'])
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=26)
+    def test_process_table_all(self, api_mock, popen_mock):
+        popen_mock.return_value = self.create_popen_mock()
+        device = DumpeyTest.DEVICE_1
+        table = dumpey.ProcessTable.load(device)
+        self.assertEqual([], table.pids(DumpeyTest.PACKAGE_1))
+        self.assert_popen_mock(popen_mock, 1,
+                               ['adb', '-s', device, 'shell', 'ps', '-A'])
+
+    @mock.patch('dumpey.dumpey.api_version', return_value=24)
+    @mock.patch('random.randint', return_value=7)
+    def test_pids_pidof(self, randint_mock, api_mock, popen_mock):
+        raw = ('_dumpey_7_B0\n101\n\n_dumpey_7_E0 0\n'
+               '_dumpey_7_B1\n\n_dumpey_7_E1 1\n'
+               '_dumpey_7_B2\n103 104\n\n_dumpey_7_E2 0\n')
+        popen_mock.return_value = self.create_popen_mock(out=raw)
+        out = dumpey.pids(DumpeyTest.PACKAGES, DumpeyTest.DEVICE_1)
+        self.assertEqual({DumpeyTest.PACKAGE_1: ['101'],
+                          DumpeyTest.PACKAGE_2: [],
+                          DumpeyTest.PACKAGE_3: ['103', '104']}, out)
+        self.assert_called(popen_mock, 1)
+
+    @mock.patch('dumpey.dumpey._dump_heap', autospec=True)
+    @mock.patch('dumpey.dumpey.pids', autospec=True)
+    def test_dump_heaps(self, pids_mock, dump_heap_mock, popen_mock):
+        pids_mock.return_value = {DumpeyTest.PACKAGE_1: ['101'],
+                                  DumpeyTest.PACKAGE_2: []}
+        device = DumpeyTest.DEVICE_1
+        local_dir = DumpeyTest.LOCAL_DIR
+        dumpey._dump_heaps([DumpeyTest.PACKAGE_1, DumpeyTest.PACKAGE_2],
+                           device, local_dir)
+        self.assert_called(pids_mock, 1)
+        dump_heap_mock.assert_any_call(DumpeyTest.PACKAGE_1, device,
+                                       local_dir, None, None, '101')
+        dump_heap_mock.assert_any_call(DumpeyTest.PACKAGE_2, device,
+                                       local_dir, None, None, None)
+
     @mock.patch('dumpey.dumpey.api_version', return_value=10)
     def test_dump_heap_bad_version(self, api_mock, popen_mock):
         package = DumpeyTest.PACKAGE_1
@@ -456,5 +1243,31 @@ class DumpeyTest(unittest.TestCase):
         self.assertEquals(count, mock_obj.call_count)
 
 
+class FakeClock(object):
+    """Patches time.sleep and time.time, sleeping only advances time."""
+
+    def __init__(self):
+        self.now = 0.0
+        self.sleeps = []
+        self.patches = [mock.patch('time.sleep', side_effect=self.sleep),
+                        mock.patch('time.time', side_effect=self.time)]
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+    def time(self):
+        return self.now
+
+    def __enter__(self):
+        for patch in self.patches:
+            patch.start()
+        return self
+
+    def __exit__(self, *args):
+        for patch in self.patches:
+            patch.stop()
+
+
 if __name__ == '__main__':
     unittest.main()
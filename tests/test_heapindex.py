@@ -0,0 +1,97 @@
+from dumpey import compress
+from dumpey import heapindex
+from dumpey import hprof
+
+from tests.test_hprof import HprofBuilder, u4
+
+import unittest
+import tempfile
+import shutil
+import mock
+import os
+
+
+class HeapIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'dump.hprof')
+        self.write_dump()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def write_dump(self, instances=5, codec=None):
+        b = HprofBuilder(8)
+        b.string(1, b'java.lang.String')
+        b.load_class(0x10, 1)
+        b.string(2, b'com/dummy/Cache')
+        b.load_class(0x11, 2)
+        segment = (b.class_dump(0x10, 0, 4, []) +
+                   b.class_dump(0x11, 0, 0, []))
+        # Object ids are written out of order, to be sorted by the index.
+        for i in reversed(range(instances)):
+            segment += b.instance(0x100 + i, 0x10, u4(i))
+        segment += b.object_array(0x50, 0x11, [0x100, 0x101])
+        segment += b.primitive_array(0x60, 8, b'\1' * 100)
+        segment += b.primitive_array(0x61, 10, b'\2' * 400)
+        segment += b.primitive_array(0x62, 8, b'\0' * 40,
+                                     hprof.PRIMITIVE_ARRAY_NODATA_DUMP)
+        b.record(hprof.TAG_HEAP_DUMP_SEGMENT, segment)
+        b.record(hprof.TAG_HEAP_DUMP_END, b'')
+        with compress.open_write(self.path, codec) as f:
+            f.write(b.data)
+
+    def perform_query_test(self):
+        with heapindex.HeapIndex(self.path) as index:
+            self.assertEqual(11, len(index))
+            record = index.get(0x102)
+            self.assertEqual((0x102, 0x10, 4, heapindex.INSTANCE),
+                             (record.object_id, record.class_id, record.size,
+                              record.kind))
+            self.assertEqual(u4(2), index.data(record))
+            self.assertIsNone(index.get(0x99))
+            self.assertEqual('java.lang.String', index.class_name(0x10))
+
+            instances = list(index.instances('java.lang.String'))
+            self.assertEqual(list(range(0x100, 0x105)),
+                             [r.object_id for r in instances])
+            array = list(index.instances(0x11))
+            self.assertEqual([0x50], [r.object_id for r in array])
+            self.assertEqual(HprofBuilder(8).ident(0x100) +
+                             HprofBuilder(8).ident(0x101),
+                             index.data(array[0]))
+            self.assertEqual([], list(index.instances('com.dummy.Missing')))
+
+            largest = index.largest_arrays(2)
+            self.assertEqual([0x61, 0x60], [r.object_id for r in largest])
+            self.assertEqual(b'\2' * 400, index.data(largest[0]))
+            bytes_arrays = index.largest_arrays(kind=8)
+            self.assertEqual([0x60, 0x62], [r.object_id for r in bytes_arrays])
+            self.assertIsNone(index.data(bytes_arrays[1]))
+            self.assertIsNone(index.data(index.get(0x10)))
+
+    def test_query(self):
+        self.perform_query_test()
+        self.assertTrue(os.path.exists(self.path + heapindex.INDEX_EXTENSION))
+
+    @mock.patch('dumpey.heapindex._SORT_RUN', 3)
+    def test_query_merged_runs(self):
+        self.perform_query_test()
+        self.assertEqual(['dump.hprof', 'dump.hprof.idx'],
+                         sorted(os.listdir(self.tmp_dir)))
+
+    def test_rebuild_stale_index(self):
+        heapindex.build_index(self.path)
+        self.write_dump(instances=2)
+        os.utime(self.path, (0, 0))
+        with heapindex.HeapIndex(self.path) as index:
+            self.assertEqual(2, len(list(index.instances(0x10))))
+
+    def test_compressed(self):
+        self.write_dump(codec=compress.GZIP)
+        self.assertRaises(Exception, heapindex.build_index, self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
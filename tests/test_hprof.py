@@ -0,0 +1,236 @@
+from dumpey import hprof
+
+import unittest
+import struct
+import io
+
+
+def u1(value):
+    return struct.pack('>B', value)
+
+
+def u2(value):
+    return struct.pack('>H', value)
+
+
+def u4(value):
+    return struct.pack('>I', value)
+
+
+class HprofBuilder(object):
+    """Builds heap dumps with a given id size, record by record."""
+
+    def __init__(self, id_size=4, version=hprof.ANDROID_VERSION):
+        self.id_size = id_size
+        self.data = version + b'\0' + u4(id_size) + b'\0' * 8
+
+    def ident(self, value):
+        return struct.pack('>I' if self.id_size == 4 else '>Q', value)
+
+    def record(self, tag, body):
+        self.data += u1(tag) + u4(0) + u4(len(body)) + body
+
+    def string(self, string_id, value):
+        self.record(hprof.TAG_STRING, self.ident(string_id) + value)
+
+    def load_class(self, class_id, name_id):
+        self.record(hprof.TAG_LOAD_CLASS, u4(1) + self.ident(class_id) +
+                    u4(0) + self.ident(name_id))
+
+    def root(self, tag, object_id, extra=b''):
+        return u1(tag) + self.ident(object_id) + extra
+
+    def class_dump(self, class_id, super_id, instance_size, fields):
+        ident = self.ident
+        body = (u1(hprof.CLASS_DUMP) + ident(class_id) + u4(0) +
+                ident(super_id) + ident(0) * 5 + u4(instance_size))
+        # One constant, one static int and one static object.
+        body += u2(1) + u2(0) + u1(10) + u4(7)
+        body += u2(2) + ident(90) + u1(10) + u4(8)
+        body += ident(91) + u1(hprof.TYPE_OBJECT) + ident(0x100)
+        body += u2(len(fields))
+        for name_id, kind in fields:
+            body += ident(name_id) + u1(kind)
+        return body
+
+    def instance(self, object_id, class_id, data):
+        return (u1(hprof.INSTANCE_DUMP) + self.ident(object_id) + u4(0) +
+                self.ident(class_id) + u4(len(data)) + data)
+
+    def object_array(self, object_id, class_id, elements):
+        return (u1(hprof.OBJECT_ARRAY_DUMP) + self.ident(object_id) + u4(0) +
+                u4(len(elements)) + self.ident(class_id) +
+                b''.join(self.ident(e) for e in elements))
+
+    def primitive_array(self, object_id, kind, data, tag=None):
+        size = hprof.TYPE_SIZES[kind]
+        head = (self.ident(object_id) + u4(0) + u4(len(data) // size) +
+                u1(kind))
+        if tag == hprof.PRIMITIVE_ARRAY_NODATA_DUMP:
+            return u1(tag) + head
+        return u1(hprof.PRIMITIVE_ARRAY_DUMP) + head + data
+
+
+def parse(data):
+    """Return the header and the list of (tag, body) records of a dump."""
+    end = data.index(b'\0')
+    version = data[:end]
+    id_size = struct.unpack_from('>I', data, end + 1)[0]
+    pos = end + 13
+    records = []
+    while pos < len(data):
+        tag, _, length = struct.unpack_from('>BII', data, pos)
+        pos += 9
+        records.append((tag, data[pos:pos + length]))
+        pos += length
+    return version, id_size, records
+
+
+class RecordingVisitor(hprof.HeapVisitor):
+    """Records the visitor calls walk() makes."""
+
+    want_data = True
+
+    def __init__(self):
+        self.calls = []
+
+    def string(self, *args):
+        self.calls.append(('string',) + args)
+
+    def load_class(self, *args):
+        self.calls.append(('load_class',) + args)
+
+    def root(self, *args):
+        self.calls.append(('root',) + args)
+
+    def class_dump(self, *args):
+        self.calls.append(('class_dump',) + args)
+
+    def instance(self, *args):
+        self.calls.append(('instance',) + args)
+
+    def object_array(self, *args):
+        self.calls.append(('object_array',) + args)
+
+    def primitive_array(self, *args):
+        self.calls.append(('primitive_array',) + args)
+
+
+class HprofTest(unittest.TestCase):
+
+    def convert(self, data, buffer_size=7):
+        dst = io.BytesIO()
+        hprof.convert(io.BytesIO(data), dst, buffer_size)
+        return dst.getvalue()
+
+    def perform_convert_test(self, id_size):
+        b = HprofBuilder(id_size)
+        b.string(1, b'java.lang.Object')
+        b.load_class(0x10, 1)
+        big = bytes(bytearray(range(256))) * 300
+        segment = (
+            u1(hprof.HEAP_DUMP_INFO) + u4(1) + b.ident(2) +
+            b.root(hprof.ROOT_INTERNED_STRING, 0x20) +
+            b.root(hprof.ROOT_JNI_MONITOR, 0x21, u4(1) + u4(2)) +
+            b.root(hprof.ROOT_JNI_GLOBAL, 0x22, b.ident(0x23)) +
+            b.class_dump(0x10, 0, 4, [(92, 10)]) +
+            b.instance(0x30, 0x10, u4(5)) +
+            b.object_array(0x31, 0x11, [0x30, 0]) +
+            b.primitive_array(0x32, 8, big) +
+            b.primitive_array(0x33, 10, b'\0' * 12,
+                              hprof.PRIMITIVE_ARRAY_NODATA_DUMP))
+        b.record(hprof.TAG_HEAP_DUMP_SEGMENT, segment)
+        b.record(hprof.TAG_HEAP_DUMP_END, b'')
+
+        version, out_id_size, records = parse(self.convert(b.data))
+        self.assertEqual(hprof.J2SE_VERSION, version)
+        self.assertEqual(id_size, out_id_size)
+        tags = [tag for tag, _ in records]
+        self.assertEqual([hprof.TAG_STRING, hprof.TAG_LOAD_CLASS], tags[:2])
+        self.assertEqual(hprof.TAG_HEAP_DUMP_END, tags[-1])
+        self.assertTrue(all(t == hprof.TAG_HEAP_DUMP_SEGMENT
+                            for t in tags[2:-1]))
+
+        expected = (
+            b.root(hprof.ROOT_UNKNOWN, 0x20) +
+            b.root(hprof.ROOT_UNKNOWN, 0x21) +
+            b.root(hprof.ROOT_JNI_GLOBAL, 0x22, b.ident(0x23)) +
+            b.class_dump(0x10, 0, 4, [(92, 10)]) +
+            b.instance(0x30, 0x10, u4(5)) +
+            b.object_array(0x31, 0x11, [0x30, 0]) +
+            b.primitive_array(0x32, 8, big) +
+            b.primitive_array(0x33, 10, b'\0' * 12))
+        body = b''.join(body for _, body in records[2:-1])
+        self.assertEqual(expected, body)
+
+    def test_convert_id4(self):
+        self.perform_convert_test(4)
+
+    def test_convert_id8(self):
+        self.perform_convert_test(8)
+
+    def test_convert_heap_dump(self):
+        b = HprofBuilder()
+        b.record(hprof.TAG_HEAP_DUMP, b.root(hprof.ROOT_DEBUGGER, 1))
+        _, _, records = parse(self.convert(b.data))
+        self.assertEqual([(hprof.TAG_HEAP_DUMP_SEGMENT,
+                           b.root(hprof.ROOT_UNKNOWN, 1)),
+                          (hprof.TAG_HEAP_DUMP_END, b'')], records)
+
+    def test_convert_j2se(self):
+        b = HprofBuilder(version=hprof.J2SE_VERSION)
+        b.string(1, b'java.lang.Object')
+        b.record(hprof.TAG_HEAP_DUMP_SEGMENT, b.instance(1, 2, u4(3)))
+        b.record(hprof.TAG_HEAP_DUMP_END, b'')
+        self.assertEqual(b.data, self.convert(b.data, 4096))
+
+    def test_convert_not_hprof(self):
+        self.assertRaises(hprof.HprofError, self.convert, b'PK\3\4' * 20)
+
+    def test_convert_truncated(self):
+        b = HprofBuilder()
+        b.record(hprof.TAG_HEAP_DUMP_SEGMENT, b.instance(1, 2, u4(3)))
+        self.assertRaises(hprof.HprofError, self.convert, b.data[:-2])
+
+    def test_convert_unknown_sub_record(self):
+        b = HprofBuilder()
+        b.record(hprof.TAG_HEAP_DUMP_SEGMENT, u1(0x42) + b.ident(1))
+        self.assertRaises(hprof.HprofError, self.convert, b.data)
+
+    def test_walk(self):
+        b = HprofBuilder(8)
+        b.string(1, b'java.lang.Object')
+        b.load_class(0x10, 1)
+        parts = [b.root(hprof.ROOT_INTERNED_STRING, 0x20),
+                 b.class_dump(0x10, 0, 4, [(92, 10)]),
+                 b.instance(0x30, 0x10, u4(5)),
+                 b.object_array(0x31, 0x11, [0x30, 0]),
+                 b.primitive_array(0x33, 10, b'\0' * 12,
+                                   hprof.PRIMITIVE_ARRAY_NODATA_DUMP)]
+        start = len(b.data) + 9
+        offsets = [start + sum(len(p) for p in parts[:i])
+                   for i in range(len(parts))]
+        b.record(hprof.TAG_HEAP_DUMP_SEGMENT, b''.join(parts))
+        b.record(hprof.TAG_HEAP_DUMP_END, b'')
+
+        recorder = RecordingVisitor()
+        hprof.walk(io.BytesIO(b.data), recorder, 7)
+        self.assertEqual([
+            ('string', 1, b'java.lang.Object'),
+            ('load_class', 0x10, 1),
+            ('root', hprof.ROOT_INTERNED_STRING, 0x20),
+            ('class_dump', offsets[1], 0x10, 0, 4,
+             [(90, 10, 8), (91, hprof.TYPE_OBJECT, 0x100)], [(92, 10)]),
+            ('instance', offsets[2], 0x30, 0x10, 4, u4(5)),
+            ('object_array', offsets[3], 0x31, 0x11, 2,
+             b.ident(0x30) + b.ident(0)),
+            ('primitive_array', offsets[4], 0x33, 10, 3),
+        ], recorder.calls)
+
+    def test_walk_not_hprof(self):
+        self.assertRaises(hprof.HprofError, hprof.walk,
+                          io.BytesIO(b'PK\3\4' * 20), hprof.HeapVisitor())
+
+
+if __name__ == '__main__':
+    unittest.main()
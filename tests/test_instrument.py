@@ -0,0 +1,92 @@
+from dumpey import instrument
+
+import unittest
+import json
+
+try:
+    from StringIO import StringIO
+except ImportError:
+    from io import StringIO
+
+DEVICE = 'dummy_device'
+
+
+class InstrumentTest(unittest.TestCase):
+
+    def tearDown(self):
+        instrument.disable()
+
+    def test_begin_disabled(self):
+        self.assertIsNone(instrument.recorder)
+        self.assertIsNone(instrument.begin(['adb', 'devices']))
+
+    def test_begin_enabled(self):
+        recorder = instrument.enable()
+        timer = instrument.begin(['adb', '-s', DEVICE, 'shell', 'ls -l'])
+        timer.end(0, 5)
+        self.assertIs(recorder, instrument.disable())
+        calls = recorder.calls()
+        self.assertEqual(1, len(calls))
+        self.assertEqual(('adb shell ls', DEVICE, 0, 5),
+                         (calls[0].kind, calls[0].device, calls[0].status,
+                          calls[0].size))
+        self.assertIsNone(instrument.begin(['adb', 'devices']))
+
+    def test_command_kind(self):
+        self.assertEqual('adb devices', instrument.command_kind(
+            ['adb', 'devices']))
+        self.assertEqual('adb shell dumpsys', instrument.command_kind(
+            ['adb', '-s', DEVICE, 'shell', 'dumpsys', 'meminfo']))
+        self.assertEqual('adb exec-out cat', instrument.command_kind(
+            ['adb', '-s', DEVICE, 'exec-out', 'cat', '/sdcard/f']))
+        self.assertEqual('adb shell batch', instrument.command_kind(
+            ['adb', '-s', DEVICE, 'shell', 'echo _dumpey_1 $?; ls']))
+        self.assertEqual('adb pull', instrument.command_kind(
+            ['/opt/sdk/adb.exe', 'pull', 'remote', 'local']))
+        self.assertEqual('hprof-conv', instrument.command_kind(
+            ['hprof-conv', 'in', 'out']))
+
+    def test_summary(self):
+        recorder = instrument.Recorder()
+        for seconds in (0.0005, 0.002, 0.002, 0.05, 20):
+            recorder.record('adb pull', DEVICE, 0, seconds, 0, 1000)
+        recorder.record('adb pull', DEVICE, 0, 0.004, 1)
+        summary = recorder.summary()['adb pull']
+        self.assertEqual(6, summary['calls'])
+        self.assertEqual(1, summary['errors'])
+        self.assertEqual(0.004, summary['p50'])
+        self.assertEqual(20, summary['max'])
+        self.assertEqual(5000, summary['bytes'])
+        self.assertAlmostEqual(5000 / 20.0545, summary['throughput'])
+        self.assertEqual([1, 2, 1, 0, 1, 0, 0, 0, 0, 1],
+                         summary['histogram'])
+
+    def test_write_report(self):
+        recorder = instrument.Recorder()
+        recorder.record('adb shell ls', DEVICE, 0, 0.002, 0, 2000000)
+        recorder.record('adb devices', None, 0, 0.5)
+        out = StringIO()
+        instrument.write_report(out, recorder)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(['kind', 'calls'], lines[0].split()[:2])
+        self.assertEqual(['adb', 'devices', '1', '0', '0.50'],
+                         lines[1].split()[:5])
+        self.assertEqual(['2.00', '1000.00'], lines[2].split()[-2:])
+        self.assertEqual(['adb', 'shell', 'ls', '.', '1', '.'],
+                         lines[-1].split()[:6])
+
+    def test_write_json(self):
+        recorder = instrument.Recorder()
+        recorder.record('adb devices', None, 1.5, 0.25, 0, 10)
+        out = StringIO()
+        instrument.write_json(out, recorder)
+        data = json.loads(out.getvalue())
+        self.assertEqual(1, data['version'])
+        self.assertEqual([{'kind': 'adb devices', 'device': None,
+                           'start': 1.5, 'seconds': 0.25, 'status': 0,
+                           'size': 10}], data['calls'])
+        self.assertEqual(1, data['summary']['adb devices']['calls'])
+
+
+if __name__ == '__main__':
+    unittest.main()
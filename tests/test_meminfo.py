@@ -0,0 +1,165 @@
+from dumpey import meminfo
+
+import threading
+import unittest
+import json
+import io
+
+# Android 10, PSS column only
+SUMMARY = """Applications Memory Usage (in Kilobytes):
+Uptime: 1000 Realtime: 1000
+
+** MEMINFO in pid 1234 [com.dummy.app] **
+                   Pss  Private  Private  SwapPss     Heap     Heap     Heap
+                 Total    Dirty    Clean    Dirty     Size    Alloc     Free
+                ------   ------   ------   ------   ------   ------   ------
+  Native Heap     5000     4900        0       10    12000     9000     3000
+  Dalvik Heap     3000     2900        0        5     8000     6000     2000
+        TOTAL    20000    15000     2000       30    20000    15000     5000
+
+ App Summary
+                       Pss(KB)
+                        ------
+           Java Heap:     3100
+         Native Heap:     4900
+                Code:     1000
+               Stack:       50
+            Graphics:     7000
+       Private Other:      800
+              System:     3150
+
+               TOTAL:    20000       TOTAL SWAP PSS:       30
+"""
+
+# Android 11, PSS and RSS columns
+SUMMARY_RSS = """ App Summary
+                       Pss(KB)                        Rss(KB)
+                        ------                         ------
+           Java Heap:     3100                           9000
+         Native Heap:     4900                           5000
+            Graphics:     7000                           7100
+
+           TOTAL PSS:    20000            TOTAL RSS:    40000
+"""
+
+# Android 4.4, detailed table only
+TABLE = """** MEMINFO in pid 1234 [com.dummy.app] **
+                   Pss  Private  Private  Swapped     Heap     Heap     Heap
+                 Total    Dirty    Clean    Dirty     Size    Alloc     Free
+                ------   ------   ------   ------   ------   ------   ------
+  Native Heap     5000     4900        0        0    12000     9000     3000
+  Dalvik Heap     3000     2900        0        0     8000     6000     2000
+     Gfx dev      1000     1000        0        0
+    GL mtrack      600      600        0        0
+        TOTAL    20000    15000     2000        0    20000    15000     5000
+"""
+
+
+class MeminfoTest(unittest.TestCase):
+
+    def test_parse_summary(self):
+        expected = {'pss': 20000, 'java_heap': 3100, 'native_heap': 4900,
+                    'graphics': 7000}
+        self.assertEqual(expected, meminfo.parse(SUMMARY))
+        self.assertEqual(expected, meminfo.parse(SUMMARY_RSS))
+
+    def test_parse_table(self):
+        self.assertEqual({'pss': 20000, 'java_heap': 3000,
+                          'native_heap': 5000, 'graphics': 1600},
+                         meminfo.parse(TABLE))
+
+    def test_parse_no_process(self):
+        self.assertIsNone(meminfo.parse('No process found for: com.dummy'))
+
+    def create_series(self):
+        series = meminfo.MemorySeries()
+        series.add(1.5, meminfo.parse(SUMMARY))
+        series.add(2.25, meminfo.parse(TABLE))
+        series.add(3, {'pss': 100})
+        return series
+
+    def test_series(self):
+        series = self.create_series()
+        self.assertEqual(3, len(series))
+        samples = list(series)
+        self.assertEqual((1.5, meminfo.parse(SUMMARY)), samples[0])
+        self.assertEqual({'pss': 100, 'java_heap': None, 'native_heap': None,
+                          'graphics': None}, samples[2][1])
+
+    def write(self, fmt):
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        self.create_series().write(out, fmt)
+        return out.getvalue().splitlines()
+
+    def test_write_csv(self):
+        lines = self.write(meminfo.CSV)
+        self.assertEqual(['time,pss,java_heap,native_heap,graphics',
+                          '1.500,20000,3100,4900,7000',
+                          '2.250,20000,3000,5000,1600',
+                          '3.000,100,,,'], lines)
+
+    def test_write_ndjson(self):
+        lines = self.write(meminfo.NDJSON)
+        self.assertEqual(3, len(lines))
+        self.assertEqual({'time': 3, 'pss': 100, 'java_heap': None,
+                          'native_heap': None, 'graphics': None},
+                         json.loads(lines[2]))
+
+    def test_write_unknown_format(self):
+        self.assertRaises(Exception, self.write, 'xml')
+
+    def write_usage(self, fmt=None, timestamp=None, header=True):
+        usage = {'device_2': {'com.dummy.app': meminfo.parse(TABLE)},
+                 'device_1': {'com.dummy.app': meminfo.parse(SUMMARY),
+                              'com.dummy.small': {'pss': 10}}}
+        out = io.StringIO() if str is not bytes else io.BytesIO()
+        meminfo.write_usage(out, usage, fmt, timestamp, header)
+        return out.getvalue().splitlines()
+
+    def test_write_usage_table(self):
+        lines = self.write_usage()
+        self.assertEqual(4, len(lines))
+        self.assertEqual(['20000', '3100', '4900', '7000', 'device_1', '/',
+                          'com.dummy.app'], lines[1].split())
+        self.assertEqual('device_2', lines[2].split()[4])
+        self.assertEqual(['10', '-', '-', '-', 'device_1', '/',
+                          'com.dummy.small'], lines[3].split())
+
+    def test_write_usage_csv(self):
+        lines = self.write_usage(meminfo.CSV, 5)
+        self.assertEqual(['time,device,package,pss,java_heap,native_heap,'
+                          'graphics',
+                          '5.000,device_1,com.dummy.app,20000,3100,4900,7000',
+                          '5.000,device_2,com.dummy.app,20000,3000,5000,1600',
+                          '5.000,device_1,com.dummy.small,10,,,'], lines)
+        self.assertEqual(3, len(self.write_usage(meminfo.CSV, header=False)))
+
+    def test_write_usage_ndjson(self):
+        lines = self.write_usage(meminfo.NDJSON)
+        self.assertEqual({'device': 'device_1', 'package': 'com.dummy.small',
+                          'pss': 10}, json.loads(lines[2]))
+
+    def test_sampler(self):
+        sampled = threading.Event()
+        calls = []
+
+        def query(package, device):
+            calls.append((package, device))
+            if len(calls) == 3:
+                sampled.set()
+            if len(calls) == 2:
+                raise Exception('adb failed')
+            return SUMMARY
+
+        sampler = meminfo.Sampler(query, 0.001)
+        self.assertIsNone(sampler.stop('com.dummy.app', 'device'))
+        sampler.start('com.dummy.app', 'device')
+        self.assertTrue(sampled.wait(5))
+        series = sampler.stop('com.dummy.app', 'device')
+        self.assertEqual(len(calls) - 1, len(series))
+        self.assertEqual(('com.dummy.app', 'device'), calls[0])
+        self.assertIsNone(sampler.stop('com.dummy.app', 'device'))
+
+
+if __name__ == '__main__':
+    unittest.main()
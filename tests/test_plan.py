@@ -0,0 +1,157 @@
+from dumpey import dumpey
+from dumpey import plan
+
+import threading
+import unittest
+import tempfile
+import shutil
+import json
+import mock
+import time
+import os
+
+DEVICE_1 = 'dummy_device_1'
+DEVICE_2 = 'dummy_device_2'
+
+
+class PlanTest(unittest.TestCase):
+
+    def test_parse(self):
+        steps = plan.parse({'steps': [
+            ['l'],
+            {'name': 'clear', 'args': 'c -p "com.dummy"'},
+            {'name': 'dump', 'args': ['h', '-p', 'com.dummy'],
+             'after': ['clear']},
+            {'name': 'top', 'args': 't dump.hprof', 'after': []},
+        ]})
+        self.assertEqual([('1', ('l',), ()),
+                          ('clear', ('c', '-p', 'com.dummy'), ('1',)),
+                          ('dump', ('h', '-p', 'com.dummy'), ('clear',)),
+                          ('top', ('t', 'dump.hprof'), ())], steps)
+
+    def test_parse_order(self):
+        steps = plan.parse([{'name': 'b', 'args': 'l', 'after': 'a'},
+                            {'name': 'a', 'args': 'l', 'after': []}])
+        self.assertEqual(['a', 'b'], [step.name for step in steps])
+
+    def test_parse_errors(self):
+        for data in ([], {'steps': 'l'}, [{'name': 'a'}],
+                     [{'name': 'a', 'args': 'l'}, {'name': 'a', 'args': 'l'}],
+                     [{'args': 'l', 'after': ['x']}],
+                     [{'name': 'a', 'args': 'l', 'after': ['b']},
+                      {'name': 'b', 'args': 'l', 'after': ['a']}]):
+            self.assertRaises(plan.PlanError, plan.parse, data)
+
+    def test_tasks(self):
+        steps = plan.parse([{'name': 'a', 'args': 'l'},
+                            {'name': 'b', 'args': 'l'},
+                            {'name': 'c', 'args': 't f', 'after': ['a']}])
+        a, b, c = steps
+        graph = plan.tasks(steps, {'a': [DEVICE_1, DEVICE_2],
+                                   'b': [DEVICE_1, DEVICE_2]})
+        self.assertEqual({
+            plan.Task(a, DEVICE_1): set(),
+            plan.Task(a, DEVICE_2): set(),
+            plan.Task(b, DEVICE_1): set([plan.Task(a, DEVICE_1)]),
+            plan.Task(b, DEVICE_2): set([plan.Task(a, DEVICE_2)]),
+            plan.Task(c, None): set([plan.Task(a, DEVICE_1),
+                                     plan.Task(a, DEVICE_2)]),
+        }, dict(graph))
+
+    def test_run(self):
+        steps = plan.parse([{'name': 'a', 'args': 'l'},
+                            {'name': 'b', 'args': 'l'},
+                            {'name': 'c', 'args': 'l'}])
+        graph = plan.tasks(steps, dict((step.name, [DEVICE_1, DEVICE_2])
+                                       for step in steps))
+        ran = []
+        lock = threading.Lock()
+
+        def execute(task):
+            with lock:
+                ran.append((task.step.name, task.device))
+            if task == (steps[0], DEVICE_2):
+                raise ValueError('failed')
+
+        outcomes = plan.run(graph, execute, 4)
+        self.assertEqual(None, outcomes[plan.Task(steps[2], DEVICE_1)])
+        self.assertIsInstance(outcomes[plan.Task(steps[0], DEVICE_2)],
+                              ValueError)
+        self.assertEqual(plan.SKIPPED, outcomes[plan.Task(steps[1], DEVICE_2)])
+        self.assertEqual(plan.SKIPPED, outcomes[plan.Task(steps[2], DEVICE_2)])
+        device_1 = [name for name, device in ran if device == DEVICE_1]
+        self.assertEqual(['a', 'b', 'c'], device_1)
+        self.assertEqual(4, len(ran))
+
+
+class HandleRunTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def write_plan(self, data):
+        path = os.path.join(self.tmp_dir, 'plan.json')
+        with open(path, 'w') as f:
+            json.dump(data, f)
+        return path
+
+    @mock.patch('dumpey.dumpey.dump_heap')
+    @mock.patch('dumpey.dumpey.clear_data')
+    @mock.patch('dumpey.dumpey.attached_devices',
+                return_value=[DEVICE_1, DEVICE_2])
+    def test_run(self, devices_mock, clear_mock, dump_mock):
+        path = self.write_plan([['c', '-p', 'com.dummy'],
+                                ['h', '-p', 'com.dummy', '-s', DEVICE_2]])
+        dumpey._handle_run(path)
+        self.assertEqual(1, devices_mock.call_count)
+        self.assertEqual(
+            sorted([mock.call('com.dummy', None, [DEVICE_1], False, None),
+                    mock.call('com.dummy', None, [DEVICE_2], False, None)]),
+            sorted(clear_mock.call_args_list))
+        dump_mock.assert_called_once_with('com.dummy', None, [DEVICE_2],
+                                          None, False, None, None)
+
+    @mock.patch('dumpey.dumpey.attached_devices', return_value=[DEVICE_1])
+    def test_run_dumps_one_at_a_time(self, devices_mock):
+        # Independent steps on a device must not share its temporary dump
+        # file at the same time.
+        path = self.write_plan([{'args': 'h -p com.dummy.fst', 'after': []},
+                                {'args': 'h -p com.dummy.snd', 'after': []}])
+        lock = threading.Lock()
+        running = []
+        overlaps = []
+
+        def dump_heap(package, *args):
+            with lock:
+                running.append(package)
+                overlaps.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(package)
+
+        with mock.patch('dumpey.dumpey.dump_heap',
+                        side_effect=dump_heap) as dump_mock:
+            dumpey._handle_run(path, max_workers=4)
+        self.assertEqual(2, dump_mock.call_count)
+        self.assertEqual([1, 1], overlaps)
+
+    @mock.patch('dumpey.dumpey.clear_data', side_effect=Exception('failed'))
+    def test_run_failed(self, clear_mock):
+        path = self.write_plan([['c', '-p', 'com.dummy', '-s', DEVICE_1],
+                                ['u', '-p', 'com.dummy', '-s', DEVICE_1]])
+        with mock.patch('dumpey.dumpey.uninstall') as uninstall_mock:
+            self.assertRaises(Exception, dumpey._handle_run, path)
+        self.assertEqual(0, uninstall_mock.call_count)
+
+    def test_invalid_step(self):
+        for step in (['--native', 'l'], ['run', 'other.json']):
+            path = self.write_plan([step])
+            self.assertRaises(plan.PlanError, dumpey._handle_run, path)
+        path = self.write_plan([['x']])
+        with mock.patch('sys.stderr'):
+            self.assertRaises(plan.PlanError, dumpey._handle_run, path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,150 @@
+from dumpey import adbclient
+from dumpey import registry
+from dumpey import dumpey
+
+import threading
+import unittest
+import mock
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+DEVICE_1 = 'dummy_device_1'
+DEVICE_2 = 'dummy_device_2'
+
+
+def device_list(*devices):
+    return ''.join('%s\t%s\n' % device for device in devices)
+
+
+class FakeTracker(object):
+    # Returns the device lists put into lists, and raises AdbError once
+    # closed or when it gets None.
+
+    def __init__(self):
+        self.lists = queue.Queue()
+        self.closed = threading.Event()
+
+    def next(self):
+        while not self.closed.is_set():
+            try:
+                output = self.lists.get(timeout=0.01)
+            except queue.Empty:
+                continue
+            if output is None:
+                break
+            return output
+        raise adbclient.AdbError('connection closed by the adb server')
+
+    def close(self):
+        self.closed.set()
+
+
+class DeviceRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.changes = queue.Queue()
+        self.listed = []
+
+    def list_devices(self, *devices):
+        def list_devices():
+            self.listed.append(devices)
+            return 'List of devices attached\n' + device_list(*devices)
+        return list_devices
+
+    def start(self, devices):
+        devices.add_listener(lambda *change: self.changes.put(change))
+        devices.start()
+        self.addCleanup(devices.stop)
+        return devices
+
+    def test_parse_devices(self):
+        self.assertEqual([(DEVICE_1, 'device'), (DEVICE_2, 'offline')],
+                         registry.parse_devices(
+                             'List of devices attached\n%s\tdevice\n'
+                             '%s\toffline\n\n' % (DEVICE_1, DEVICE_2)))
+        self.assertEqual([], registry.parse_devices(''))
+
+    def test_track(self):
+        tracker = FakeTracker()
+        devices = self.start(registry.DeviceRegistry(
+            self.list_devices((DEVICE_1, 'device')), lambda: tracker))
+        self.assertEqual((DEVICE_1, None, 'device'), self.changes.get())
+        self.assertEqual([DEVICE_1], devices.devices())
+        tracker.lists.put(device_list((DEVICE_1, 'offline'),
+                                      (DEVICE_2, 'device')))
+        self.assertEqual((DEVICE_1, 'device', 'offline'),
+                         self.changes.get(timeout=5))
+        self.assertEqual((DEVICE_2, None, 'device'),
+                         self.changes.get(timeout=5))
+        self.assertEqual([DEVICE_2], devices.devices())
+        self.assertEqual([DEVICE_1, DEVICE_2], devices.devices(None))
+        self.assertEqual({DEVICE_1: 'offline', DEVICE_2: 'device'},
+                         devices.states())
+        self.assertEqual(1, len(self.listed))
+        devices.stop()
+        self.assertTrue(tracker.closed.is_set())
+
+    def test_poll_when_tracking_fails(self):
+        def track():
+            raise adbclient.ServerUnavailable('no adb server')
+
+        listed = [[(DEVICE_1, 'device')], []]
+        devices = registry.DeviceRegistry(
+            lambda: device_list(*(listed.pop(0) if listed else [])),
+            track, interval=0.01)
+        self.start(devices)
+        self.assertEqual((DEVICE_1, None, 'device'), self.changes.get())
+        self.assertEqual((DEVICE_1, 'device', None),
+                         self.changes.get(timeout=5))
+        self.assertEqual([], devices.devices())
+
+    def test_wait_for(self):
+        tracker = FakeTracker()
+        devices = self.start(registry.DeviceRegistry(
+            self.list_devices(), lambda: tracker))
+        self.assertFalse(devices.wait_for(DEVICE_1, timeout=0.01))
+        tracker.lists.put(device_list((DEVICE_1, 'device')))
+        self.assertTrue(devices.wait_for(DEVICE_1, timeout=5))
+
+    def test_listener_error(self):
+        tracker = FakeTracker()
+        devices = registry.DeviceRegistry(self.list_devices(),
+                                          lambda: tracker)
+        devices.add_listener(mock.Mock(side_effect=ValueError))
+        self.start(devices)
+        with mock.patch('traceback.print_exc') as print_mock:
+            tracker.lists.put(device_list((DEVICE_1, 'device')))
+            self.assertEqual((DEVICE_1, None, 'device'),
+                             self.changes.get(timeout=5))
+        self.assertEqual(1, print_mock.call_count)
+
+
+class WatchDevicesTest(unittest.TestCase):
+
+    def tearDown(self):
+        dumpey.watch_devices(False)
+
+    @mock.patch('dumpey.registry.DeviceRegistry.start', autospec=True)
+    @mock.patch('subprocess.Popen', autospec=True)
+    def test_attached_devices(self, popen_mock, start_mock):
+        devices = dumpey.watch_devices()
+        devices._update([(DEVICE_1, 'device'), (DEVICE_2, 'offline')])
+        self.assertEqual([DEVICE_1], dumpey.attached_devices())
+        devices._update([(DEVICE_2, 'offline')])
+        self.assertRaises(Exception, dumpey.attached_devices)
+        self.assertEqual(0, popen_mock.call_count)
+
+    @mock.patch('dumpey.registry.DeviceRegistry.start', autospec=True)
+    def test_forget_flapping_device(self, start_mock):
+        devices = dumpey.watch_devices()
+        devices._update([(DEVICE_1, 'device')])
+        dumpey._package_cache[DEVICE_1] = (0, ['com.dummy'])
+        devices._update([])
+        self.assertNotIn(DEVICE_1, dumpey._package_cache)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,189 @@
+from dumpey import dumpey
+from dumpey import server
+
+import threading
+import unittest
+import tempfile
+import shutil
+import socket
+import mock
+import time
+import os
+
+DEVICE_1 = 'dummy_device_1'
+DEVICE_2 = 'dummy_device_2'
+PACKAGE = 'com.dummy.package.fst'
+
+
+@unittest.skipUnless(hasattr(socket, 'AF_UNIX'), 'needs Unix sockets')
+class ServerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+        self.path = os.path.join(self.tmp_dir, 'dumpey.sock')
+        self.server = server.Server(self.path)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  args=(0.05,))
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join)
+        self.addCleanup(self.server.shutdown)
+        self.client = server.Client(self.path, timeout=5)
+        self.addCleanup(self.client.close)
+
+    @mock.patch('dumpey.dumpey.attached_devices', return_value=[DEVICE_1])
+    @mock.patch('dumpey.dumpey.package_list')
+    def test_call(self, package_list_mock, devices_mock):
+        package_list_mock.return_value = {DEVICE_1: [PACKAGE]}
+        self.assertEqual({DEVICE_1: [PACKAGE]},
+                         self.client.package_list(regex='dummy'))
+        self.assertEqual({DEVICE_1: [PACKAGE]},
+                         self.client.call('package_list'))
+        self.assertEqual([mock.call(devices=[DEVICE_1], regex='dummy'),
+                          mock.call(devices=[DEVICE_1])],
+                         package_list_mock.call_args_list)
+        self.assertEqual([DEVICE_1], self.client.attached_devices())
+
+    def test_unknown_method(self):
+        self.assertRaises(server.RemoteError, self.client.call, 'adb',
+                          args=['reboot'])
+        self.assertRaises(AttributeError, getattr, self.client, 'adb')
+
+    @mock.patch('dumpey.dumpey.pid', side_effect=Exception('no process'))
+    def test_error(self, pid_mock):
+        with self.assertRaises(server.RemoteError) as cm:
+            self.client.pid(package=PACKAGE, device=DEVICE_1)
+        self.assertEqual('Exception', cm.exception.type)
+        self.assertEqual('no process', str(cm.exception))
+
+    @mock.patch('dumpey.dumpey.attached_devices',
+                return_value=[DEVICE_1, DEVICE_2])
+    def test_per_device(self, devices_mock):
+        def install(devices, **params):
+            if devices == [DEVICE_2]:
+                raise dumpey.DeviceError({}, {DEVICE_2: Exception('full')})
+            return {devices[0]: {'installed': ['a.apk']}}
+
+        with mock.patch('dumpey.dumpey.install',
+                        side_effect=install) as install_mock:
+            with self.assertRaises(dumpey.DeviceError) as cm:
+                self.client.install(local_path='apks', reinstall=True)
+        self.assertEqual({DEVICE_1: {'installed': ['a.apk']}},
+                         cm.exception.results)
+        self.assertEqual('full', str(cm.exception.errors[DEVICE_2]))
+        local_path = os.path.abspath('apks')
+        self.assertEqual(
+            [mock.call(devices=[DEVICE_1], local_path=local_path,
+                       reinstall=True),
+             mock.call(devices=[DEVICE_2], local_path=local_path,
+                       reinstall=True)],
+            sorted(install_mock.call_args_list,
+                   key=lambda c: c[1]['devices']))
+
+    @mock.patch('dumpey.dumpey._usb_hubs',
+                return_value={DEVICE_1: '1-1', DEVICE_2: '1-1'})
+    def test_install_hub_workers(self, hubs_mock):
+        local_file = os.path.join(self.tmp_dir, 'a.apk')
+        open(local_file, 'w').close()
+        lock = threading.Lock()
+        running = []
+        overlaps = []
+
+        def install_apks(local_files, device, throttle=None):
+            with lock:
+                running.append(device)
+                overlaps.append(len(running))
+            time.sleep(0.05)
+            with lock:
+                running.remove(device)
+
+        with mock.patch('dumpey.dumpey._install_apks',
+                        side_effect=install_apks) as install_mock:
+            with mock.patch('sys.stdout'):
+                out = self.client.install(local_path=local_file,
+                                          devices=[DEVICE_2, DEVICE_1],
+                                          reinstall=True, hub_workers=1)
+        self.assertEqual([local_file], out[DEVICE_1]['installed'])
+        self.assertEqual([local_file], out[DEVICE_2]['installed'])
+        self.assertEqual(2, install_mock.call_count)
+        self.assertEqual([1, 1], overlaps)
+
+    def test_device_lock(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def dump_heap(package, devices):
+            calls.append((package, devices))
+            if package == 'first':
+                started.set()
+                release.wait(5)
+
+        with mock.patch('dumpey.dumpey.dump_heap', side_effect=dump_heap):
+            first = threading.Thread(target=self.client.dump_heap,
+                                     kwargs={'package': 'first',
+                                             'devices': [DEVICE_1]})
+            first.start()
+            started.wait(5)
+            with server.Client(self.path, timeout=5) as other:
+                other.dump_heap(package='other', devices=[DEVICE_2])
+                waiting = threading.Thread(
+                    target=other.dump_heap,
+                    kwargs={'package': 'second', 'devices': [DEVICE_1]})
+                waiting.start()
+                waiting.join(0.1)
+                self.assertEqual(['first', 'other'], [c[0] for c in calls])
+                release.set()
+                waiting.join(5)
+            first.join(5)
+        self.assertEqual(['first', 'other', 'second'], [c[0] for c in calls])
+
+    def test_device_lock_reads(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def monkey(devices, **params):
+            calls.append('monkey')
+            started.set()
+            release.wait(5)
+
+        def api_version(device):
+            calls.append('api_version')
+            return '30'
+
+        with mock.patch('dumpey.dumpey.monkey', side_effect=monkey):
+            with mock.patch('dumpey.dumpey.api_version',
+                            side_effect=api_version):
+                first = threading.Thread(target=self.client.monkey,
+                                         kwargs={'package': PACKAGE,
+                                                 'devices': [DEVICE_1]})
+                first.start()
+                started.wait(5)
+                with server.Client(self.path, timeout=5) as other:
+                    waiting = threading.Thread(target=other.api_version,
+                                               kwargs={'device': DEVICE_1})
+                    waiting.start()
+                    waiting.join(0.1)
+                    self.assertEqual(['monkey'], calls)
+                    release.set()
+                    waiting.join(5)
+                first.join(5)
+        self.assertEqual(['monkey', 'api_version'], calls)
+
+    def test_already_serving(self):
+        self.assertRaises(Exception, server.Server, self.path)
+
+    def test_stale_socket(self):
+        path = os.path.join(self.tmp_dir, 'stale.sock')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.bind(path)
+        sock.close()
+        stale = server.Server(path)
+        stale._server.server_close()
+        self.assertTrue(os.path.exists(path))
+
+
+if __name__ == '__main__':
+    unittest.main()